@@ -1,9 +1,13 @@
 
 from copy import deepcopy
 from datetime import datetime
-from os import getcwd, path, makedirs
+from functools import reduce
+from os import getcwd, path, makedirs, remove, replace
 from string import ascii_letters, digits
 import json
+import pickle
+import shutil
+from tempfile import mkdtemp
 import multiprocessing as mp
 
 from configargparse import ArgParser
@@ -12,15 +16,19 @@ from scipy import stats as sps
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-import math
+import time
 
 
-from _99_shared_functions import SIR_from_params, qdraw, jumper, power_spline,\
-    reopen_wrapper
+from _99_shared_functions import SIR_from_params, qdraw, jumper, \
+    spline_design_matrix, reopening_days, reopening_scenarios, ParamSchema, \
+    binomial_observation, OBSERVATION_MODELS, projection_days, \
+    TrajectoryReservoir, AdaptiveProposal, effective_sample_size, ParamVector, \
+    convergence_diagnostics, SampleStore, ChainWriter, QuadraticEmulator, read_chains
 
-from _02_munge_chains import SD_plot, mk_projection_tables, plt_predictive, \
+from _02_munge_chains import SD_plot, mk_projection_tables, plot_horizons, plt_predictive, \
     plt_pairplot_posteriors, SEIR_plot, Rt_plot
-from utils import beta_from_q
+from utils import beta_from_q, DirectoryType
+from bayes_chime.executor import RunExecutor
 
 LET_NUMS = pd.Series(list(ascii_letters) + list(digits))
 
@@ -75,29 +83,43 @@ def write_inputs(options, paramdir, census_ts, params, prefix=""):
 
 
 def loglik(r):
-    return -len(r) / 2 * (np.log(2 * np.pi * np.var(r))) - 1 / (
-        2 * np.pi * np.var(r)
-    ) * np.sum(r ** 2)
+    # residuals are along the last axis, so a matrix gives one value per row
+    n = r.shape[-1]
+    var = np.var(r, axis=-1)
+    return -n / 2 * (np.log(2 * np.pi * var)) - 1 / (
+        2 * np.pi * var
+    ) * np.sum(r ** 2, axis=-1)
 
 
 def do_shrinkage(pos, shrinkage, shrink_mask):
     densities = sps.beta.pdf(pos, a=shrinkage[0], b=shrinkage[1])
     densities *= shrink_mask
-    regularization_penalty = -np.sum(np.log(densities))
+    regularization_penalty = -np.sum(np.log(densities), axis=-1)
     return regularization_penalty
 
 
 def eval_pos(pos, params, obs, shrinkage, shrink_mask, holdout, 
-             sample_obs, forecast_priors, ignore_vent):
-    """function takes quantiles of the priors and outputs a posterior and relevant stats"""
+             sample_obs, forecast_priors, ignore_vent,
+             rng=None, observation=binomial_observation):
+    """
+    function takes quantiles of the priors and outputs a posterior and relevant stats
+    `pos` may also be an (n_proposals, size) matrix; everything is then
+    evaluated in one batched simulation and the posterior is a vector.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
     n_obs = obs.shape[0]
     nobs = n_obs-holdout
-    draw = SIR_from_params(qdraw(pos, params))
+    # fit mode: only simulate the days the likelihood reads, and skip the
+    # stochastic projection. Retained samples are projected by chain()
+    fit_days = n_obs + 7 if forecast_priors['sig'] > 0 else n_obs
+    draw = SIR_from_params(qdraw(pos, params), observation=observation, rng=rng,
+                           n_days=fit_days, stochastic=False)
     if sample_obs:
-        ynoise_h = np.random.normal(scale=obs.hosp_rwstd)
+        ynoise_h = rng.normal(scale=obs.hosp_rwstd)
         ynoise_h[0] = 0
         obs.hosp += ynoise_h
-        ynoise_v = np.random.normal(scale=obs.vent_rwstd)
+        ynoise_v = rng.normal(scale=obs.vent_rwstd)
         ynoise_v[0] = 0
         obs.vent += ynoise_v
     if holdout > 0:
@@ -110,24 +132,22 @@ def eval_pos(pos, params, obs, shrinkage, shrink_mask, holdout,
     residuals_vent = None
     if train.vent.sum() > 0:
         residuals_vent = (
-            draw["arr"][: (n_obs - holdout), 5] - train.vent.values[:nobs]
+            draw["arr"][..., : (n_obs - holdout), 5] - train.vent.values[:nobs]
         )  # 5 corresponds with vent census
-        if any(residuals_vent == 0):
-            residuals_vent[residuals_vent == 0] = 0.01
+        residuals_vent[residuals_vent == 0] = 0.01
         sigma2 = np.var(residuals_vent)
         if ignore_vent is False:
             LL += loglik(residuals_vent)
 
     # loss for hosp
     residuals_hosp = (
-        draw["arr"][: (n_obs - holdout), 3] - train.hosp.values[:nobs]
+        draw["arr"][..., : (n_obs - holdout), 3] - train.hosp.values[:nobs]
     )  # 3 corresponds with hosp census
-    if any(residuals_hosp == 0):
-        residuals_hosp[residuals_hosp == 0] = 0.01
+    residuals_hosp[residuals_hosp == 0] = 0.01
     sigma2 = np.var(residuals_hosp)
     LL += loglik(residuals_hosp)
 
-    Lprior = np.log(draw["parms"].prob).sum()
+    Lprior = draw["parms"].logprior.sum(axis=-1)
     posterior = LL + Lprior
     # shrinkage -- the regarization parameter reaches its max value at the median of each prior.
     # the penalty gets subtracted off of the posterior
@@ -138,100 +158,265 @@ def eval_pos(pos, params, obs, shrinkage, shrink_mask, holdout,
     # first compute the percent change in the forecast, one week out
     # then compute the probability of the change under the prior
     if forecast_priors['sig']>0:
-        hosp_next_week = draw['arr'][n_obs+7,3]
+        hosp_next_week = draw['arr'][..., n_obs+7,3]
         hosp_now = train.hosp.values[-1]
         hosp_pct_diff = (hosp_next_week/hosp_now-1) * 100
         hosp_forecast_prob = sps.norm.pdf(hosp_pct_diff, forecast_priors['mu'], forecast_priors['sig'])
         
-        vent_next_week = draw['arr'][n_obs+7,5]
+        vent_next_week = draw['arr'][..., n_obs+7,5]
         vent_now = train.vent.values[-1]
         vent_pct_diff = (vent_next_week/vent_now-1) * 100
         vent_forecast_prob = sps.norm.pdf(vent_pct_diff, forecast_priors['mu'], forecast_priors['sig'])      
 
         forecast_prior_contrib = (hosp_forecast_prob * vent_forecast_prob)
-        forecast_prior_contrib = np.log(forecast_prior_contrib) if forecast_prior_contrib >0 else -np.inf
-        posterior += forecast_prior_contrib
+        with np.errstate(divide="ignore"):
+            forecast_prior_contrib = np.log(forecast_prior_contrib)
+        posterior = posterior + forecast_prior_contrib
 
     out = dict(
         pos=pos,
         draw=draw,
         posterior=posterior,
+        # the data likelihood, and everything else (priors, shrinkage, forecast prior)
+        loglik=LL,
+        logprior=posterior - LL,
         residuals_vent=residuals_vent,
         residuals_hosp=residuals_hosp,
     )
     if holdout > 0:
-        res_te_vent = draw["arr"][(n_obs - holdout) : n_obs, 5] - test.vent.values[:n_obs]
-        res_te_hosp = draw["arr"][(n_obs - holdout) : n_obs, 3] - test.hosp.values[:n_obs]
-        test_loss = (np.mean(res_te_hosp ** 2) + np.mean(res_te_vent ** 2)) / 2
+        res_te_vent = draw["arr"][..., (n_obs - holdout) : n_obs, 5] - test.vent.values[:n_obs]
+        res_te_hosp = draw["arr"][..., (n_obs - holdout) : n_obs, 3] - test.hosp.values[:n_obs]
+        test_loss = (np.mean(res_te_hosp ** 2, axis=-1) + np.mean(res_te_vent ** 2, axis=-1)) / 2
         out.update({"test_loss": test_loss})
     return out
 
 
+def n_kept(n_iters, burn_in, thin):
+    """Number of iterations a chain keeps: every `thin`-th after burn-in"""
+    return len(range(burn_in + 1, n_iters, thin))
+
+
+def save_checkpoint(checkpoint, state):
+    """Pickle a sampler state to the file `checkpoint`, atomically"""
+    tmp = f"{checkpoint}.tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    replace(tmp, checkpoint)
+
+
+def load_checkpoint(checkpoint):
+    """The sampler state saved at `checkpoint`, or None if there is none"""
+    if checkpoint is None or not path.exists(checkpoint):
+        return None
+    with open(checkpoint, "rb") as f:
+        return pickle.load(f)
+
+
 def chain(seed, params, obs, n_iters, shrinkage, holdout, 
           forecast_priors,
           sample_obs,
-          ignore_vent):
-    np.random.seed(seed)
+          ignore_vent,
+          observation=binomial_observation,
+          burn_in=0,
+          n_days=300,
+          reservoir_size=4000,
+          adaptive=False,
+          target_accept=.234,
+          checkpoint=None,
+          checkpoint_every=500,
+          thin=1,
+          project=True,
+          store_dir=None,
+          delayed_acceptance=False,
+          start=None):
+    """
+    Metropolis chain over the prior quantiles.
+    Only every `thin`-th iteration after `burn_in` is kept, in a SampleStore.
+    Full `n_days` projections (arr, s, e, i, r) are computed for kept
+    iterations, once per accepted state (not at all without `project`).
+    Kept projections are also pushed into TrajectoryReservoirs, returned
+    in `df.attrs["bands"]`: "arr" and "seir" (s, e, i, r from the offset).
+    They keep a uniform subsample of at most `reservoir_size` projections,
+    or all of them (exact bands) with reservoir_size=None.
+    With a `store_dir`, kept iterations are also streamed there by a
+    ChainWriter, every `checkpoint_every` iterations.
+    With `adaptive`, proposals come from an AdaptiveProposal that learns its
+    covariance during burn-in and is frozen afterwards; otherwise `jumper`
+    with the jump_sd heuristics. Acceptance rate and sampling time after
+    burn-in are returned in `df.attrs["sampler"]`.
+    If `checkpoint` is a file name, the complete chain state is written there
+    every `checkpoint_every` iterations, and a chain that finds an existing
+    checkpoint continues from it, with output identical to an uninterrupted run.
+    With `delayed_acceptance`, a QuadraticEmulator of the posterior is fit to
+    the burn-in evaluations. After burn-in, proposals are first screened by
+    the emulator, and only those that pass pay for the full posterior, whose
+    second-stage test divides the emulator back out so the chain still
+    targets the full posterior. The fraction of full evaluations saved after
+    burn-in is returned in `df.attrs["sampler"]["full_evals_saved"]`.
+    The emulator needs a burn-in of at least 2 * QuadraticEmulator.n_coef
+    iterations (272 for 15 free parameters); with a shorter one no proposal
+    is screened. Not available with `sample_obs`.
+    `start` is the starting vector of quantiles (e.g. from `last_states`);
+    its nan entries, and all of them without a `start`, are drawn uniformly.
+    """
+    assert not (delayed_acceptance and sample_obs), \
+        "delayed acceptance needs a fixed likelihood, not sample_obs"
+    # every random number of the chain comes from this generator
+    rng = np.random.default_rng(seed)
+    if sample_obs:
+        # the observation noise accumulates in `obs`; keep it private to the chain
+        obs = obs.copy()
+    # the reservoirs get their own stream so they never perturb the chain
+    bands_rng = np.random.default_rng(rng.bit_generator.seed_seq.spawn(1)[0])
+    bands = dict(arr=TrajectoryReservoir(reservoir_size, bands_rng),
+                 seir=TrajectoryReservoir(reservoir_size, bands_rng))
+    params = ParamSchema(params)
     if shrinkage is not None:
         assert (shrinkage < 1) and (shrinkage >= 0.05)
         sq1 = shrinkage / 2
         sq2 = 1 - shrinkage / 2
         shrinkage = beta_from_q(sq1, sq2)
-        shrink_mask= np.array([1 if "" in i else 0 for i in params.param])
-    current_pos = eval_pos(
-        pos = np.random.uniform(size=params.shape[0]),
-        params = params,
-        obs = obs, 
-        shrinkage=shrinkage,
-        shrink_mask = shrink_mask,
-        holdout=holdout,
-        sample_obs=sample_obs,
-        forecast_priors = forecast_priors,
-        ignore_vent = ignore_vent
-    )
-    outdicts = []
-    U = np.random.uniform(0, 1, n_iters)
+        shrink_mask= np.array([1 if "" in i else 0 for i in params.names])
+    state = load_checkpoint(checkpoint)
+    if state is None:
+        pos = rng.uniform(size=params.size)
+        if start is not None:
+            pos = np.where(np.isnan(start), pos, start)
+        current_pos = eval_pos(
+            pos = pos,
+            params = params,
+            obs = obs, 
+            shrinkage=shrinkage,
+            shrink_mask = shrink_mask,
+            holdout=holdout,
+            sample_obs=sample_obs,
+            forecast_priors = forecast_priors,
+            ignore_vent = ignore_vent,
+            rng = rng,
+            observation = observation
+        )
+    store = SampleStore(params, n_kept(n_iters, burn_in, thin), test_loss=holdout > 0)
+    writer = None if store_dir is None else ChainWriter(store_dir)
+    U = rng.uniform(0, 1, n_iters)
+    # second-stage uniforms of delayed acceptance
+    U2 = rng.uniform(0, 1, n_iters) if delayed_acceptance else None
     posterior_history = []
     jump_sd = .2 # this is the starting value
-    for ii in range(n_iters):
+    proposal = AdaptiveProposal(params.free, jump_sd, target_accept) if adaptive else None
+    # constant parameters do not change the posterior: leave them out of the emulator
+    emulator = QuadraticEmulator(params.free) if delayed_acceptance else None
+    n_accepted = 0
+    n_screened = 0
+    start_iter = 0
+    t_start = time.time()
+    if state is not None:
+        start_iter = state["next_iter"]
+        current_pos = state["current_pos"]
+        store = state["store"]
+        store.grow(n_kept(n_iters, burn_in, thin))
+        if writer is not None:
+            # drop whatever was streamed after the checkpoint
+            writer.truncate(store.n, len(store.trajectories))
+        U = state["U"]
+        U2 = state["U2"]
+        posterior_history = state["posterior_history"]
+        jump_sd = state["jump_sd"]
+        proposal = state["proposal"]
+        emulator = state["emulator"]
+        n_accepted = state["n_accepted"]
+        n_screened = state["n_screened"]
+        bands = state["bands"]
+        obs = state["obs"]
+        rng.bit_generator.state = state["rng"]
+        t_start = time.time() - state["seconds"]
+        if len(U) < n_iters:
+            # the chain is being extended past its original length
+            U = np.concatenate([U, rng.uniform(0, 1, n_iters - len(U))])
+            if delayed_acceptance:
+                U2 = np.concatenate([U2, rng.uniform(0, 1, n_iters - len(U2))])
+    # recorded if the very first proposal fails
+    proposed_pos = current_pos
+    for ii in range(start_iter, n_iters):
+        if ii == burn_in + 1:
+            if proposal is not None:
+                proposal.freeze()
+            if emulator is not None:
+                emulator.freeze()
+            n_accepted = 0
+            n_screened = 0
+            t_start = time.time()
+        accept_prob = 0.0
         try:
-            proposed_pos = eval_pos(
-                jumper(current_pos["pos"], jump_sd),
-                params,
-                obs,
-                shrinkage=shrinkage,
-                shrink_mask = shrink_mask,
-                holdout=holdout,
-                sample_obs=sample_obs,
-                forecast_priors = forecast_priors,
-                ignore_vent = ignore_vent
-            )
-            p_accept = np.exp(proposed_pos["posterior"] - current_pos["posterior"])
-            if U[ii] < p_accept:
-                current_pos = proposed_pos
+            if proposal is not None:
+                proposed = proposal.propose(current_pos["pos"], rng)
+            else:
+                proposed = jumper(current_pos["pos"], jump_sd, rng)
+            delayed = emulator is not None and emulator.ready
+            if delayed:
+                # first stage: the emulated posterior
+                screen = emulator(proposed) - emulator(current_pos["pos"])
+            # acceptance tests in log space: exp() of a large emulated gap overflows
+            if delayed and not np.log(U[ii]) < screen:
+                # rejected without a full evaluation; record the current posterior
+                n_screened += 1
+                proposed_pos = current_pos
+            else:
+                proposed_pos = eval_pos(
+                    proposed,
+                    params,
+                    obs,
+                    shrinkage=shrinkage,
+                    shrink_mask = shrink_mask,
+                    holdout=holdout,
+                    sample_obs=sample_obs,
+                    forecast_priors = forecast_priors,
+                    ignore_vent = ignore_vent,
+                    rng = rng,
+                    observation = observation
+                )
+                log_ratio = proposed_pos["posterior"] - current_pos["posterior"]
+                if delayed:
+                    # second stage: divide out the emulator, so the full posterior is exact
+                    log_ratio = log_ratio - screen
+                    accepted = np.log(U2[ii]) < log_ratio
+                else:
+                    accepted = np.log(U[ii]) < log_ratio
+                    if emulator is not None:
+                        emulator.update(proposed, proposed_pos["posterior"])
+                accept_prob = np.nan_to_num(np.exp(np.minimum(log_ratio, 0.0)))
+                if accepted:
+                    current_pos = proposed_pos
+                    n_accepted += 1
 
         except Exception as e:
             print(e)
-        # append the relevant results
-        out = {
-            current_pos["draw"]["parms"].param[i]: current_pos["draw"]["parms"].val[i]
-            for i in range(params.shape[0])
-        }
-        # out.update({"arr": current_pos["draw"]["arr"]})
-        out.update({"arr": current_pos["draw"]["arr_stoch"]})
-        out.update({"iter": ii})
-        out.update({"chain": seed})
-        out.update({"posterior": proposed_pos["posterior"]})
-        out.update({"offset": current_pos["draw"]["offset"]})
-        out.update({"s": current_pos['draw']['s']})
-        out.update({"e": current_pos['draw']['e']})
-        out.update({"i": current_pos['draw']['i']})
-        out.update({"r": current_pos['draw']['r']})
-        if holdout > 0:
-            out.update({"test_loss": current_pos["test_loss"]})
-        outdicts.append(out)
+        if proposal is not None:
+            proposal.update(current_pos["pos"], accept_prob)
+        # keep the relevant results
+        if ii > burn_in and (ii - burn_in - 1) % thin == 0:
+            if project and "state" not in current_pos:
+                projection = SIR_from_params(
+                    current_pos["draw"]["parms"], observation=observation, rng=rng,
+                    n_days=n_days
+                )
+                # out = {"arr": projection["arr"]}
+                current_pos["state"] = store.add_state(
+                    projection["arr_stoch"], *[projection[k] for k in "seir"])
+                off = projection["offset"]
+                current_pos["seir"] = np.stack(
+                    [projection[k][off:off + n_days + 1] for k in "seir"], axis=1)
+            if project:
+                bands["arr"].push(store.trajectories[current_pos["state"]]["arr"])
+                bands["seir"].push(current_pos["seir"])
+            store.append(current_pos["draw"]["parms"].val,
+                         iter=ii,
+                         chain=seed,
+                         posterior=proposed_pos["posterior"],
+                         offset=current_pos["draw"]["offset"],
+                         state=current_pos.get("state", -1),
+                         test_loss=current_pos.get("test_loss"))
         posterior_history.append(current_pos['posterior'])
-        if (ii%100 == 0) and (ii>200):
+        if (proposal is None) and (ii%100 == 0) and (ii>200):
             # diagnose:
             always_rejecting = len(list(set(posterior_history[-99:])))<10
             if (ii>2000) and (ii%1000 == 0):
@@ -240,15 +425,493 @@ def chain(seed, params, obs, n_iters, shrinkage, holdout,
                 flat = False
             if always_rejecting or flat:
                 jump_sd *= .9
-        # TODO: write down itermediate chains in case of a crash... also re-read if we restart. Good for debugging purposes.
-    return pd.DataFrame(outdicts)
+        if (ii + 1) % checkpoint_every == 0 or ii + 1 == n_iters:
+            if writer is not None:
+                writer.flush(store)
+        if checkpoint is not None and ((ii + 1) % checkpoint_every == 0 or ii + 1 == n_iters):
+            save_checkpoint(checkpoint, dict(
+                next_iter=ii + 1,
+                current_pos=current_pos,
+                store=store,
+                U=U,
+                U2=U2,
+                posterior_history=posterior_history,
+                jump_sd=jump_sd,
+                proposal=proposal,
+                emulator=emulator,
+                n_accepted=n_accepted,
+                n_screened=n_screened,
+                bands=bands,
+                obs=obs,
+                rng=rng.bit_generator.state,
+                seconds=time.time() - t_start,
+            ))
+    df = store.frame()
+    df.attrs["bands"] = bands
+    n_retained = n_iters - burn_in - 1
+    df.attrs["sampler"] = dict(
+        chain=seed,
+        seconds=time.time() - t_start,
+        accept_rate=n_accepted / n_retained if n_retained > 0 else np.nan,
+    )
+    if delayed_acceptance:
+        df.attrs["sampler"]["full_evals_saved"] = \
+            n_screened / n_retained if n_retained > 0 else np.nan
+    return df
+
+
+def ensemble_chain(seed, params, obs, n_iters, shrinkage, holdout,
+                   forecast_priors,
+                   sample_obs,
+                   ignore_vent,
+                   observation=binomial_observation,
+                   burn_in=0,
+                   n_days=300,
+                   reservoir_size=4000,
+                   n_walkers=None,
+                   stretch=2.0,
+                   checkpoint=None,
+                   checkpoint_every=500,
+                   thin=1,
+                   store_dir=None,
+                   start=None):
+    """
+    Affine-invariant ensemble sampler (Goodman & Weare 2010 stretch moves)
+    over the probit of the prior quantiles, targeting the same posterior as
+    chain(). All walkers advance together: each half of the ensemble is
+    moved against the other with one batched eval_pos call.
+    Returns a frame like chain(), with one "chain" per walker.
+    Thinning, checkpointing and streaming to `store_dir` work as in chain().
+    The rows of `start` are the starting quantiles of the first walkers, the
+    remaining walkers start as in chain().
+    """
+    rng = np.random.default_rng(seed)
+    if sample_obs:
+        # the observation noise accumulates in `obs`; keep it private to the chain
+        obs = obs.copy()
+    bands_rng = np.random.default_rng(rng.bit_generator.seed_seq.spawn(1)[0])
+    bands = dict(arr=TrajectoryReservoir(reservoir_size, bands_rng),
+                 seir=TrajectoryReservoir(reservoir_size, bands_rng))
+    params = ParamSchema(params)
+    free = params.free
+    if n_walkers is None:
+        n_walkers = 2 * len(free) + 2
+    n_walkers += n_walkers % 2
+    shrink_mask = np.ones(params.size)
+    if shrinkage is not None:
+        assert (shrinkage < 1) and (shrinkage >= 0.05)
+        shrinkage = beta_from_q(shrinkage / 2, 1 - shrinkage / 2)
+
+    def evaluate(pos):
+        with np.errstate(all="ignore"):
+            out = eval_pos(pos, params, obs, shrinkage=shrinkage,
+                           shrink_mask=shrink_mask, holdout=holdout,
+                           sample_obs=sample_obs, forecast_priors=forecast_priors,
+                           ignore_vent=ignore_vent, rng=rng,
+                           observation=observation)
+        # failed simulations are never accepted
+        out["posterior"] = np.where(np.isnan(out["posterior"]), -np.inf,
+                                    out["posterior"])
+        return out
+
+    state = load_checkpoint(checkpoint)
+    if state is None:
+        pos = rng.uniform(size=(n_walkers, params.size))
+        if start is not None:
+            start = np.atleast_2d(start)[:n_walkers]
+            pos[:len(start)] = np.where(np.isnan(start), pos[:len(start)], start)
+        current = evaluate(pos)
+        posterior = current["posterior"]
+        vals = current["draw"]["parms"].val.copy()
+        offset = np.atleast_1d(current["draw"]["offset"]).copy()
+        test_loss = current.get("test_loss")
+        proposed_posterior = posterior.copy()
+    halves = [np.arange(0, n_walkers, 2), np.arange(1, n_walkers, 2)]
+    # per walker: store index and offset-aligned s, e, i, r of its projection
+    projections = [None] * n_walkers
+    store = SampleStore(params, n_kept(n_iters, burn_in, thin) * n_walkers,
+                        test_loss=holdout > 0)
+    writer = None if store_dir is None else ChainWriter(store_dir)
+    n_accepted = 0
+    start_iter = 0
+    t_start = time.time()
+    if state is not None:
+        start_iter = state["next_iter"]
+        pos, posterior, proposed_posterior = state["pos"], state["posterior"], state["proposed_posterior"]
+        vals, offset, test_loss = state["vals"], state["offset"], state["test_loss"]
+        projections, store = state["projections"], state["store"]
+        store.grow(n_kept(n_iters, burn_in, thin) * n_walkers)
+        if writer is not None:
+            writer.truncate(store.n, len(store.trajectories))
+        n_accepted = state["n_accepted"]
+        bands = state["bands"]
+        obs = state["obs"]
+        rng.bit_generator.state = state["rng"]
+        t_start = time.time() - state["seconds"]
+    for ii in range(start_iter, n_iters):
+        if ii == burn_in + 1:
+            n_accepted = 0
+            t_start = time.time()
+        for k, half in enumerate(halves):
+            other = halves[1 - k]
+            partner = rng.choice(other, len(half))
+            z = ((stretch - 1) * rng.uniform(size=len(half)) + 1) ** 2 / stretch
+            x = sps.norm.ppf(pos[half][:, free])
+            y = sps.norm.ppf(pos[partner][:, free])
+            new = pos[half].copy()
+            new[:, free] = sps.norm.cdf(y + z[:, None] * (x - y))
+            prop = evaluate(new)
+            log_ratio = (len(free) - 1) * np.log(z) + prop["posterior"] - posterior[half]
+            accept = np.log(rng.uniform(size=len(half))) < log_ratio
+            proposed_posterior[half] = prop["posterior"]
+            idx = half[accept]
+            pos[idx] = new[accept]
+            posterior[idx] = prop["posterior"][accept]
+            vals[idx] = prop["draw"]["parms"].val[accept]
+            offset[idx] = prop["draw"]["offset"][accept]
+            if holdout > 0:
+                test_loss[idx] = prop["test_loss"][accept]
+            for j in idx:
+                projections[j] = None
+            n_accepted += accept.sum()
+        if ii > burn_in and (ii - burn_in - 1) % thin == 0:
+            # project the walkers that moved, in one batch
+            stale = [j for j in range(n_walkers) if projections[j] is None]
+            if stale:
+                proj = SIR_from_params(ParamVector(params, vals[stale]),
+                                       observation=observation, rng=rng,
+                                       n_days=n_days)
+                for m, j in enumerate(stale):
+                    off = proj["offset"][m]
+                    seir = [proj[k][m][:off + n_days + 1] for k in "seir"]
+                    projections[j] = dict(
+                        state=store.add_state(proj["arr_stoch"][m], *seir),
+                        seir=np.stack([x[off:] for x in seir], axis=1),
+                    )
+            for j, p in enumerate(projections):
+                bands["arr"].push(store.trajectories[p["state"]]["arr"])
+                bands["seir"].push(p["seir"])
+                store.append(vals[j],
+                             iter=ii,
+                             chain=j,
+                             posterior=proposed_posterior[j],
+                             offset=offset[j],
+                             state=p["state"],
+                             test_loss=None if test_loss is None else test_loss[j])
+        if (ii + 1) % checkpoint_every == 0 or ii + 1 == n_iters:
+            if writer is not None:
+                writer.flush(store)
+        if checkpoint is not None and ((ii + 1) % checkpoint_every == 0 or ii + 1 == n_iters):
+            save_checkpoint(checkpoint, dict(
+                next_iter=ii + 1,
+                pos=pos,
+                posterior=posterior,
+                proposed_posterior=proposed_posterior,
+                vals=vals,
+                offset=offset,
+                test_loss=test_loss,
+                projections=projections,
+                store=store,
+                n_accepted=n_accepted,
+                bands=bands,
+                obs=obs,
+                rng=rng.bit_generator.state,
+                seconds=time.time() - t_start,
+            ))
+    df = store.frame()
+    df.attrs["bands"] = bands
+    n_retained = (n_iters - burn_in - 1) * n_walkers
+    df.attrs["sampler"] = [dict(
+        chain="ensemble",
+        seconds=time.time() - t_start,
+        accept_rate=n_accepted / n_retained if n_retained > 0 else np.nan,
+    )]
+    return df
+
+
+def tempered_log_ratio(prop_lp, prop_ll, lp, ll, betas):
+    """
+    Log acceptance ratios of the tempered replicas' proposals. Failed states
+    have -inf log densities: a replica stuck in one moves to any proposal
+    that evaluates, and never to one that fails, instead of getting a nan.
+    """
+    stuck = np.isneginf(lp) | np.isneginf(ll)
+    failed = np.isneginf(prop_lp) | np.isneginf(prop_ll)
+    with np.errstate(invalid="ignore"):
+        log_ratio = prop_lp - lp + betas * (prop_ll - ll)
+    log_ratio = np.where(stuck, np.inf, log_ratio)
+    return np.where(failed, -np.inf, log_ratio)
+
+
+def tempered_chain(seed, params, obs, n_iters, shrinkage, holdout,
+                   forecast_priors,
+                   sample_obs,
+                   ignore_vent,
+                   observation=binomial_observation,
+                   burn_in=0,
+                   n_days=300,
+                   reservoir_size=4000,
+                   n_temps=8,
+                   max_temp=50.0,
+                   swap_every=1,
+                   target_accept=.234,
+                   checkpoint=None,
+                   checkpoint_every=500,
+                   thin=1,
+                   store_dir=None,
+                   start=None):
+    """
+    Parallel tempering (replica exchange) over the probit of the prior
+    quantiles. `n_temps` replicas target logprior + loglik / T, with the
+    temperatures T geometric from 1 to `max_temp`; all replicas take a
+    random-walk step together with one batched eval_pos call, and every
+    `swap_every` iterations adjacent replicas propose to swap states,
+    alternating the even and the odd pairs. Each replica's step size is tuned
+    towards `target_accept` during burn-in.
+    Only the T=1 replica is kept, in a frame like chain()'s; thinning,
+    checkpointing and streaming to `store_dir` work as in chain().
+    `df.attrs["sampler"]` also holds the temperatures, the swap acceptance
+    rate of every adjacent pair and the likelihood evaluations, after burn-in.
+    With a `start` (as in chain()), every replica starts from it.
+    """
+    rng = np.random.default_rng(seed)
+    if sample_obs:
+        # the observation noise accumulates in `obs`; keep it private to the chain
+        obs = obs.copy()
+    bands_rng = np.random.default_rng(rng.bit_generator.seed_seq.spawn(1)[0])
+    bands = dict(arr=TrajectoryReservoir(reservoir_size, bands_rng),
+                 seir=TrajectoryReservoir(reservoir_size, bands_rng))
+    params = ParamSchema(params)
+    free = params.free
+    temps = max_temp ** (np.arange(n_temps) / max(n_temps - 1, 1))
+    betas = 1 / temps
+    shrink_mask = np.ones(params.size)
+    if shrinkage is not None:
+        assert (shrinkage < 1) and (shrinkage >= 0.05)
+        shrinkage = beta_from_q(shrinkage / 2, 1 - shrinkage / 2)
+
+    def evaluate(pos):
+        with np.errstate(all="ignore"):
+            out = eval_pos(pos, params, obs, shrinkage=shrinkage,
+                           shrink_mask=shrink_mask, holdout=holdout,
+                           sample_obs=sample_obs, forecast_priors=forecast_priors,
+                           ignore_vent=ignore_vent, rng=rng,
+                           observation=observation)
+        # failed simulations are never accepted
+        failed = np.isnan(out["posterior"])
+        out["loglik"] = np.where(failed, -np.inf, out["loglik"])
+        out["logprior"] = np.where(failed, -np.inf, out["logprior"])
+        return out
+
+    state = load_checkpoint(checkpoint)
+    if state is None:
+        pos = rng.uniform(size=(n_temps, params.size))
+        if start is not None:
+            pos = np.where(np.isnan(start), pos, start)
+        current = evaluate(pos)
+        ll, lp = current["loglik"], current["logprior"]
+        vals = current["draw"]["parms"].val.copy()
+        offset = np.atleast_1d(current["draw"]["offset"]).copy()
+        test_loss = current.get("test_loss")
+    log_scales = np.log(.2) + np.log(temps) / 2
+    # store index and offset-aligned s, e, i, r of the T=1 replica's projection
+    projection = None
+    store = SampleStore(params, n_kept(n_iters, burn_in, thin), test_loss=holdout > 0)
+    writer = None if store_dir is None else ChainWriter(store_dir)
+    n_accepted = np.zeros(n_temps)
+    swaps_proposed = np.zeros(n_temps - 1)
+    swaps_accepted = np.zeros(n_temps - 1)
+    start_iter = 0
+    t_start = time.time()
+    if state is not None:
+        start_iter = state["next_iter"]
+        pos, ll, lp = state["pos"], state["ll"], state["lp"]
+        vals, offset, test_loss = state["vals"], state["offset"], state["test_loss"]
+        log_scales = state["log_scales"]
+        projection, store = state["projection"], state["store"]
+        store.grow(n_kept(n_iters, burn_in, thin))
+        if writer is not None:
+            writer.truncate(store.n, len(store.trajectories))
+        n_accepted = state["n_accepted"]
+        swaps_proposed, swaps_accepted = state["swaps_proposed"], state["swaps_accepted"]
+        bands = state["bands"]
+        obs = state["obs"]
+        rng.bit_generator.state = state["rng"]
+        t_start = time.time() - state["seconds"]
+    for ii in range(start_iter, n_iters):
+        if ii == burn_in + 1:
+            n_accepted[:] = 0
+            swaps_proposed[:] = 0
+            swaps_accepted[:] = 0
+            t_start = time.time()
+        # every replica takes a step
+        new = pos.copy()
+        new[:, free] = sps.norm.cdf(
+            sps.norm.ppf(pos[:, free])
+            + np.exp(log_scales)[:, None] * rng.normal(size=(n_temps, len(free))))
+        prop = evaluate(new)
+        log_ratio = tempered_log_ratio(prop["logprior"], prop["loglik"], lp, ll, betas)
+        accept = np.log(rng.uniform(size=n_temps)) < log_ratio
+        if ii <= burn_in:
+            accept_prob = np.exp(np.minimum(log_ratio, 0.0))
+            log_scales += (ii + 1) ** -0.6 * (accept_prob - target_accept)
+        pos[accept] = new[accept]
+        ll[accept] = prop["loglik"][accept]
+        lp[accept] = prop["logprior"][accept]
+        vals[accept] = prop["draw"]["parms"].val[accept]
+        offset[accept] = prop["draw"]["offset"][accept]
+        if holdout > 0:
+            test_loss[accept] = prop["test_loss"][accept]
+        n_accepted += accept
+        cold_moved = accept[0]
+        # swap adjacent replicas, the even pairs and the odd pairs in turn
+        if (ii + 1) % swap_every == 0:
+            for k in range((ii // swap_every) % 2, n_temps - 1, 2):
+                if np.isneginf(ll[k + 1]):
+                    # nothing to gain from a failed state, also when both failed
+                    log_swap = -np.inf
+                else:
+                    log_swap = (betas[k] - betas[k + 1]) * (ll[k + 1] - ll[k])
+                swaps_proposed[k] += 1
+                if np.log(rng.uniform()) < log_swap:
+                    swaps_accepted[k] += 1
+                    pair = [k, k + 1]
+                    swapped = pair[::-1]
+                    pos[pair], ll[pair], lp[pair] = pos[swapped], ll[swapped], lp[swapped]
+                    vals[pair], offset[pair] = vals[swapped], offset[swapped]
+                    if holdout > 0:
+                        test_loss[pair] = test_loss[swapped]
+                    cold_moved = cold_moved or k == 0
+        if cold_moved:
+            projection = None
+        if ii > burn_in and (ii - burn_in - 1) % thin == 0:
+            if projection is None:
+                proj = SIR_from_params(ParamVector(params, vals[0]), observation=observation,
+                                       rng=rng, n_days=n_days)
+                off = proj["offset"]
+                projection = dict(
+                    state=store.add_state(proj["arr_stoch"], *[proj[k] for k in "seir"]),
+                    seir=np.stack([proj[k][off:off + n_days + 1] for k in "seir"], axis=1),
+                )
+            bands["arr"].push(store.trajectories[projection["state"]]["arr"])
+            bands["seir"].push(projection["seir"])
+            store.append(vals[0],
+                         iter=ii,
+                         chain=seed,
+                         posterior=prop["loglik"][0] + prop["logprior"][0],
+                         offset=offset[0],
+                         state=projection["state"],
+                         test_loss=None if test_loss is None else test_loss[0])
+        if (ii + 1) % checkpoint_every == 0 or ii + 1 == n_iters:
+            if writer is not None:
+                writer.flush(store)
+        if checkpoint is not None and ((ii + 1) % checkpoint_every == 0 or ii + 1 == n_iters):
+            save_checkpoint(checkpoint, dict(
+                next_iter=ii + 1,
+                pos=pos,
+                ll=ll,
+                lp=lp,
+                vals=vals,
+                offset=offset,
+                test_loss=test_loss,
+                log_scales=log_scales,
+                projection=projection,
+                store=store,
+                n_accepted=n_accepted,
+                swaps_proposed=swaps_proposed,
+                swaps_accepted=swaps_accepted,
+                bands=bands,
+                obs=obs,
+                rng=rng.bit_generator.state,
+                seconds=time.time() - t_start,
+            ))
+    df = store.frame()
+    df.attrs["bands"] = bands
+    n_retained = n_iters - burn_in - 1
+    with np.errstate(invalid="ignore"):
+        swap_rates = swaps_accepted / swaps_proposed
+    df.attrs["sampler"] = dict(
+        chain=seed,
+        seconds=time.time() - t_start,
+        accept_rate=n_accepted[0] / n_retained if n_retained > 0 else np.nan,
+        temperatures=temps,
+        swap_rates=swap_rates,
+        evaluations=n_temps * max(n_retained, 0),
+    )
+    return df
 
 
 def get_test_loss(n_iters, seed, holdout, shrinkage, params, obs, 
-                  forecast_priors, ignore_vent):
+                  forecast_priors, ignore_vent, burn_in=0, checkpoint=None):
+    # test losses of the post-burn-in iterations; no projections needed
     return chain(n_iters = n_iters, seed = seed, params=params, 
                  obs=obs, shrinkage=shrinkage, holdout=holdout,
-                 forecast_priors = forecast_priors, ignore_vent = ignore_vent)["test_loss"]
+                 forecast_priors = forecast_priors, sample_obs = False,
+                 ignore_vent = ignore_vent, burn_in = burn_in,
+                 project = False, checkpoint = checkpoint)["test_loss"]
+
+
+def successive_halving(pen_vec, n_iters, n_chains, holdout, params, obs,
+                       forecast_priors, ignore_vent, burn_in=0, eta=2,
+                       executor=None):
+    """
+    Successive halving over the shrinkage penalties `pen_vec`. Every penalty
+    starts with `n_chains` short get_test_loss chains; after each round only
+    the best 1/eta penalties (by mean test loss) continue, resuming their
+    chains from checkpoints with eta times the iterations, until the last
+    one has run `n_iters`. Test losses are compared after a warm-up of
+    min(burn_in, half the iterations).
+    The chains run on the `executor` (a RunExecutor), or in-process.
+    Returns {penalty: test losses of its last round} and the total number of
+    iterations run over all chains.
+    """
+    n_rounds = int(np.ceil(np.log(len(pen_vec)) / np.log(eta))) + 1
+    checkpoint_dir = mkdtemp()
+    survivors = list(pen_vec)
+    losses = {}
+    iters_run = {}
+    for k in range(n_rounds):
+        budget = max(int(n_iters / eta ** (n_rounds - 1 - k)), 2)
+        tuples_for_starmap = [(budget, i, holdout, j, params, obs, forecast_priors,
+                               ignore_vent, 0, path.join(checkpoint_dir, f"{j}_{i}.pkl"))
+                              for i in range(n_chains) for j in survivors]
+        if executor is not None:
+            results = executor.starmap(get_test_loss, tuples_for_starmap)
+        else:
+            results = [get_test_loss(*x) for x in tuples_for_starmap]
+        warm_up = min(burn_in, budget // 2)
+        for j in survivors:
+            losses[j] = []
+            iters_run[j] = budget
+        for x, test_loss in zip(tuples_for_starmap, results):
+            losses[x[3]] += test_loss.tolist()[warm_up:]
+        print(f"penalty search, {budget} iterations: " + ", ".join(
+            f"{j:.2f}: {np.mean(losses[j]):.4g}" for j in survivors))
+        survivors = sorted(survivors, key=lambda j: np.mean(losses[j]))
+        survivors = survivors[:int(np.ceil(len(survivors) / eta))]
+    shutil.rmtree(checkpoint_dir)
+    return losses, n_chains * sum(iters_run.values())
+
+
+def last_states(prev_dir, params):
+    """
+    Starting quantiles for an update run: the last retained state of every
+    chain of the run in `prev_dir`, one row per chain, from its chain store
+    (output/chains) or else its output/chains.json.bz2. The values are mapped
+    back to quantiles with the prior cdf of the current `params`; parameters
+    the previous run did not have start at their base value, constants are nan.
+    """
+    outdir = path.join(prev_dir, "output")
+    schema = ParamSchema(params)
+    if path.isdir(path.join(outdir, "chains")):
+        df = read_chains(path.join(outdir, "chains"),
+                         columns=["iter", "chain"] + schema.scalar_names)
+    else:
+        df = pd.read_json(path.join(outdir, "chains.json.bz2"), orient="records",
+                          lines=True)
+    last = df.sort_values("iter").groupby("chain").tail(1).sort_values("chain")
+    # keep off the edges, where the probit of the proposals diverges
+    return np.clip(schema.quantiles(schema.vectors(last)), 1e-6, 1 - 1e-6)
 
 
 def do_chains(n_iters, 
@@ -260,21 +923,180 @@ def do_chains(n_iters,
               n_chains, 
               forecast_priors, 
               parallel,
-              ignore_vent):
-    tuples_for_starmap = [(i, params, obs, n_iters, best_penalty, holdout, \
-                           forecast_priors, sample_obs, ignore_vent) \
-                          for i in range(n_chains)]
-    # get the final answer based on the best penalty
-    if parallel:
-        pool = mp.Pool(mp.cpu_count())
-        chains = pool.starmap(chain, tuples_for_starmap)
-        pool.close()
-    else:
-        chains = map(lambda x: chain(*x), tuples_for_starmap)
-    df = pd.concat(chains, ignore_index=True)
+              ignore_vent,
+              observation=binomial_observation,
+              burn_in=0,
+              n_days=300,
+              reservoir_size=4000,
+              adaptive=False,
+              target_accept=.234,
+              sampler="metropolis",
+              n_walkers=None,
+              checkpoint_dir=None,
+              checkpoint_every=500,
+              rhat_target=None,
+              ess_target=None,
+              max_iters=None,
+              thin=1,
+              store_dir=None,
+              delayed_acceptance=False,
+              n_temps=8,
+              max_temp=50.0,
+              swap_every=1,
+              executor=None,
+              init=None):
+    """
+    Run the chains (or the walker ensemble) for `n_iters` iterations.
+    With sampler="tempering", every chain is a tempered_chain ladder of
+    `n_temps` replicas up to `max_temp`, swapping every `swap_every` iterations.
+    Parallel chains run on the `executor` (a RunExecutor) if one is given.
+    With an `rhat_target` and/or `ess_target`, the chains then keep being
+    extended by `n_iters` iterations per round, from their checkpoints, until
+    every sampled parameter and the day-7 hosp census forecast reach
+    split-R-hat <= rhat_target and bulk/tail ESS >= ess_target, or
+    `max_iters` (default 4 * n_iters) is reached. The last round's
+    diagnostics are returned in `df.attrs["convergence"]`.
+    With a `store_dir`, every chain streams its kept iterations to its own
+    subdirectory there (see ChainWriter and read_chains).
+    `delayed_acceptance` applies to the Metropolis chains only (see chain).
+    `init` holds starting quantiles, one row per chain (see last_states): chain
+    i starts from row i (cycling), the ensemble's walkers from the rows.
+    Checkpoints are written to `checkpoint_dir` only if one is given (or to a
+    temporary directory between rounds), and deleted once the chains are done.
+    """
+    assert not (delayed_acceptance and sampler != "metropolis"), \
+        "delayed acceptance is only implemented for the Metropolis chains"
+    rounds = rhat_target is not None or ess_target is not None
+    temporary = rounds and checkpoint_dir is None
+    if temporary:
+        checkpoint_dir = mkdtemp()
+    max_iters = max_iters or 4 * n_iters
+    checkpoints = set()
+
+    def checkpoint(name):
+        if checkpoint_dir is None:
+            return None
+        checkpoints.add(path.join(checkpoint_dir, name))
+        return path.join(checkpoint_dir, name)
+
+    def chain_store(name):
+        return None if store_dir is None else path.join(store_dir, name)
+
+    def start(i):
+        return None if init is None else init[i % len(init)]
+
+    def run(total_iters):
+        if sampler == "ensemble":
+            # one process advances every walker; the batched simulations do the work
+            return ensemble_chain(0, params, obs, total_iters, best_penalty, holdout,
+                                  forecast_priors, sample_obs, ignore_vent,
+                                  observation, burn_in, n_days, reservoir_size,
+                                  n_walkers, checkpoint=checkpoint("ensemble.pkl"),
+                                  checkpoint_every=checkpoint_every, thin=thin,
+                                  store_dir=chain_store("ensemble"), start=init)
+        if sampler == "tempering":
+            # one ladder per process; its replicas are evaluated as a batch
+            target = tempered_chain
+            tuples_for_starmap = [(i, params, obs, total_iters, best_penalty, holdout,
+                                   forecast_priors, sample_obs, ignore_vent, observation,
+                                   burn_in, n_days, reservoir_size, n_temps, max_temp,
+                                   swap_every, target_accept, checkpoint(f"tempering_{i}.pkl"),
+                                   checkpoint_every, thin, chain_store(f"chain_{i}"),
+                                   start(i))
+                                  for i in range(n_chains)]
+        else:
+            target = chain
+            tuples_for_starmap = [(i, params, obs, total_iters, best_penalty, holdout, \
+                                   forecast_priors, sample_obs, ignore_vent, observation,
+                                   burn_in, n_days, reservoir_size, adaptive, target_accept,
+                                   checkpoint(f"chain_{i}.pkl"), checkpoint_every, thin,
+                                   True, chain_store(f"chain_{i}"), delayed_acceptance,
+                                   start(i)) \
+                                  for i in range(n_chains)]
+        # get the final answer based on the best penalty
+        if parallel and executor is not None:
+            chains = executor.starmap(target, tuples_for_starmap)
+        elif parallel:
+            pool = mp.Pool(mp.cpu_count())
+            chains = pool.starmap(target, tuples_for_starmap)
+            pool.close()
+        else:
+            chains = [target(*x) for x in tuples_for_starmap]
+        df = pd.concat(chains, ignore_index=True)
+        # pool the per-chain trajectory reservoirs
+        df.attrs["bands"] = {
+            k: reduce(lambda a, b: a.merge(b), [c.attrs["bands"][k] for c in chains])
+            for k in chains[0].attrs["bands"]
+        }
+        df.attrs["sampler"] = [c.attrs["sampler"] for c in chains]
+        return df
+
+    total_iters = n_iters
+    df = run(total_iters)
+    if rounds:
+        forecast_day = obs.shape[0] + 7 if obs.shape[0] + 7 <= n_days else None
+        while True:
+            diagnostics = sampler_diagnostics(df, params, burn_in, forecast_day)
+            converged = bool(
+                (rhat_target is None or (diagnostics.rhat <= rhat_target).all())
+                and (ess_target is None or (
+                    (diagnostics.ess_bulk >= ess_target).all()
+                    and (diagnostics.ess_tail >= ess_target).all()))
+            )
+            print(f"{total_iters} iterations: max R-hat {diagnostics.rhat.max():.3f}, "
+                  f"min bulk ESS {diagnostics.ess_bulk.min():.1f}, "
+                  f"min tail ESS {diagnostics.ess_tail.min():.1f}")
+            if converged or total_iters >= max_iters:
+                break
+            total_iters = min(total_iters + n_iters, max_iters)
+            df = run(total_iters)
+        df.attrs["convergence"] = dict(converged=converged, n_iters=total_iters,
+                                       diagnostics=diagnostics)
+    # the chains are done: their checkpoints are no longer needed
+    if temporary:
+        shutil.rmtree(checkpoint_dir)
+    for name in checkpoints:
+        if path.exists(name):
+            remove(name)
     return df
 
 
+def sampler_diagnostics(df, params, burn_in, forecast_day=None):
+    """
+    Split-R-hat, bulk/tail ESS and plain ESS of every sampled parameter over
+    the retained iterations, with ESS per second of (summed) chain sampling
+    time. With a `forecast_day`, the hosp census on that day of the
+    projections is included as "hosp_census_day_7".
+    """
+    schema = ParamSchema(params)
+    retained = df.loc[df.iter > burn_in]
+    seconds = sum(s["seconds"] for s in df.attrs["sampler"])
+    quantities = {schema.names[i]: retained[schema.names[i]] for i in schema.free}
+    if forecast_day is not None:
+        quantities["hosp_census_day_7"] = retained.arr.apply(lambda a: a[forecast_day, 3])
+    rows = []
+    for name, values in quantities.items():
+        draws = pd.DataFrame(dict(iter=retained.iter, chain=retained.chain, v=values.values)) \
+            .pivot(index="iter", columns="chain", values="v").values.T
+        ess = effective_sample_size(draws)
+        rows.append(dict(param=name, **convergence_diagnostics(draws),
+                         ess=ess, ess_per_sec=ess / seconds))
+    return pd.DataFrame(rows)
+
+
+def swap_diagnostics(df):
+    """
+    Swap acceptance rate of every adjacent pair of temperatures, per
+    tempered chain, from `df.attrs["sampler"]`
+    """
+    rows = []
+    for s in df.attrs["sampler"]:
+        for k, rate in enumerate(s["swap_rates"]):
+            rows.append(dict(chain=s["chain"], temp_lo=s["temperatures"][k],
+                             temp_hi=s["temperatures"][k + 1], swap_rate=rate))
+    return pd.DataFrame(rows)
+
+
 
 def main():
     # if __name__ == "__main__":
@@ -326,6 +1148,12 @@ def main():
         action="store_true",
         help="fit the penalty based on the last week of data",
     )
+    p.add(
+        "--penalty_search",
+        choices=["grid", "halving"],
+        help="with --fit_penalty: full-length chains for every penalty, or successive halving",
+        default="grid",
+    )
     p.add(
         "--penalty",
         help="penalty factor used for shrinkage (0.05 - 1)",
@@ -383,7 +1211,7 @@ def main():
     p.add(
         "--reopen_day",
         type=int,
-        help="day at which to commence evaluating the reopen function",
+        help="day at which to commence evaluating the reopen function; the reopening scenarios start on this day and end before 2/3 of the projection (none by default)",
         default = 8675309
     )
     p.add(
@@ -413,13 +1241,122 @@ def main():
     p.add(
         "--save_chains",
         action="store_true",
-        help="store the chains?  It'll make it take longer, as there is a lot of info in them.",
+        help="stream the chains to output/chains while sampling (read back with read_chains)",
     )
     p.add(
         "--ignore_vent",
         action="store_true",
         help="don't fit to vent, multiply the likelihood by zero",
     )
+    p.add(
+        "--horizon",
+        type=int,
+        help="days to project past the end of the census series (default: 300 days from the first observation)",
+    )
+    p.add(
+        "--adaptive",
+        action="store_true",
+        help="adaptive-covariance Metropolis: learn the proposal during burn-in",
+    )
+    p.add(
+        "--target_accept",
+        type=float,
+        help="acceptance rate targeted by the adaptive proposal",
+        default=0.234,
+    )
+    p.add(
+        "--delayed_acceptance",
+        action="store_true",
+        help="after burn-in, screen proposals with a quadratic emulator of the posterior before the full evaluation (metropolis sampler, not with --sample_obs); needs a burn-in of at least (d + 1)(d + 2) iterations for d sampled parameters",
+    )
+    p.add(
+        "--sampler",
+        choices=["metropolis", "ensemble", "tempering"],
+        help="independent Metropolis chains, one ensemble of stretch-move walkers, or parallel-tempering chains",
+        default="metropolis",
+    )
+    p.add(
+        "--n_walkers",
+        type=int,
+        help="walkers of the ensemble sampler (default: 2 per sampled parameter, plus 2)",
+    )
+    p.add(
+        "--n_temps",
+        type=int,
+        help="replicas per parallel-tempering chain",
+        default=8,
+    )
+    p.add(
+        "--max_temp",
+        type=float,
+        help="temperature of the hottest parallel-tempering replica",
+        default=50.0,
+    )
+    p.add(
+        "--swap_every",
+        type=int,
+        help="iterations between replica swap proposals",
+        default=1,
+    )
+    p.add(
+        "--resume",
+        type=DirectoryType(),
+        help="output directory of an interrupted run: continue its chains from their checkpoints (rerun with the same options)",
+    )
+    p.add(
+        "--update",
+        type=DirectoryType(),
+        help="output directory of the previous run: start the chains from its last retained states (needs its chains: --save_chains or chains.json.bz2)",
+    )
+    p.add(
+        "--update_burn_in",
+        type=int,
+        help="burn-in of an --update run, replaces --burn_in",
+        default=200,
+    )
+    p.add(
+        "--checkpoint_every",
+        type=int,
+        help="checkpoint the chains every this many iterations, so that an interrupted run can be resumed (off by default; 500 with --resume)",
+    )
+    p.add(
+        "--rhat_target",
+        type=float,
+        help="keep extending the chains until split-R-hat is at most this (e.g. 1.01)",
+    )
+    p.add(
+        "--ess_target",
+        type=float,
+        help="keep extending the chains until bulk and tail ESS are at least this",
+    )
+    p.add(
+        "--max_iters",
+        type=int,
+        help="cap on iterations per chain when extending towards the targets (default 4 * n_iters)",
+    )
+    p.add(
+        "--thin",
+        type=int,
+        help="keep every thin-th post-burn-in iteration",
+        default=1,
+    )
+    p.add(
+        "--reservoir_size",
+        type=int,
+        help="cap on the posterior trajectories kept for the quantile bands, per chain and after pooling the chains; beyond it the bands are approximate",
+        default=4000,
+    )
+    p.add(
+        "--exact_bands",
+        action="store_true",
+        help="keep every posterior trajectory for exact quantile bands, ignoring --reservoir_size; needs memory for all of them",
+    )
+    p.add(
+        "--observation_model",
+        choices=sorted(OBSERVATION_MODELS),
+        help="stochastic observation stage used for the projections",
+        default="binomial",
+    )
 
     options = p.parse_args()
         
@@ -441,13 +1378,17 @@ def main():
     save_chains = options.save_chains
     ignore_vent = options.ignore_vent
     plot_all = options.plot_all
+    observation = OBSERVATION_MODELS[options.observation_model]
 
     if flexible_beta:
         print("doing flexible beta")
     else:
         print('doing logistic')
         
-    dir = get_dir_name(options)
+    if options.resume:
+        dir = options.resume
+    else:
+        dir = get_dir_name(options)
     print(dir)
 
     census_ts, params = get_inputs(options)
@@ -459,17 +1400,26 @@ def main():
         
     if not fit_penalty:
         assert penalty >= 0.05 and penalty < 1
+    if options.delayed_acceptance:
+        assert not sample_obs, "--delayed_acceptance does not work with --sample_obs"
+        assert options.sampler == "metropolis", "--delayed_acceptance needs the metropolis sampler"
 
     outdir = path.join(dir, "output")
-    makedirs(outdir)
+    makedirs(outdir, exist_ok=True)
     figdir = path.join(dir, "figures")
-    makedirs(figdir)
+    makedirs(figdir, exist_ok=True)
     paramdir = path.join(dir, "parameters")
-    makedirs(paramdir)
+    makedirs(paramdir, exist_ok=True)
+    # checkpointing is opt-in
+    checkpoint_dir = None
+    if options.checkpoint_every or options.resume:
+        checkpoint_dir = path.join(dir, "checkpoints")
+        makedirs(checkpoint_dir, exist_ok=True)
 
     write_inputs(options, paramdir, census_ts, params, prefix)
 ## start here when debug
     nobs = census_ts.shape[0] - as_of_days_ago
+    sim_days = projection_days(census_ts.shape[0], options.horizon)
 
     # expand out the spline terms and append them to params
     # also add the number of observations, as i'll need this for evaluating the knots
@@ -492,8 +1442,7 @@ def main():
         # create the design matrix in order to compute the scaling factors
         # this is critical to make the prior on design matrix flexibility invariant to the scaling of the features
         beta_k = int(params.loc[params.param == "beta_spline_dimension", 'base'])
-        knots = np.linspace(0, nobs-nobs/beta_k/2, beta_k)
-        X = np.stack([power_spline(day, knots, beta_spline_power, xtrim = nobs) for day in range(nobs)])
+        X = spline_design_matrix(nobs, beta_k, beta_spline_power, nobs)
         Xmu = np.mean(X, axis = 0)
         Xsig = np.std(X, axis = 0)
         Xscale = pd.DataFrame(dict(param = ['Xmu', 'Xsig'], 
@@ -541,121 +1490,190 @@ def main():
         plt.title("week-long rolling variance")
         fig.savefig(path.join(f"{figdir}", f"observation_variance.pdf"))
 
-    if fit_penalty:
-        pen_vec = np.linspace(0.05, 0.5, 10)
-        tuples_for_starmap = [(n_iters, i, 7, j, params, census_ts, forecast_priors) \
-                              for i in range(n_chains) for j in pen_vec]
-        pool = mp.Pool(mp.cpu_count())
-        shrinkage_chains = pool.starmap(get_test_loss, tuples_for_starmap)
-        pool.close()
-        # put together the mp results
-        chain_dict = {i: [] for i in pen_vec}
-        for i in range(len(tuples_for_starmap)):
-            chain_dict[tuples_for_starmap[i][3]] += shrinkage_chains[i][
-                burn_in:
-            ].tolist()  # get the penalty value
-
-        mean_test_loss = [np.mean(np.array(chain_dict[i])) for i in pen_vec]
-        if plot_all:
-            fig = plt.figure()
-            plt.plot(pen_vec, mean_test_loss)
-            plt.fill_between(
-                x=pen_vec,
-                y1=[float(np.quantile(chain_dict[i][1000:], [0.025])) for i in pen_vec],
-                y2=[float(np.quantile(chain_dict[i][1000:], [0.975])) for i in pen_vec],
-                alpha=0.3,
-                lw=2,
-                edgecolor="k",
-            )
-            plt.xlabel("penalty factor")
-            plt.ylabel("log10(test MSE)")
-            fig.savefig(path.join(f"{figdir}", f"shrinkage_grid_GOF.pdf"))
-        # identify the best penalty
-        best_penalty = pen_vec[np.argmin(mean_test_loss)]
-    elif penalty < 1:
-        best_penalty = penalty
-    # fit the actual chains
-    print("do_chains")
-    df = do_chains(n_iters = n_iters, 
-                   params = params, 
-                   obs = census_ts, 
-                   best_penalty = best_penalty, 
-                   sample_obs = sample_obs, 
-                   holdout = as_of_days_ago,
-                   n_chains = n_chains,
-                   forecast_priors = forecast_priors,
-                   parallel=True,
-                   ignore_vent = ignore_vent)
-    if save_chains:
-        df.to_json(path.join(f"{outdir}", "chains.json.bz2"), orient="records", lines=True)
-
-    # process the output    
-    burn_in_df = df.loc[(df.iter <= burn_in)]
-    df = df.loc[(df.iter > burn_in)]
+    init = None
+    if options.update:
+        init = last_states(options.update, params)
+        burn_in = options.update_burn_in
+        print(f"updating {options.update}: {len(init)} chains start from its last states, "
+              f"burn-in {burn_in}")
+    if options.delayed_acceptance:
+        min_burn_in = 2 * QuadraticEmulator(ParamSchema(params).free).n_coef
+        if burn_in < min_burn_in:
+            print(f"--delayed_acceptance needs a burn-in of at least {min_burn_in} to fit "
+                  f"its emulator; with {burn_in} every proposal is fully evaluated")
+
+    # one pool for every parallel phase; the inputs are shipped to its workers once
+    with RunExecutor(params=params, census_ts=census_ts) as executor:
+        if fit_penalty:
+            pen_vec = np.linspace(0.05, 0.5, 10)
+            if options.penalty_search == "halving":
+                chain_dict, total_iters = successive_halving(
+                    pen_vec, n_iters, n_chains, 7, params, census_ts, forecast_priors,
+                    ignore_vent, burn_in, executor=executor)
+                print(f"penalty search ran {total_iters} iterations "
+                      f"(the full grid: {n_chains * len(pen_vec) * n_iters})")
+                # the warm-up is already dropped
+                band_dict = chain_dict
+            else:
+                tuples_for_starmap = [(n_iters, i, 7, j, params, census_ts, forecast_priors, ignore_vent, burn_in) \
+                                      for i in range(n_chains) for j in pen_vec]
+                shrinkage_chains = executor.starmap(get_test_loss, tuples_for_starmap)
+                # put together the mp results
+                chain_dict = {i: [] for i in pen_vec}
+                for i in range(len(tuples_for_starmap)):
+                    chain_dict[tuples_for_starmap[i][3]] += shrinkage_chains[i].tolist()  # get the penalty value
+                band_dict = {i: chain_dict[i][1000:] for i in pen_vec}
+
+            mean_test_loss = [np.mean(np.array(chain_dict[i])) for i in pen_vec]
+            if plot_all:
+                fig = plt.figure()
+                plt.plot(pen_vec, mean_test_loss)
+                plt.fill_between(
+                    x=pen_vec,
+                    y1=[float(np.quantile(band_dict[i], [0.025])) for i in pen_vec],
+                    y2=[float(np.quantile(band_dict[i], [0.975])) for i in pen_vec],
+                    alpha=0.3,
+                    lw=2,
+                    edgecolor="k",
+                )
+                plt.xlabel("penalty factor")
+                plt.ylabel("log10(test MSE)")
+                fig.savefig(path.join(f"{figdir}", f"shrinkage_grid_GOF.pdf"))
+            # identify the best penalty
+            best_penalty = pen_vec[np.argmin(mean_test_loss)]
+        elif penalty < 1:
+            best_penalty = penalty
+        # fit the actual chains
+        print("do_chains")
+        df = do_chains(n_iters = n_iters, 
+                       params = params, 
+                       obs = census_ts, 
+                       best_penalty = best_penalty, 
+                       sample_obs = sample_obs, 
+                       holdout = as_of_days_ago,
+                       n_chains = n_chains,
+                       forecast_priors = forecast_priors,
+                       parallel=True,
+                       ignore_vent = ignore_vent,
+                       observation = observation,
+                       burn_in = burn_in,
+                       n_days = sim_days,
+                       reservoir_size = None if options.exact_bands else options.reservoir_size,
+                       adaptive = options.adaptive,
+                       target_accept = options.target_accept,
+                       sampler = options.sampler,
+                       n_walkers = options.n_walkers,
+                       checkpoint_dir = checkpoint_dir,
+                       checkpoint_every = options.checkpoint_every or 500,
+                       rhat_target = options.rhat_target,
+                       ess_target = options.ess_target,
+                       max_iters = options.max_iters,
+                       thin = options.thin,
+                       store_dir = path.join(outdir, "chains") if save_chains else None,
+                       delayed_acceptance = options.delayed_acceptance,
+                       n_temps = options.n_temps,
+                       max_temp = options.max_temp,
+                       swap_every = options.swap_every,
+                       executor = executor,
+                       init = init)
+        if checkpoint_dir is not None:
+            # do_chains removed the checkpoints of the finished chains
+            shutil.rmtree(checkpoint_dir)
+
+        # sampler efficiency and convergence
+        forecast_day = census_ts.shape[0] + 7 if census_ts.shape[0] + 7 <= sim_days else None
+        diagnostics = sampler_diagnostics(df, params, burn_in, forecast_day)
+        diagnostics.to_csv(path.join(f"{outdir}", "sampler_diagnostics.csv"), index=False)
+        accept = np.mean([s["accept_rate"] for s in df.attrs["sampler"]])
+        print(f"acceptance rate {accept:.3f}, max R-hat {diagnostics.rhat.max():.3f}, "
+              f"min bulk ESS {diagnostics.ess_bulk.min():.1f}, "
+              f"min tail ESS {diagnostics.ess_tail.min():.1f}, "
+              f"min ESS/sec {diagnostics.ess_per_sec.min():.3f}")
+        if options.delayed_acceptance:
+            saved = np.mean([s["full_evals_saved"] for s in df.attrs["sampler"]])
+            print(f"delayed acceptance saved {saved:.1%} of full posterior evaluations")
+        if options.sampler == "tempering":
+            swaps = swap_diagnostics(df)
+            swaps.to_csv(path.join(f"{outdir}", "swap_diagnostics.csv"), index=False)
+            evaluations = sum(s["evaluations"] for s in df.attrs["sampler"])
+            print(f"replica swap rates {swaps.swap_rate.min():.3f} to {swaps.swap_rate.max():.3f}, "
+                  f"{evaluations} likelihood evaluations after burn-in")
+        if "convergence" in df.attrs:
+            convergence = df.attrs["convergence"]
+            print(f"{'converged' if convergence['converged'] else 'NOT converged'} "
+                  f"after {convergence['n_iters']} iterations per chain")
+
+        # process the output: the chains only keep post-burn-in iterations
+        # quantile bands of the retained trajectories, accumulated by the chains
+        bands = df.attrs["bands"]
+        print(f"quantile bands: {bands['arr'].describe()}")
     
-    # do the SD plot
-    if plot_all:
-        print("do SD plot")
-        SD_plot(census_ts, params, df, figdir, prefix if prefix is not None else "")
+        # do the SD plot
+        if plot_all:
+            print("do SD plot")
+            SD_plot(census_ts, params, df, figdir, prefix if prefix is not None else "")
     
-    ## SEIR plot
-    if plot_all:
-        print("do SEIR plot")
-        SEIR_plot(df=df,
-                  first_day = census_ts[census_ts.columns[0]].values[0],
-                  howfar = 300,
-                  figdir = figdir,
-                  prefix = prefix if prefix is not None else "",
-                  as_of_days_ago = as_of_days_ago,
-                  census_ts = census_ts)
-
-    ## Rt plot
-    if plot_all:
-        print("do Rt plot")
-        Rt_plot(df=df,
-                  first_day = census_ts[census_ts.columns[0]].values[0],
-                  howfar = 300,
-                  figdir = figdir,
-                  prefix = prefix if prefix is not None else "",
-                  params = params,
-                  census_ts = census_ts)
-
-    # make predictive plot
-    n_days = [30, 90, 180]
-    if options.n_days:
-        n_days = options.n_days
-
-    first_day = census_ts[census_ts.columns[0]].values[0]
-    if plot_all:
-        print("do plt predictive")
-        for howfar in n_days:
-            plt_predictive(
-                df,
-                first_day,
-                census_ts,
-                figdir,
-                as_of_days_ago,
-                howfar=howfar,
-                prefix=prefix if prefix is not None else "",
-                y_max=y_max,
-                hosp_capacity=None,
-                vent_capacity=None,
-            )
+        ## SEIR plot
+        if plot_all:
+            print("do SEIR plot")
+            SEIR_plot(df=df,
+                      first_day = census_ts[census_ts.columns[0]].values[0],
+                      howfar = sim_days,
+                      figdir = figdir,
+                      prefix = prefix if prefix is not None else "",
+                      as_of_days_ago = as_of_days_ago,
+                      census_ts = census_ts,
+                      bands = bands)
 
-    # reopening
-    colors = ['blue', 'green', 'orange', 'red', 'yellow', 'cyan']
-    reopen_day_gap = math.ceil((300-reopen_day)/len(colors))
-    reopen_days = np.arange(reopen_day, 199, reopen_day_gap)
-    qmats = []    
-    for day in reopen_days:
-        pool = mp.Pool(mp.cpu_count())
-        reop = pool.starmap(reopen_wrapper, [(df.iloc[i], day, reopen_speed, reopen_cap) for i in range(df.shape[0])])
-        pool.close()
-        reop = np.stack(reop)
-        reopq = np.quantile(reop, [.05, .25, .5, .75, .95], axis = 0)
-        qmats.append(reopq)
-    dates = pd.date_range(f"{first_day}", periods=301, freq="d")
-    if plot_all:
+        ## Rt plot
+        if plot_all:
+            print("do Rt plot")
+            Rt_plot(df=df,
+                      first_day = census_ts[census_ts.columns[0]].values[0],
+                      howfar = sim_days,
+                      figdir = figdir,
+                      prefix = prefix if prefix is not None else "",
+                      params = params,
+                      census_ts = census_ts)
+
+        # make predictive plot
+        n_days = [30, 90, 180]
+        if options.n_days:
+            n_days = options.n_days
+        n_days = plot_horizons(n_days, options.horizon)
+
+        first_day = census_ts[census_ts.columns[0]].values[0]
+        if plot_all:
+            print("do plt predictive")
+            for howfar in n_days:
+                plt_predictive(
+                    df,
+                    first_day,
+                    census_ts,
+                    figdir,
+                    as_of_days_ago,
+                    howfar=howfar,
+                    prefix=prefix if prefix is not None else "",
+                    y_max=y_max,
+                    hosp_capacity=None,
+                    vent_capacity=None,
+                    bands=bands,
+                )
+
+        # reopening
+        colors = ['blue', 'green', 'orange', 'red', 'yellow', 'cyan']
+        reopen_days = reopening_days(reopen_day, sim_days, len(colors))
+        if len(reopen_days) > 0:
+            schema = ParamSchema(params)
+            qmats = reopening_scenarios(schema, schema.vectors(df),
+                                        [(day, reopen_speed, reopen_cap) for day in reopen_days],
+                                        observation=observation, n_days=sim_days,
+                                        executor=executor)
+        else:
+            print(f"no reopening scenarios: reopen_day {reopen_day} is not before "
+                  f"day {sim_days*2//3} of the projection")
+    dates = pd.date_range(f"{first_day}", periods=sim_days+1, freq="d")
+    if plot_all and len(reopen_days) > 0:
         print("do reopen plot")
         fig = plt.figure()
         for i in range(len(reopen_days)):
@@ -673,7 +1691,7 @@ def main():
         fig.savefig(path.join(f"{figdir}", f"{prefix}reopening_scenarios.pdf"))
 
     print("do projection tables")
-    mk_projection_tables(df, first_day, outdir, prefix)
+    mk_projection_tables(df, first_day, outdir, prefix, bands=bands)
 
     if plot_all:
         toplot = df[
@@ -7,7 +7,8 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 
-from _99_shared_functions import power_spline
+from _99_shared_functions import spline_design_matrix, TrajectoryReservoir, \
+    read_chains
 from utils import DirectoryType
 import warnings
 from datetime import datetime
@@ -17,6 +18,35 @@ def logistic(L, k, x0, x):
     return L / (1 + np.exp(-k * (x - x0)))
 
 
+def trajectory_bands(df, capacity=4000, seed=0):
+    """
+    Stream the trajectories stored in a chains frame into reservoirs, for
+    frames that come without the bands computed by the chains (e.g. read back
+    from chains.json.bz2). The reservoirs keep at most `capacity` of them, or
+    all of them (exact bands) with capacity=None.
+    """
+    rng = np.random.default_rng(seed)
+    bands = dict(arr=TrajectoryReservoir(capacity, rng),
+                 seir=TrajectoryReservoir(capacity, rng))
+    n_days = len(df.arr.iloc[0]) - 1
+    for row in df[["arr", "offset", "s", "e", "i", "r"]].itertuples(index=False):
+        bands["arr"].push(row.arr)
+        bands["seir"].push(np.stack(
+            [np.asarray(getattr(row, k))[row.offset:row.offset + n_days + 1] for k in "seir"],
+            axis=1))
+    return bands
+
+
+def plot_horizons(n_days, horizon=None):
+    """
+    Horizons of the predictive plots (days past the census series) that the
+    chains cover: those within the run's `horizon`, else the horizon itself.
+    """
+    if horizon is None:
+        return list(n_days)
+    return [h for h in n_days if h <= horizon] or [horizon]
+
+
 # plot of chains
 def plt_predictive(
     df,
@@ -29,13 +59,15 @@ def plt_predictive(
     prefix="",
     hosp_capacity=None,
     vent_capacity=None,
+    bands=None,
 ):
     # predictive plot
     file_howfar = howfar
-    arrs = np.stack([df.arr.iloc[i] for i in range(df.shape[0])])
-    arrq = np.quantile(arrs, axis=0, q=[0.025, 0.25, 0.5, 0.75, 0.975])
+    if bands is None:
+        bands = trajectory_bands(df)
+    arrq = bands["arr"].quantiles([0.025, 0.25, 0.5, 0.75, 0.975])
     howfar = len(census_ts.hosp) + howfar
-    howfar = np.min([howfar, arrs.shape[1]])
+    howfar = np.min([howfar, arrq.shape[1]])
 
     dates = pd.date_range(f"{first_day}", periods=howfar, freq="d")
     fig, ax = plt.subplots(figsize=(16, 10), ncols=2, nrows=2, sharex=True)
@@ -193,10 +225,11 @@ def plt_pairplot_posteriors(df, figdir, n=1000, prefix=""):
     grid.savefig(path.join(f"{figdir}", f"{prefix}posterior_pairplot.pdf"))
 
 
-def mk_projection_tables(df, first_day, outdir, facility_code=None):
+def mk_projection_tables(df, first_day, outdir, facility_code=None, bands=None):
     # predictive plot
-    arrs = np.stack([df.arr.iloc[i] for i in range(df.shape[0])])
-    arrq = np.quantile(arrs, axis=0, q=[0.05, 0.25, 0.5, 0.75, 0.95])
+    if bands is None:
+        bands = trajectory_bands(df)
+    arrq = bands["arr"].quantiles([0.05, 0.25, 0.5, 0.75, 0.95])
     column_postfix = ["5%", "25%", "Median", "75%", "%95"]
 
     summary_df_hsp = pd.DataFrame(
@@ -262,16 +295,13 @@ def SD_plot(census_ts, params, df, figdir, prefix = ""):
         nobs = census_ts.shape[0]
         beta_k = int(params.loc[params.param == 'beta_spline_dimension', 'base'])
         beta_spline_power = int(params.loc[params.param == 'beta_spline_power', 'base'])
-        knots = np.linspace(0, nobs-nobs/beta_k/2, beta_k) # this has to mirror the knot definition in the _99_helper functons
+        X = spline_design_matrix(nobs, beta_k, beta_spline_power, nobs)
         beta_spline_coefs = np.array(df[[i for i in df.columns if 'beta_spline_coef' in i]])        
         b0 = np.array(df.b0)
 
-        for day in range(nobs):
-            X = power_spline(day, knots, beta_spline_power, xtrim = nobs)
-            XB = X@beta_spline_coefs.T
-            sd = logistic(L = 1, k=1, x0 = 0, x=b0 + XB)
-            qlist.append(np.quantile(sd, [0.05,.25, 0.5, .75, 0.95]))
-            # plt.hist(sd)
+        # (nobs, n_samples): one row of sd draws per day
+        sd = logistic(L = 1, k=1, x0 = 0, x=b0 + X@beta_spline_coefs.T)
+        qlist.append(np.quantile(sd, [0.05,.25, 0.5, .75, 0.95], axis = 1).T)
     else:
         for day in range(census_ts.shape[0]):
             ldist = logistic(
@@ -306,13 +336,15 @@ def SD_plot(census_ts, params, df, figdir, prefix = ""):
     fig.savefig(path.join(f"{figdir}", f"{prefix}effective_soc_dist.pdf"))
 
 
-def SEIR_plot(df, first_day, howfar, figdir, prefix, census_ts, as_of_days_ago):
+def SEIR_plot(df, first_day, howfar, figdir, prefix, census_ts, as_of_days_ago,
+              bands=None):
     dates = pd.date_range(f"{first_day}", periods=howfar, freq="d")
     fig = plt.figure()
-    for letter in ['s', 'e', 'i', 'r']   : 
-        list_of_letter_values = [df[letter].iloc[j][df.offset.iloc[j]:] for j in range(len(df[letter]))]
-        L = np.stack(list_of_letter_values)
-        Lqs = np.quantile(L[:,:howfar], [.025, .05, .25, .5, .75, .95, .975], axis = 0)    /1000 
+    if bands is None:
+        bands = trajectory_bands(df)
+    seirq = bands["seir"].quantiles([.025, .05, .25, .5, .75, .95, .975])
+    for j, letter in enumerate(['s', 'e', 'i', 'r']):
+        Lqs = seirq[:, :howfar, j] / 1000
         plt.plot_date(dates, Lqs[3, :], "-", label = letter)
         plt.fill_between(x = dates,
                          y1 = Lqs[1, :],
@@ -331,36 +363,50 @@ def SEIR_plot(df, first_day, howfar, figdir, prefix, census_ts, as_of_days_ago):
 
     
 
-def Rt_plot(df, first_day, howfar, figdir, prefix, params, census_ts):
-    dates = pd.date_range(f"{first_day}", periods=howfar, freq="d")
-    fig = plt.figure()
+def Rt_quantiles(df, params, census_ts):
+    """
+    (nobs, 5) quantiles of R(t) over the draws in `df`, for every day of the
+    census series. Each draw is read from its own offset, i.e. day 0 is the
+    day of its first hospitalization.
+    """
     qlist = []
+    nobs = census_ts.shape[0]
+    region_pop = float(params.loc[params.param == "region_pop", 'base'])
+    offset = np.array(df.offset, dtype=int)
+    # (n_samples, nobs) susceptibles, from the offset of each draw
+    S = np.stack([np.asarray(x)[off:off + nobs] for x, off in zip(df['s'], offset)])
     if 'beta_spline_coef_0' in df.columns:
-        nobs = census_ts.shape[0]
         beta_k = int(params.loc[params.param == 'beta_spline_dimension', 'base'])
         beta_spline_power = int(params.loc[params.param == 'beta_spline_power', 'base'])
-        knots = np.linspace(0, nobs-nobs/beta_k/2, beta_k) # this has to mirror the knot definition in the _99_helper functons
+        # the simulations evaluate the splines on days since their start
+        X = spline_design_matrix(nobs, beta_k, beta_spline_power, nobs + offset.max())
         beta_spline_coefs = np.array(df[[i for i in df.columns if 'beta_spline_coef' in i]])        
         b0 = np.array(df.b0)
 
-        for day in range(nobs):
-            X = power_spline(day, knots, beta_spline_power, xtrim = nobs)
-            XB = X@beta_spline_coefs.T
-            sd = logistic(L = 1, k=1, x0 = 0, x=b0 + XB)
-            S = df['s'].apply(lambda x: x[df.offset.iloc[0]+day])
-            beta_t = (df.beta * (1-sd)) * ((S/float(params.loc[params.param == "region_pop", 'base']))**df.nu)*df.recovery_days
-            qlist.append(np.quantile(beta_t, [0.05,.25, 0.5, .75, 0.95]))
-            # plt.hist(sd)
+        # (nobs, n_samples): one row of draws per day
+        XB = np.take_along_axis(X @ beta_spline_coefs.T,
+                                offset[None, :] + np.arange(nobs)[:, None], axis=0)
+        sd = logistic(L = 1, k=1, x0 = 0, x=b0 + XB)
+        beta_t = (np.array(df.beta) * (1-sd)) \
+            * ((S.T/region_pop)**np.array(df.nu)) \
+            * np.array(df.recovery_days)
+        qlist.append(np.quantile(beta_t, [0.05,.25, 0.5, .75, 0.95], axis = 1).T)
     else:
         
-        for day in range(census_ts.shape[0]):
+        for day in range(nobs):
+            # as in the simulations: x0 and the day both count from their start
             sd = logistic(
-                df.logistic_L, df.logistic_k, df.logistic_x0 - df.offset.astype(int), day
+                df.logistic_L, df.logistic_k, df.logistic_x0 + offset, offset + day
             )
-            S = df['s'].apply(lambda x: x[df.offset.iloc[0]+day])
-            beta_t = (df.beta * (1-sd)) * ((S/float(params.loc[params.param == "region_pop", 'base']))**df.nu)*df.recovery_days
+            beta_t = (df.beta * (1-sd)) * ((S[:, day]/region_pop)**df.nu)*df.recovery_days
             qlist.append(np.quantile(beta_t, [0.05,.25, 0.5, .75, 0.95]))            
-    qmat = np.vstack(qlist)
+    return np.vstack(qlist)
+
+
+def Rt_plot(df, first_day, howfar, figdir, prefix, params, census_ts):
+    dates = pd.date_range(f"{first_day}", periods=howfar, freq="d")
+    fig = plt.figure()
+    qmat = Rt_quantiles(df, params, census_ts)
     fig = plt.figure()
     plt.plot(list(range(census_ts.shape[0])), qmat[:, 2])
     plt.fill_between(
@@ -433,6 +479,17 @@ def main():
         help="how much of the burn-in to discard",
         default = 2000
     )
+    p.add(
+        "--reservoir_size",
+        type=int,
+        help="cap on the posterior trajectories kept for the quantile bands; beyond it the bands are approximate",
+        default=4000,
+    )
+    p.add(
+        "--exact_bands",
+        action="store_true",
+        help="keep every posterior trajectory for exact quantile bands, ignoring --reservoir_size; needs memory for all of them",
+    )
 
     options = p.parse_args()
     burn_in = options.burn_in
@@ -456,6 +513,8 @@ def main():
     # TODO: This needs to be configurable based on the time period specificed
     as_of_days_ago = args["as_of"]
     nobs = census_ts.shape[0] - as_of_days_ago
+    # the chains only hold `horizon` days past the census series
+    n_days = plot_horizons(n_days, args.get("horizon"))
 
     # define capacity
     vent_capacity, hosp_capacity = None, None
@@ -467,10 +526,13 @@ def main():
 # census_ts = pd.read_csv('/Users/crandrew/projects/chime_sims/output/2020_05_08_20_38_34/parameters/census_ts.csv')
 # params = pd.read_csv('/Users/crandrew/projects/chime_sims/output/2020_05_08_20_38_34/parameters/params.csv')
 
-    # Chains
-    df = pd.read_json(
-        path.join(f"{outdir}", "chains.json.bz2"), orient="records", lines=True
-    )
+    # Chains: the binary chain store if there is one, else the older json dump
+    if path.isdir(path.join(outdir, "chains")):
+        df = read_chains(path.join(outdir, "chains"), iters=slice(burn_in + 1, None))
+    else:
+        df = pd.read_json(
+            path.join(f"{outdir}", "chains.json.bz2"), orient="records", lines=True
+        )
     print(f"READ chains file: {df.shape[0]} total iterations")
     # remove burn-in
     
@@ -479,6 +541,8 @@ def main():
     if iters_remaining < 1000:
         warnings.warn(f"You're only using {iters_remaining} iterations per chain.  This may not be fully cromulent.")
     df = df.loc[(df.iter > burn_in)]
+    bands = trajectory_bands(df, capacity=None if options.exact_bands else options.reservoir_size)
+    print(f"quantile bands: {bands['arr'].describe()}")
 
     # make the social distancing plot
     SD_plot(census_ts, params, df, figdir, prefix)
@@ -496,9 +560,10 @@ def main():
             y_max=options.y_max,
             hosp_capacity=hosp_capacity,
             vent_capacity=vent_capacity,
+            bands=bands,
         )
 
-    mk_projection_tables(df, first_day, outdir)
+    mk_projection_tables(df, first_day, outdir, bands=bands)
 
     toplot = df[
         [
@@ -1,10 +1,15 @@
-import re
+import json
 import os
+import math
+import multiprocessing as mp
+from functools import lru_cache
 
 import numpy as np
 import pandas as pd
 import scipy.stats as sps
 
+from bayes_chime.normal.utilities import exponential_census
+
 pd.options.display.max_rows = 4000
 pd.options.display.max_columns = 4000
 
@@ -39,17 +44,32 @@ def reopenfn(day, reopen_day=60, reopen_speed=0.1, reopen_cap = .5):
         return val
 
 
-def reopen_wrapper(dfi, day, speed, cap):
-    p_df = dfi.reset_index()   
-    p_df.columns = ['param', 'val']
-    ro = dict(param = ['reopen_day', 'reopen_speed', 'reopen_cap'],
-              val = [day, speed, cap])
-    p_df = pd.concat([p_df, pd.DataFrame(ro)])
-    p_df
-    SIR_ii = SIR_from_params(p_df)
+def reopenfn_batch(day, reopen_day, reopen_speed, reopen_cap):
+    """Array version of `reopenfn`: arguments broadcast against each other."""
+    since = np.maximum(day - reopen_day, 0)
+    val = np.maximum((1 - reopen_speed) ** since, 1 - reopen_cap)
+    return np.where(day < reopen_day, 1.0, val)
+
+
+def reopen_wrapper(p, day, speed, cap, observation=None, n_days=300):
+    """Stochastic hosp census of ParamVector `p` under a reopening scenario"""
+    SIR_ii = SIR_from_params(p, reopen_day=day, reopen_speed=speed, reopen_cap=cap,
+                             observation=observation or binomial_observation,
+                             n_days=n_days)
     return SIR_ii['arr_stoch'][:,3]
 
 
+def projection_days(n_census_days, horizon=None):
+    """
+    Number of days to simulate after the first hospitalization: the census
+    series plus `horizon` days of forecast.  Without a horizon, fall back to
+    the historical fixed 300 days.
+    """
+    if horizon is None:
+        return 300
+    return int(n_census_days + horizon)
+
+
 def scale(arr, mu, sig):
     if len(arr.shape)==1:
         arr = np.expand_dims(arr, 0)
@@ -58,7 +78,6 @@ def scale(arr, mu, sig):
     return arr
 
 
-import matplotlib.pyplot as plt
 # Run the SIR model forward in time
 def sim_sir(
     S,
@@ -84,35 +103,99 @@ def sim_sir(
     reopen_speed = 0.0,
     reopen_cap = 1.0,
 ):
-    N = S + E + I + R
-    s, e, i, r = [S], [E], [I], [R]
-    # reoplist, sdlist, betatlist = [],[] ,[]
     if len(beta_spline) > 0:
-        knots = np.linspace(0, nobs-nobs/beta_k/2, beta_k)
-    for day in range(n_days):
+        beta_spline = np.asarray(beta_spline, dtype=float)[None, :]
+    else:
+        beta_spline = None
+    sd = sd_schedule(
+        n_days=n_days,
+        logistic_L=logistic_L,
+        logistic_k=logistic_k,
+        logistic_x0=logistic_x0,
+        b0=b0,
+        beta_spline=beta_spline,
+        beta_k=beta_k,
+        beta_spline_power=beta_spline_power,
+        nobs=nobs,
+        reopen_day=reopen_day,
+        reopen_speed=reopen_speed,
+        reopen_cap=reopen_cap,
+    )
+    s, e, i, r = sim_sir_batch(S, E, I, R, alpha, beta, gamma, nu, sd)
+    return s[0], e[0], i[0], r[0]
+
+
+def sd_schedule(
+    n_days,
+    logistic_L=None,
+    logistic_k=None,
+    logistic_x0=None,
+    b0=None,
+    beta_spline=None,
+    beta_k=None,
+    beta_spline_power=None,
+    nobs=None,
+    reopen_day=8675309,
+    reopen_speed=0.0,
+    reopen_cap=1.0,
+):
+    """
+    Social distancing sd(t), shape (n_draws, n_days), for a batch of draws.
+    Scalar parameters broadcast against the (n_draws,) ones.
+    `beta_spline` is either None (logistic path) or an (n_draws, beta_k) matrix
+    """
+    day = np.arange(n_days)
+    if beta_spline is not None:
+        X = spline_design_matrix(nobs, beta_k, beta_spline_power, n_days)
+        XB = np.atleast_2d(beta_spline) @ X.T
+        sd = logistic(L = 1, k=1, x0 = 0, x=np.reshape(b0, (-1, 1)) + XB)
+    else:
+        sd = logistic(
+            np.reshape(logistic_L, (-1, 1)),
+            np.reshape(logistic_k, (-1, 1)),
+            np.reshape(logistic_x0, (-1, 1)),
+            x=day[None, :],
+        )
+    reop = reopenfn_batch(
+        day[None, :],
+        np.reshape(reopen_day, (-1, 1)),
+        np.reshape(reopen_speed, (-1, 1)),
+        np.reshape(reopen_cap, (-1, 1)),
+    )
+    return np.atleast_2d(sd * reop)
+
+
+def sim_sir_batch(S, E, I, R, alpha, beta, gamma, nu, sd):
+    """
+    Advance every draw of the SEIR model together.
+    S, E, I, R, alpha, beta, gamma and nu are scalars or arrays of shape (n_draws,);
+    sd is the (n_draws, n_days) social distancing schedule from `sd_schedule`.
+    Returns s, e, i, r, each of shape (n_draws, n_days+1)
+    """
+    sd = np.atleast_2d(sd)
+    n_draws, n_days = sd.shape
+    if n_draws == 1:
+        # a single draw is faster on python floats than on numpy arrays
+        S, E, I, R, alpha, gamma, nu = (
+            float(np.ravel(x)[0]) for x in (S, E, I, R, alpha, gamma, nu)
+        )
+        N = S + E + I + R
         y = S, E, I, R
-        # evaluate splines
-        if len(beta_spline) > 0:
-            X = power_spline(day, knots, beta_spline_power, xtrim = nobs)
-            # X = scale(X, Xmu, Xsig)
-            #scale to prevent overflows and make the penalties comparable across bases
-            XB = float(X@beta_spline)
-            sd = logistic(L = 1, k=1, x0 = 0, x= b0 + XB)
-        else:
-            sd = logistic(logistic_L, logistic_k, logistic_x0, x=day)
-        reop = reopenfn(day, reopen_day, reopen_speed, reopen_cap)
-        sd *= reop
-        beta_t = beta * (1 - sd)
-        S, E, I, R = sir(y, alpha, beta_t, gamma, nu, N)
-        s.append(S)
-        e.append(E)
-        i.append(I)
-        r.append(R)
-    s, e, i, r = np.array(s), np.array(e), np.array(i), np.array(r)
-    # plt.plot(sdlist)
-    # plt.plot(betatlist)
-    # plt.plot(reoplist)
-    return s, e, i, r
+        out = [y]
+        for beta_t in (np.ravel(beta)[0] * (1 - sd[0])).tolist():
+            y = sir(y, alpha, beta_t, gamma, nu, N)
+            out.append(y)
+        out = np.array(out).T[:, None, :]
+        return out[0], out[1], out[2], out[3]
+    # time-major storage so that each day is a contiguous slice
+    out = np.empty((n_days + 1, 4, n_draws))
+    out[0] = np.stack([np.broadcast_to(x, n_draws) for x in (S, E, I, R)])
+    N = out[0].sum(axis=0)
+    beta_t = np.reshape(beta, (-1, 1)) * (1 - sd)
+    alpha, gamma, nu = (np.reshape(x, -1) for x in (alpha, gamma, nu))
+    for day in range(n_days):
+        out[day + 1] = sir(out[day], alpha, beta_t[:, day], gamma, nu, N)
+    return out[:, 0].T, out[:, 1].T, out[:, 2].T, out[:, 3].T
 
 # beta = 3
 # sd = .9
@@ -139,113 +222,731 @@ Plan:
     beta_t = L/(1 + np.exp(XB))
 '''
 
+
+def spline_design_matrix(nobs, beta_k, beta_spline_power, n_days):
+    """
+    The (n_days, beta_k) matrix of `power_spline` rows for days 0..n_days-1.
+    It only depends on its arguments, so it is built once per run and cached.
+    The returned array is read-only.
+    """
+    return _spline_design_matrix(
+        float(nobs), int(beta_k), float(np.ravel(beta_spline_power)[0]), int(n_days)
+    )
+
+
+@lru_cache(maxsize=32)
+def _spline_design_matrix(nobs, beta_k, beta_spline_power, n_days):
+    knots = np.linspace(0, nobs-nobs/beta_k/2, beta_k)
+    X = np.stack(
+        [power_spline(day, knots, beta_spline_power, xtrim = nobs) for day in range(n_days)]
+    ).astype(float)
+    X.setflags(write=False)
+    return X
+
 def logistic(L, k, x0, x):
     exp_term = np.exp(-k * (x - x0))
     # Catch overflow and return nan instead of 0.0
+    if np.ndim(exp_term) > 0:
+        return np.where(np.isfinite(exp_term), L / (1 + exp_term), np.nan)
     if not np.isfinite(exp_term):
         return np.nan
     return L / (1 + exp_term)
 
 
+class ParamSchema:
+    """
+    Fixed layout of a parameter table: the parameter names with a name -> index
+    map, plus the columns of `params` needed to turn quantiles into values.
+    Built once per run, so that proposals are plain float64 vectors.
+    Constants whose `base` is an array (e.g. Xmu, Xsig) are kept in `arrays`
+    and hold nan in the float vector.
+    """
+
+    def __init__(self, params):
+        self.names = list(params.param)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.size = len(self.names)
+        self.distribution = np.array(params.distribution, dtype=object)
+        self.p1 = np.array(params.p1, dtype=float)
+        self.p2 = np.array(params.p2, dtype=float)
+        self.arrays = {}
+        self.base = np.full(self.size, np.nan)
+        for i, base in enumerate(params.base):
+            if np.ndim(base) > 0:
+                self.arrays[self.names[i]] = np.asarray(base)
+            else:
+                self.base[i] = base
+        self.scalar_names = [n for n in self.names if n not in self.arrays]
+        # this evaluates to an empty list if there are no splines in the params
+        self.spline_index = [
+            i for i, n in enumerate(self.names) if "beta_spline_coef" in n
+        ]
+        # parameters that are actually sampled
+        self.free = np.flatnonzero(self.distribution != "constant")
+        # the priors, grouped by family, as one frozen distribution per family
+        self.priors = []
+        for family in pd.unique(self.distribution):
+            if family == "constant":
+                continue
+            idx = np.flatnonzero(self.distribution == family)
+            p1, p2 = self.p1[idx], self.p2[idx]
+            if family == "gamma":
+                dist = sps.gamma(p1, 0, p2)
+            elif family == "beta":
+                dist = sps.beta(p1, p2)
+            elif family == "uniform":
+                dist = sps.uniform(p1, p1 + p2)
+            elif family == "norm":
+                dist = sps.norm(p1, p2)
+            else:
+                raise KeyError(
+                    "Distribution {distribution} not implemented.".format(
+                        distribution=family
+                    )
+                )
+            self.priors.append((idx, dist))
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def prior_transform(self, qvec):
+        """
+        Quantiles -> (values, log prior densities), one vectorized call per family.
+        qvec is either one vector of quantiles or an (n_proposals, size) matrix
+        """
+        qvec = np.asarray(qvec, dtype=float)
+        val = np.broadcast_to(self.base, qvec.shape).copy()
+        logprior = np.zeros(qvec.shape)
+        for idx, dist in self.priors:
+            val[..., idx] = dist.ppf(qvec[..., idx])
+            logprior[..., idx] = dist.logpdf(val[..., idx])
+        return val, logprior
+
+    def quantiles(self, vals):
+        """
+        Values -> quantiles under the prior, the inverse of prior_transform.
+        Constants get nan.
+        """
+        vals = np.asarray(vals, dtype=float)
+        qvec = np.full(vals.shape, np.nan)
+        for idx, dist in self.priors:
+            qvec[..., idx] = dist.cdf(vals[..., idx])
+        return qvec
+
+    def frame(self, vals):
+        """DataFrame with one column per scalar parameter and one row per vector"""
+        vals = np.atleast_2d(vals)
+        return pd.DataFrame(
+            vals[:, [self.index[n] for n in self.scalar_names]],
+            columns=self.scalar_names,
+        )
+
+    def vectors(self, df):
+        """Inverse of `frame`: the (n_rows, size) matrix of parameter values"""
+        vals = np.tile(self.base, (df.shape[0], 1))
+        for name in self.scalar_names:
+            if name in df.columns:
+                vals[:, self.index[name]] = df[name]
+        return vals
+
+
+class ParamVector:
+    """
+    Parameter values and their log prior densities, laid out according to a
+    ParamSchema. `val` is either one vector or an (n_draws, size) matrix
+    """
+
+    __slots__ = ("schema", "val", "logprior")
+
+    def __init__(self, schema, val, logprior=None):
+        self.schema = schema
+        self.val = val
+        self.logprior = logprior
+
+    def __getitem__(self, name):
+        if name in self.schema.arrays:
+            return self.schema.arrays[name]
+        return self.val[..., self.schema.index[name]]
+
+    def get(self, name, default=None):
+        return self[name] if name in self.schema else default
+
+    @classmethod
+    def from_frame(cls, p_df):
+        """From the old long format, i.e. a frame with `param` and `val` columns"""
+        schema = ParamSchema(
+            pd.DataFrame(dict(param=p_df.param, base=p_df.val, distribution="constant",
+                              p1=np.nan, p2=np.nan))
+        )
+        logprior = np.log(np.array(p_df.prob, dtype=float)) if "prob" in p_df else None
+        return cls(schema, schema.base.copy(), logprior)
+
+    def to_frame(self):
+        """Long format frame, as qdraw used to return"""
+        return pd.DataFrame(dict(param=self.schema.names, val=self.val, logprior=self.logprior))
+
+
+class TrajectoryReservoir:
+    """
+    Bounded uniform sample of equally-shaped trajectories (reservoir sampling),
+    for quantile bands over a posterior without stacking every draw.
+    Quantiles are exact as long as at most `capacity` trajectories were pushed.
+    capacity=None keeps every trajectory, for exact quantiles at the cost of
+    holding all of them.
+    """
+
+    def __init__(self, capacity=4000, rng=None):
+        self.capacity = capacity
+        self.rng = np.random.default_rng(rng)
+        self.n_seen = 0
+        self.samples = []
+
+    def __len__(self):
+        return self.n_seen
+
+    def push(self, x):
+        x = np.asarray(x, dtype=float)
+        if self.capacity is None or len(self.samples) < self.capacity:
+            self.samples.append(x)
+        else:
+            j = self.rng.integers(self.n_seen + 1)
+            if j < self.capacity:
+                self.samples[j] = x
+        self.n_seen += 1
+
+    def merge(self, other):
+        """Reservoir over everything pushed into `self` and `other`"""
+        out = TrajectoryReservoir(self.capacity, self.rng)
+        out.n_seen = self.n_seen + other.n_seen
+        if self.capacity is None or out.n_seen <= self.capacity:
+            out.samples = self.samples + other.samples
+            return out
+        # a uniform subsample of the union: how many come from each side is
+        # hypergeometric in the number of trajectories each has seen
+        k = out.rng.hypergeometric(self.n_seen, other.n_seen, self.capacity)
+        for res, m in [(self, k), (other, self.capacity - k)]:
+            keep = out.rng.choice(len(res.samples), m, replace=False)
+            out.samples += [res.samples[j] for j in keep]
+        return out
+
+    @property
+    def exact(self):
+        """Whether the quantiles are over every trajectory pushed"""
+        return len(self.samples) == self.n_seen
+
+    def describe(self):
+        """Which trajectories the quantiles are computed from, for the logs"""
+        if self.exact:
+            return f"exact, over all {self.n_seen} retained trajectories"
+        return (f"approximate, over a uniform subsample of {len(self.samples)} "
+                f"of {self.n_seen} retained trajectories")
+
+    def quantiles(self, q):
+        """(len(q), *trajectory shape) quantile bands"""
+        return np.quantile(np.stack(self.samples), q, axis=0)
+
+
+class SampleStore:
+    """
+    Compact storage of the kept MCMC iterations: a preallocated structured
+    array with one record per kept iteration (iter, chain, posterior, offset,
+    test_loss and the scalar parameters), and the trajectories (arr, s, e, i,
+    r) stored once per distinct accepted state, referenced from the records
+    by `state` index (-1 when there is no projection).
+    """
+
+    trajectory_names = ["arr", "s", "e", "i", "r"]
+
+    @staticmethod
+    def column_order(names):
+        """Frame column order: parameters, arr, iter, chain, posterior, offset, s..r, test_loss"""
+        fixed = ["arr", "iter", "chain", "posterior", "offset", "s", "e", "i", "r", "test_loss"]
+        params = [n for n in names if n not in fixed + ["state"]]
+        return params + [n for n in fixed if n in names]
+
+    def __init__(self, schema, n_rows, test_loss=False):
+        self.param_index = [schema.index[n] for n in schema.scalar_names]
+        fields = [("iter", "i8"), ("chain", "i8"), ("posterior", "f8"),
+                  ("offset", "i8"), ("state", "i8")]
+        if test_loss:
+            fields.append(("test_loss", "f8"))
+        fields += [(n, "f8") for n in schema.scalar_names]
+        self.records = np.zeros(n_rows, dtype=fields)
+        self.n = 0
+        self.trajectories = []
+
+    def __len__(self):
+        return self.n
+
+    def grow(self, n_rows):
+        """Make room for `n_rows` records in total"""
+        if n_rows > len(self.records):
+            extra = np.zeros(n_rows - len(self.records), dtype=self.records.dtype)
+            self.records = np.concatenate([self.records, extra])
+
+    def add_state(self, arr, s, e, i, r):
+        """Store the trajectories of a state; returns the index for `append`"""
+        self.trajectories.append(dict(arr=arr, s=s, e=e, i=i, r=r))
+        return len(self.trajectories) - 1
+
+    def append(self, vals, iter, chain, posterior, offset, state=-1, test_loss=None):
+        row = (iter, chain, posterior, offset, state)
+        if test_loss is not None:
+            row += (test_loss,)
+        self.records[self.n] = row + tuple(vals[self.param_index])
+        self.n += 1
+
+    def frame(self):
+        """The records as a frame, with trajectory columns referencing the stored states"""
+        records = self.records[: self.n]
+        df = pd.DataFrame({n: records[n] for n in records.dtype.names if n != "state"})
+        traj = [self.trajectories[j] if j >= 0 else {} for j in records["state"]]
+        for k in self.trajectory_names:
+            df[k] = [t.get(k) for t in traj]
+        return df[self.column_order(df.columns)]
+
+
+class ChainWriter:
+    """
+    Appendable on-disk columnar copy of a chain's SampleStore, written while
+    sampling. The directory holds
+        header.json   record dtype, trajectory shape and counts
+        records.bin   the raw structured records
+        arr.bin       one float32 (n_days + 1, 6) projection per state
+        seir.bin      one float32 (n_days + 1, 4) block per state: s, e, i, r
+                      from the offset on; the days before it are not kept
+    Read back with `read_chains`.
+    """
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        os.makedirs(dirname, exist_ok=True)
+        self.n_rows = 0
+        self.n_states = 0
+        self.n_days = None
+
+    def _path(self, name):
+        return os.path.join(self.dirname, name)
+
+    def truncate(self, n_rows, n_states):
+        """Drop anything written after `n_rows` records and `n_states` states"""
+        header = self._path("header.json")
+        if not os.path.exists(header):
+            return
+        with open(header) as f:
+            header = json.load(f)
+        self.n_days = header["n_days"]
+        itemsize = _dtype_from_json(header["dtype"]).itemsize
+        # float32 bytes per day of a state's trajectory
+        day_bytes = 0 if self.n_days is None else (self.n_days + 1) * 4
+        for name, size in [("records.bin", n_rows * itemsize),
+                           ("arr.bin", n_states * day_bytes * 6),
+                           ("seir.bin", n_states * day_bytes * 4)]:
+            if os.path.exists(self._path(name)):
+                os.truncate(self._path(name), size)
+        self.n_rows, self.n_states = n_rows, n_states
+
+    def flush(self, store):
+        """Append what `store` holds beyond what was written already"""
+        states = store.trajectories[self.n_states:]
+        if states and self.n_days is None:
+            self.n_days = states[0]["arr"].shape[0] - 1
+        with open(self._path("records.bin"), "ab") as f:
+            f.write(store.records[self.n_rows:store.n].tobytes())
+        with open(self._path("arr.bin"), "ab") as f:
+            for t in states:
+                f.write(np.asarray(t["arr"], dtype=np.float32).tobytes())
+        with open(self._path("seir.bin"), "ab") as f:
+            for t in states:
+                seir = np.stack([t[k][-(self.n_days + 1):] for k in "seir"], axis=1)
+                f.write(seir.astype(np.float32).tobytes())
+        self.n_rows, self.n_states = store.n, len(store.trajectories)
+        with open(self._path("header.json"), "w") as f:
+            json.dump(dict(dtype=store.records.dtype.descr, n_days=self.n_days,
+                           n_rows=self.n_rows, n_states=self.n_states), f)
+
+
+def _dtype_from_json(descr):
+    return np.dtype([tuple(field) for field in descr])
+
+
+def read_chains(dirname, columns=None, iters=None):
+    """
+    Chains frame from the ChainWriter directories under `dirname`, memory-mapped.
+    `columns` selects columns (default: all); `iters` selects iterations,
+    either a slice over iteration numbers or a list of them.
+    s, e, i and r are rebuilt from the stored offset-aligned blocks: the
+    simulation days before the offset (before the first hospitalization) are
+    not stored and read back as nan, from the offset on the values are the
+    chain's. A chain that kept no rows contributes none.
+    """
+    frames = []
+    for sub in sorted(os.listdir(dirname)):
+        header_file = os.path.join(dirname, sub, "header.json")
+        if not os.path.exists(header_file):
+            continue
+        with open(header_file) as f:
+            header = json.load(f)
+        dtype = _dtype_from_json(header["dtype"])
+        n_days, n_rows, n_states = header["n_days"], header["n_rows"], header["n_states"]
+        if n_rows == 0:
+            # an empty file cannot be memory-mapped
+            records = np.zeros(0, dtype=dtype)
+        else:
+            records = np.memmap(os.path.join(dirname, sub, "records.bin"), dtype=dtype,
+                                mode="r", shape=(n_rows,))
+        it = records["iter"]
+        if isinstance(iters, slice):
+            start = iters.start or 0
+            keep = (it >= start) & ((it - start) % (iters.step or 1) == 0)
+            if iters.stop is not None:
+                keep &= it < iters.stop
+        elif iters is not None:
+            keep = np.isin(it, iters)
+        else:
+            keep = np.ones(n_rows, dtype=bool)
+        records = records[keep]
+        wanted = columns or SampleStore.column_order(
+            list(dtype.names) + SampleStore.trajectory_names)
+        df = pd.DataFrame({n: np.asarray(records[n]) for n in wanted if n in dtype.names})
+        if any(k in wanted for k in SampleStore.trajectory_names) and n_states > 0:
+            state = records["state"]
+            if "arr" in wanted:
+                arr = np.memmap(os.path.join(dirname, sub, "arr.bin"), dtype=np.float32,
+                                mode="r", shape=(n_states, n_days + 1, 6))
+                df["arr"] = [arr[j] if j >= 0 else None for j in state]
+            if any(k in wanted for k in "seir"):
+                seir = np.memmap(os.path.join(dirname, sub, "seir.bin"), dtype=np.float32,
+                                 mode="r", shape=(n_states, n_days + 1, 4))
+                for m, k in enumerate("seir"):
+                    if k in wanted:
+                        df[k] = [np.concatenate([np.full(off, np.nan), seir[j, :, m]])
+                                 if j >= 0 else None
+                                 for j, off in zip(state, records["offset"])]
+        frames.append(df[[c for c in wanted if c in df.columns]])
+    return pd.concat(frames, ignore_index=True)
+
+
 def qdraw(qvec, p_df):
     """
     Function takes a vector of quantiles and returns marginals based on the parameters in the parameter data frame
     It returns a bunch of parameters for inputting into SIR
-    It'll also return their probability under the prior
+    It'll also return their log density under the prior
+    `p_df` is either the parameter data frame or, better, its ParamSchema, which
+    holds the compiled priors. `qvec` may also be an (n_proposals, n_params) matrix
     """
-    assert len(qvec) == p_df.shape[0]
-    outdicts = []
-    for i in range(len(qvec)):
-        if p_df.distribution.iloc[i] == "constant":
-            out = dict(param=p_df.param.iloc[i], val=p_df.base.iloc[i], prob=1)
-        else:
-            # Construct this differently for different distributoons
-            if p_df.distribution.iloc[i] == "gamma":
-                p = (qvec[i], p_df.p1.iloc[i], 0, p_df.p2.iloc[i])
-            elif p_df.distribution.iloc[i] == "beta":
-                p = (qvec[i], p_df.p1.iloc[i], p_df.p2.iloc[i])
-            elif p_df.distribution.iloc[i] == "uniform":
-                p = (qvec[i], p_df.p1.iloc[i], p_df.p1.iloc[i] + p_df.p2.iloc[i])
-            elif p_df.distribution.iloc[i] == "norm":
-                p = (qvec[i], p_df.p1.iloc[i], p_df.p2.iloc[i])
-            out = dict(
-                param=p_df.param.iloc[i],
-                val=getattr(sps, p_df.distribution.iloc[i]).ppf(*p),
-            )
-            # does scipy not have a function to get the density from the quantile?
-            p_pdf = (out["val"],) + p[1:]
-            out.update({"prob": getattr(sps, p_df.distribution.iloc[i]).pdf(*p_pdf)})
-        outdicts.append(out)
-    return pd.DataFrame(outdicts)
+    schema = p_df if isinstance(p_df, ParamSchema) else ParamSchema(p_df)
+    assert np.shape(qvec)[-1] == schema.size
+    val, logprior = schema.prior_transform(qvec)
+    return ParamVector(schema, val, logprior)
 
 
-def jumper(start, jump_sd):
+def jumper(start, jump_sd, rng=np.random):
     probit = sps.norm.ppf(start)
-    probit += np.random.normal(size=len(probit), scale=jump_sd)
+    probit += rng.normal(size=len(probit), scale=jump_sd)
     newq = sps.norm.cdf(probit)
     return newq
 
 
+class AdaptiveProposal:
+    """
+    Adaptive-Metropolis proposal in probit space: the proposal covariance is
+    learned from the chain's history (Haario et al. 2001), and a global scale
+    is tuned by Robbins-Monro towards `target_accept`.
+    Only the `free` coordinates move. Call `update` after every step while
+    adapting and `freeze` once burn-in is over, after which the proposal is
+    a fixed random walk.
+    Proposals are clipped to [`clip`, 1 - `clip`], so that saturated
+    quantiles never reach the covariance estimate as infinite probits.
+    Updates with a non-finite acceptance probability are skipped.
+    """
+
+    def __init__(self, free, jump_sd=.2, target_accept=.234, min_samples=None,
+                 eps=1e-4, clip=1e-10):
+        self.free = np.asarray(free)
+        d = len(self.free)
+        self.target_accept = target_accept
+        self.min_samples = 10 * d if min_samples is None else min_samples
+        self.eps = eps
+        self.clip = clip
+        self.log_scale = 0.0
+        self.chol = np.eye(d) * jump_sd
+        self.mean = np.zeros(d)
+        self.m2 = np.zeros((d, d))
+        self.n = 0
+        self.adapting = True
+
+    def propose(self, pos, rng):
+        probit = sps.norm.ppf(pos)
+        step = self.chol @ rng.normal(size=len(self.free))
+        probit[self.free] += np.exp(self.log_scale) * step
+        return np.clip(sps.norm.cdf(probit), self.clip, 1 - self.clip)
+
+    def update(self, pos, accept_prob):
+        """Add the current state to the covariance estimate and tune the scale"""
+        if not self.adapting:
+            return
+        z = sps.norm.ppf(np.clip(pos[self.free], self.clip, 1 - self.clip))
+        if not (np.isfinite(accept_prob) and np.isfinite(z).all()):
+            return
+        self.n += 1
+        delta = z - self.mean
+        self.mean += delta / self.n
+        self.m2 += np.outer(delta, z - self.mean)
+        self.log_scale += self.n ** -0.6 * (accept_prob - self.target_accept)
+        if self.n >= self.min_samples:
+            d = len(self.free)
+            cov = self.m2 / (self.n - 1) + self.eps * np.eye(d)
+            self.chol = np.linalg.cholesky(2.38 ** 2 / d * cov)
+
+    def freeze(self):
+        self.adapting = False
+
+
+class QuadraticEmulator:
+    """
+    Least-squares quadratic in probit space of the `free` coordinates, fit to
+    log posterior evaluations: a cheap surrogate posterior for delayed
+    acceptance. Call `update` with every evaluation while collecting and
+    `freeze` to make the fit, to the later half of the evaluations (those
+    after the chain has found its way in). The emulator is `ready` once it
+    has been fit to at least as many evaluations as it has coefficients,
+    `n_coef` = (d + 1)(d + 2) / 2 for d free coordinates: with one evaluation
+    per iteration, that takes a burn-in of at least 2 * n_coef iterations.
+    """
+
+    def __init__(self, free):
+        self.free = np.asarray(free)
+        self.upper = np.triu_indices(len(self.free))
+        self.X = []
+        self.y = []
+        self.coef = None
+
+    @property
+    def ready(self):
+        return self.coef is not None
+
+    @property
+    def n_coef(self):
+        return 1 + len(self.free) + len(self.upper[0])
+
+    def features(self, pos):
+        z = sps.norm.ppf(np.asarray(pos)[..., self.free])
+        quad = (z[..., :, None] * z[..., None, :])[..., self.upper[0], self.upper[1]]
+        return np.concatenate([np.ones(z.shape[:-1] + (1,)), z, quad], axis=-1)
+
+    def update(self, pos, posterior):
+        if self.ready or not np.isfinite(posterior):
+            return
+        self.X.append(self.features(pos))
+        self.y.append(posterior)
+
+    def freeze(self):
+        start = len(self.y) // 2
+        if len(self.y) - start >= self.n_coef:
+            X = np.array(self.X[start:])
+            self.coef = np.linalg.lstsq(X, np.array(self.y[start:]), rcond=None)[0]
+        self.X = []
+        self.y = []
+
+    def __call__(self, pos):
+        return self.features(pos) @ self.coef
+
+
+def effective_sample_size(draws):
+    """
+    Multi-chain effective sample size of an (n_chains, n_draws) array, from
+    FFT autocorrelations truncated with Geyer's initial monotone sequence.
+    """
+    draws = np.asarray(draws, dtype=float)
+    m, n = draws.shape
+    if n < 4:
+        return np.nan
+    centered = draws - draws.mean(axis=1, keepdims=True)
+    f = np.fft.rfft(centered, n=2 * n, axis=1)
+    acov = np.fft.irfft(f * np.conjugate(f), axis=1)[:, :n] / n
+    chain_var = acov[:, 0] * n / (n - 1)
+    W = chain_var.mean()
+    var_plus = W * (n - 1) / n
+    if m > 1:
+        var_plus += draws.mean(axis=1).var(ddof=1)
+    if not var_plus > 0:
+        return np.nan
+    rho = 1 - (W - acov.mean(axis=0)) / var_plus
+    rho[0] = 1
+    # sum of autocorrelation pairs while they stay positive, made monotone
+    pairs = rho[:-1:2] + rho[1::2]
+    stop = np.flatnonzero(pairs <= 0)
+    pairs = pairs[: stop[0] if len(stop) else len(pairs)]
+    pairs = np.minimum.accumulate(pairs)
+    tau = max(-1 + 2 * pairs.sum(), 1 / np.log10(m * n))
+    return m * n / tau
+
+
+def _split_chains(draws):
+    """(n_chains, n_draws) -> (2 * n_chains, n_draws // 2): first and second halves"""
+    draws = np.asarray(draws, dtype=float)
+    half = draws.shape[1] // 2
+    return np.concatenate([draws[:, :half], draws[:, -half:]])
+
+
+def _rank_normalize(draws):
+    ranks = sps.rankdata(draws, method="average").reshape(draws.shape)
+    return sps.norm.ppf((ranks - 3 / 8) / (draws.size + 1 / 4))
+
+
+def _rhat(draws):
+    m, n = draws.shape
+    W = draws.var(axis=1, ddof=1).mean()
+    B = n * draws.mean(axis=1).var(ddof=1)
+    return np.sqrt(((n - 1) / n * W + B / n) / W) if W > 0 else np.nan
+
+
+def convergence_diagnostics(draws):
+    """
+    Rank-normalized split-R-hat, bulk ESS and tail ESS (Vehtari et al. 2021)
+    of an (n_chains, n_draws) array.
+    """
+    split = _split_chains(draws)
+    if split.shape[1] < 4:
+        return dict(rhat=np.nan, ess_bulk=np.nan, ess_tail=np.nan)
+    folded = np.abs(split - np.median(split))
+    rhat = max(_rhat(_rank_normalize(split)), _rhat(_rank_normalize(folded)))
+    ess_bulk = effective_sample_size(_rank_normalize(split))
+    q05, q95 = np.quantile(split, [.05, .95])
+    ess_tail = min(effective_sample_size(split <= q05),
+                   effective_sample_size(split <= q95))
+    return dict(rhat=rhat, ess_bulk=ess_bulk, ess_tail=ess_tail)
+
+
 def compute_census(projection_admits_series, mean_los):
     """Compute Census based on exponential LOS distribution."""
-    census = [0]
-    for a in projection_admits_series.values:
-        c = float(a) + (1 - 1 / float(mean_los)) * census[-1]
-        census.append(c)
-    return np.array(census[1:])
-
-
-def SIR_from_params(p_df):
-    """
-    This function takes the output from the qdraw function
-    """
-    n_hosp = int(p_df.val.loc[p_df.param == "n_hosp"])
-    incubation_days = float(p_df.val.loc[p_df.param == "incubation_days"])
-    hosp_prop = float(p_df.val.loc[p_df.param == "hosp_prop"])
-    ICU_prop = float(p_df.val.loc[p_df.param == "ICU_prop"])
-    vent_prop = float(p_df.val.loc[p_df.param == "vent_prop"])
-    hosp_LOS = float(p_df.val.loc[p_df.param == "hosp_LOS"])
-    ICU_LOS = float(p_df.val.loc[p_df.param == "ICU_LOS"])
-    vent_LOS = float(p_df.val.loc[p_df.param == "vent_LOS"])
-    recovery_days = float(p_df.val.loc[p_df.param == "recovery_days"])
-    mkt_share = float(p_df.val.loc[p_df.param == "mkt_share"])
-    region_pop = float(p_df.val.loc[p_df.param == "region_pop"])
-    logistic_k = float(p_df.val.loc[p_df.param == "logistic_k"])
-    logistic_L = float(p_df.val.loc[p_df.param == "logistic_L"])
-    logistic_x0 = float(p_df.val.loc[p_df.param == "logistic_x0"])
-    nu = float(p_df.val.loc[p_df.param == "nu"])
-    beta = float(
-        p_df.val.loc[p_df.param == "beta"]
-    )  # get beta directly rather than via doubling time
-    # assemble the coefficient vector for the splines
-    beta_spline = np.array(p_df.val.loc[p_df.param.str.contains('beta_spline_coef')]) #this evaluates to an empty array if it's not in the params
-    if len(beta_spline) > 0:
-        b0 = float(p_df.val.loc[p_df.param == "b0"])
-        beta_spline_power = np.array(p_df.val.loc[p_df.param == "beta_spline_power"])
-        nobs = float(p_df.val.loc[p_df.param == "nobs"])
-        beta_k = int(p_df.loc[p_df.param == "beta_spline_dimension", 'val'])
-        Xmu = p_df.loc[p_df.param == "Xmu", 'val'].iloc[0]
-        Xsig = p_df.loc[p_df.param == "Xsig", 'val'].iloc[0]
+    return exponential_census(
+        np.asarray(projection_admits_series, dtype=float), float(mean_los)
+    )
+
+
+def binomial_observation(ds, s, e, hosp_prop, ICU_prop, vent_prop, mkt_share, rng):
+    """
+    Stochastic observation stage with discrete individuals.
+    `ds`, `s` and `e` are (n_draws, n_days+1) arrays of new infections, susceptible
+    and exposed; the proportions are (n_draws, 1) columns; `rng` is a
+    numpy.random.Generator. Returns hosp, icu and vent admits.
+    """
+    #  Sample from expected new infections as
+    #  a proportion of Exposed + Succeptible
+    #  NOTE: This is still an *underaccounting* of stochastic
+    #        process which would compound over time.
+    #        This would require that the SEIR were truly stocastic.
+    e_int = e.astype(int) + s.astype(int)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        prob_i = np.clip(np.nan_to_num(ds / e_int, nan=0.0), 0.0, 1.0)
+    ds = rng.binomial(e_int, prob_i)
+
+    #  Sample admissions as proportion of
+    #  new infections.
+    hosp = rng.binomial(ds, hosp_prop * mkt_share)
+    icu = rng.binomial(hosp, ICU_prop)
+    vent = rng.binomial(icu, vent_prop)
+    return hosp, icu, vent
+
+
+def beta_observation(ds, s, e, hosp_prop, ICU_prop, vent_prop, mkt_share, rng):
+    """Like `binomial_observation`, but with continuous fractions of individuals"""
+    e_int = e + s
+    with np.errstate(divide="ignore", invalid="ignore"):
+        prob_i = np.clip(np.nan_to_num(ds / e_int, nan=0.0), 0.0, 1.0)
+    ds = rng.beta(prob_i * e_int + 1, (1 - prob_i) * e_int + 1) * e_int
+
+    #  Sample admissions as proportion of
+    #  new infections.
+    hosp = (
+        rng.beta(
+            ds * hosp_prop * mkt_share + 1,
+            ds * (1 - hosp_prop * mkt_share) + 1,
+        )
+        * ds
+    )
+    icu = rng.beta(hosp * ICU_prop + 1, hosp * (1 - ICU_prop) + 1) * hosp
+    vent = rng.beta(icu * vent_prop + 1, icu * (1 - vent_prop) + 1) * icu
+    return hosp, icu, vent
+
+
+OBSERVATION_MODELS = dict(binomial=binomial_observation, beta=beta_observation)
+
+
+def SIR_from_params(p_df, reopen_day=None, reopen_speed=None, reopen_cap=None,
+                    observation=binomial_observation, rng=None, n_days=300,
+                    stochastic=True):
+    """
+    This function takes the output from the qdraw function (a ParamVector).
+    The old long-format frame of `param` and `val` is still accepted.
+    The reopen_* arguments override the values in `p_df`, if any; they may be
+    scalars or arrays over draws.
+    `observation` is the stochastic observation stage (see OBSERVATION_MODELS),
+    which draws from the numpy.random.Generator `rng`.
+    Projections run for `n_days` days after the first hospitalization. With
+    `stochastic=False` ("fit mode") the stochastic projection is skipped and
+    `arr_stoch` is None; pass a short `n_days` to simulate only what a
+    likelihood needs.
+
+    If `p_df.val` is an (n_draws, n_params) matrix, all draws are simulated together
+    and every output gains a leading draw axis. s, e, i and r then run to
+    n_days + max(offset), which is valid for every draw.
+    """
+    if isinstance(p_df, pd.DataFrame):
+        p_df = ParamVector.from_frame(p_df)
+    if rng is None:
+        rng = np.random.default_rng()
+    batch = np.ndim(p_df.val) == 2
+    p = ParamVector(p_df.schema, np.atleast_2d(p_df.val))
+
+    def col(name, default=None):
+        # (n_draws,) float column
+        return np.broadcast_to(
+            np.asarray(p.get(name, default), dtype=float), p.val.shape[:1]
+        )
+
+    n_hosp = col("n_hosp").astype(int)
+    incubation_days = col("incubation_days")
+    hosp_prop = col("hosp_prop")
+    ICU_prop = col("ICU_prop")
+    vent_prop = col("vent_prop")
+    hosp_LOS = col("hosp_LOS")
+    ICU_LOS = col("ICU_LOS")
+    vent_LOS = col("vent_LOS")
+    recovery_days = col("recovery_days")
+    mkt_share = col("mkt_share")
+    region_pop = col("region_pop")
+    logistic_k = col("logistic_k")
+    logistic_L = col("logistic_L")
+    logistic_x0 = col("logistic_x0")
+    nu = col("nu")
+    beta = col("beta")  # get beta directly rather than via doubling time
+    # assemble the coefficient matrix for the splines
+    beta_spline = p.val[:, p.schema.spline_index]
+    if beta_spline.shape[1] > 0:
+        b0 = col("b0")
+        beta_spline_power = float(p["beta_spline_power"][0])
+        nobs = float(p["nobs"][0])
+        beta_k = int(p["beta_spline_dimension"][0])
     else:
+        beta_spline = None
         beta_spline_power = None
         beta_k = None
         nobs = None
         b0 = None
-        Xmu, Xsig = None, None
-        
-    reopen_day, reopen_speed, reopen_cap = 1000, 0.0, 1.0
-    if "reopen_day" in p_df.param.values:
-        reopen_day = int(p_df.val.loc[p_df.param == "reopen_day"])
-    if "reopen_speed" in p_df.param.values:
-        reopen_speed = float(p_df.val.loc[p_df.param == "reopen_speed"])
-    if "reopen_cap" in p_df.param.values:
-        reopen_cap = float(p_df.val.loc[p_df.param == "reopen_cap"])
+
+    if reopen_day is None:
+        reopen_day = col("reopen_day", 1000).astype(int)
+    if reopen_speed is None:
+        reopen_speed = col("reopen_speed", 0.0)
+    if reopen_cap is None:
+        reopen_cap = col("reopen_cap", 1.0)
     alpha = 1 / incubation_days
     gamma = 1 / recovery_days
     total_infections = n_hosp / mkt_share / hosp_prop
 
-    n_days = 300
-
     # Offset by the incubation period to start the sim
     # that many days before the first hospitalization
     # Estimate the number Exposed from the number hospitalized
@@ -259,132 +960,79 @@ def SIR_from_params(p_df):
     offset = expon.ppf(
         0.99, 1 / incubation_days
     )  # Enough time for 95% of exposed to become infected
-    offset = int(offset)
-    s, e, i, r = sim_sir(
+    offset = offset.astype(int)
+    sd = sd_schedule(
+        n_days=n_days + offset.max(),
+        logistic_L=logistic_L,
+        logistic_k=logistic_k,
+        logistic_x0=logistic_x0 + offset,
+        b0=b0,
+        beta_spline=beta_spline,
+        beta_k=beta_k,
+        beta_spline_power=beta_spline_power,
+        nobs=nobs,
+        reopen_day=reopen_day,
+        reopen_speed=reopen_speed,
+        reopen_cap=reopen_cap,
+    )
+    s, e, i, r = sim_sir_batch(
         S=region_pop - total_infections,
         E=total_infections,
         I=0.0,  # n_infec / detection_prob,
         R=0.0,
         alpha=alpha,
         beta=beta,
-        b0=b0,
-        beta_spline = beta_spline,
-        beta_k = beta_k,
-        beta_spline_power = beta_spline_power,
-        Xmu = Xmu,
-        Xsig = Xsig,
-        nobs = nobs,
         gamma=gamma,
         nu=nu,
-        n_days=n_days + offset,
-        logistic_L=logistic_L,
-        logistic_k=logistic_k,
-        logistic_x0=logistic_x0 + offset,
-        reopen_day=reopen_day,
-        reopen_speed=reopen_speed,
-        reopen_cap=reopen_cap
+        sd=sd,
     )
 
-    arrs = {}
-    for sim_type in ["mean", "stochastic"]:
-        if sim_type == "mean":
-
-            ds = np.diff(i) + np.diff(r)  # new infections is delta i plus delta r
-            ds = np.array([0] + list(ds))
-            ds = ds[offset:]
+    # align every draw on the day of the first hospitalization
+    window = offset[:, None] + np.arange(n_days + 1)[None, :]
+    ds = np.diff(i) + np.diff(r)  # new infections is delta i plus delta r
+    ds = np.concatenate([np.zeros((ds.shape[0], 1)), ds], axis=1)
+    ds = np.take_along_axis(ds, window, axis=1)
 
-            hosp_raw = hosp_prop
-            ICU_raw = hosp_raw * ICU_prop  # coef param
-            vent_raw = ICU_raw * vent_prop  # coef param
+    arrs = dict(stochastic=None)
+    for sim_type in ["mean", "stochastic"] if stochastic else ["mean"]:
+        if sim_type == "mean":
+            hosp_raw = hosp_prop[:, None]
+            ICU_raw = hosp_raw * ICU_prop[:, None]  # coef param
+            vent_raw = ICU_raw * vent_prop[:, None]  # coef param
 
-            hosp = ds * hosp_raw * mkt_share
-            icu = ds * ICU_raw * mkt_share
-            vent = ds * vent_raw * mkt_share
+            hosp = ds * hosp_raw * mkt_share[:, None]
+            icu = ds * ICU_raw * mkt_share[:, None]
+            vent = ds * vent_raw * mkt_share[:, None]
         elif sim_type == "stochastic":
             # Sampling Stochastic Observation
+            hosp, icu, vent = observation(
+                ds,
+                np.take_along_axis(s, window, axis=1),
+                np.take_along_axis(e, window, axis=1),
+                hosp_prop=hosp_prop[:, None],
+                ICU_prop=ICU_prop[:, None],
+                vent_prop=vent_prop[:, None],
+                mkt_share=mkt_share[:, None],
+                rng=rng,
+            )
 
-            ds = np.diff(i) + np.diff(r)  # new infections is delta i plus delta r
-            ds = np.array([0] + list(ds))
-
-            #  Sample from expected new infections as
-            #  a proportion of Exposed + Succeptible
-            #  NOTE: This is still an *underaccounting* of stochastic
-            #        process which would compound over time.
-            #        This would require that the SEIR were truly stocastic.
-            stocastic_dist = "binomial"
-            if stocastic_dist == "binomial":
-                #  Discrete individuals
-                e_int = e.astype(int) + s.astype(int)
-                prob_i = pd.Series(ds / e_int).fillna(0.0)
-                prob_i = prob_i.apply(lambda x: min(x, 1.0))
-                prob_i = prob_i.apply(lambda x: max(x, 0.0))
-                ds = np.random.binomial(e_int, prob_i)
-                ds = ds[offset:]
-
-                #  Sample admissions as proportion of
-                #  new infections.
-                hosp = np.random.binomial(ds.astype(int), hosp_prop * mkt_share)
-                icu = np.random.binomial(hosp, ICU_prop)
-                vent = np.random.binomial(icu, vent_prop)
-            elif stocastic_dist == "beta":
-                #  Continuous fractions of individuals
-                e_int = e + s
-                prob_i = pd.Series(ds / e_int).fillna(0.0)
-                prob_i = prob_i.apply(lambda x: min(x, 1.0))
-                prob_i = prob_i.apply(lambda x: max(x, 0.0))
-                ds = (
-                    np.random.beta(prob_i * e_int + 1, (1 - prob_i) * e_int + 1) * e_int
-                )
-                ds = ds[offset:]
-
-                #  Sample admissions as proportion of
-                #  new infections.
-                hosp = (
-                    np.random.beta(
-                        ds * hosp_prop * mkt_share + 1,
-                        ds * (1 - hosp_prop * mkt_share) + 1,
-                    )
-                    * ds
-                )
-                icu = (
-                    np.random.beta(hosp * ICU_prop + 1, hosp * (1 - ICU_prop) + 1)
-                    * hosp
-                )
-                vent = (
-                    np.random.beta(icu * vent_prop + 1, icu * (1 - vent_prop) + 1) * icu
-                )
+        # admits and census for hosp, icu and vent; census is computed for
+        # all kinds and draws with a single call
+        admits = np.stack([hosp, icu, vent], axis=1).astype(float)
+        census = exponential_census(
+            admits, np.stack([hosp_LOS, ICU_LOS, vent_LOS], axis=1)
+        )
+        proj = np.concatenate([admits, census], axis=1).transpose(0, 2, 1)
+        arrs[sim_type] = np.where(np.isnan(proj), 0, proj)
 
-        # make a data frame with all the stats for plotting
-        days = np.array(range(0, n_days + 1))
-        data_list = [days, hosp, icu, vent]
-        data_dict = dict(zip(["day", "hosp_adm", "icu_adm", "vent_adm"], data_list))
-        projection = pd.DataFrame.from_dict(data_dict)
-        projection_admits = projection
-        projection_admits["day"] = range(projection_admits.shape[0])
-        # census df
-        hosp_LOS_raw = hosp_LOS
-        ICU_LOS_raw = ICU_LOS
-        vent_LOS_raw = vent_LOS
-
-        los_dict = {
-            "hosp_census": hosp_LOS_raw,
-            "icu_census": ICU_LOS_raw,
-            "vent_census": vent_LOS_raw,
-        }
-        census_dict = {}
-        for k, los in los_dict.items():
-            census = compute_census(
-                projection_admits[re.sub("_census", "_adm", k)], los
-            )
-            census_dict[k] = census
-        proj = pd.concat([projection_admits, pd.DataFrame(census_dict)], axis=1)
-        proj = proj.fillna(0)
-        arrs[sim_type] = proj
+    if not batch:
+        arrs = {k: v if v is None else v[0] for k, v in arrs.items()}
+        s, e, i, r, offset = s[0], e[0], i[0], r[0], int(offset[0])
     output = dict(
-        days=np.asarray(proj.day),
-        arr=np.asarray(arrs["mean"])[:, 1:],
-        arr_stoch=np.asarray(arrs["stochastic"])[:, 1:],
-        names=proj.columns.tolist()[1:],
+        days=np.arange(n_days + 1),
+        arr=arrs["mean"],
+        arr_stoch=arrs["stochastic"],
+        names=["hosp_adm", "icu_adm", "vent_adm", "hosp_census", "icu_census", "vent_census"],
         parms=p_df,
         s=s,
         e=e,
@@ -393,3 +1041,72 @@ def SIR_from_params(p_df):
         offset=offset,
     )
     return output
+
+
+# posterior shared with the reopening scenario workers, set by the pool
+# initializer so it is shipped once per worker rather than once per task
+_scenario_posterior = {}
+
+
+def _init_scenario_worker(schema, vals, observation, n_days, chunk_size):
+    _scenario_posterior.update(schema=schema, vals=vals, observation=observation,
+                               n_days=n_days, chunk_size=chunk_size)
+
+
+def scenario_quantiles(day, speed, cap, seed, q):
+    """
+    Quantiles of the stochastic hosp census over the shared posterior, under
+    one reopening scenario. Posterior rows are simulated in batched chunks.
+    """
+    post = _scenario_posterior
+    vals, chunk_size = post["vals"], post["chunk_size"]
+    rng = np.random.default_rng(seed)
+    hosp = []
+    for start in range(0, vals.shape[0], chunk_size):
+        draw = SIR_from_params(ParamVector(post["schema"], vals[start:start + chunk_size]),
+                               reopen_day=day, reopen_speed=speed, reopen_cap=cap,
+                               observation=post["observation"], rng=rng,
+                               n_days=post["n_days"])
+        hosp.append(draw["arr_stoch"][:, :, 3])
+    return np.quantile(np.concatenate(hosp), q, axis=0)
+
+
+def _scenario_task(schema, vals, observation, n_days, chunk_size, *scenario):
+    _init_scenario_worker(schema, vals, observation, n_days, chunk_size)
+    return scenario_quantiles(*scenario)
+
+
+def reopening_days(reopen_day, n_days, n_scenarios):
+    """
+    Reopening days of at most `n_scenarios` scenarios, evenly spaced from
+    `reopen_day` and before 2/3 of an `n_days` projection. None when
+    `reopen_day` is not before that day (e.g. the 8675309 default).
+    """
+    gap = max(1, math.ceil((n_days - reopen_day) / n_scenarios))
+    return np.arange(reopen_day, n_days * 2 // 3, gap)
+
+
+def reopening_scenarios(schema, vals, scenarios, observation=binomial_observation,
+                        n_days=300, q=(.05, .25, .5, .75, .95), seed=0,
+                        chunk_size=1000, processes=None, executor=None):
+    """
+    Evaluate a grid of reopening scenarios over a posterior sample.
+    `vals` is the (n_samples, schema.size) posterior matrix and `scenarios` a
+    list of (reopen_day, reopen_speed, reopen_cap). One pool is used for the
+    whole grid, with the posterior shared through its initializer; with an
+    `executor` (a RunExecutor), its workers are used instead and the
+    posterior is published to them in shared memory.
+    Returns a list of (len(q), n_days + 1) quantile bands of the hosp census,
+    one per scenario.
+    """
+    seeds = np.random.SeedSequence(seed).spawn(len(scenarios))
+    tasks = [(day, speed, cap, ss, q) for (day, speed, cap), ss in zip(scenarios, seeds)]
+    init = (schema, vals, observation, n_days, chunk_size)
+    if executor is not None:
+        init = (schema, executor.share_array(vals), observation, n_days, chunk_size)
+        return executor.starmap(_scenario_task, [init + t for t in tasks])
+    if processes == 1:
+        _init_scenario_worker(*init)
+        return [scenario_quantiles(*t) for t in tasks]
+    with mp.Pool(processes or mp.cpu_count(), _init_scenario_worker, init) as pool:
+        return pool.starmap(scenario_quantiles, tasks)
@@ -35,6 +35,7 @@ from bayes_chime.normal.utilities import (
     one_minus_logistic_fcn,
 )
 
+from bayes_chime.normal.fitting import NORM_APPROXIMATIONS
 from bayes_chime.normal.models import SEIRModel
 from bayes_chime.normal.scripts.utils import (
     DEBUG,
@@ -49,6 +50,7 @@ import matplotlib.pyplot as plt
 from scipy.stats import probplot
 
 from _01_GOF_sims import do_chains
+from bayes_chime.executor import RunExecutor
 
 datadir = f"{os.getcwd()}/data/"
 outdir = f"{os.getcwd()}/output/"
@@ -132,9 +134,9 @@ def get_yy(data: DataFrame, **err: Dict[str, FloatLike]) -> NormalDistArray:
     ).T
 
 
-def bayes_xval(days_withheld = 7, which_hospital = "HUP"):
+def bayes_xval(days_withheld = 7, which_hospital = "HUP", prior_cache = NORM_APPROXIMATIONS):
     try:
-        parameters = read_parameters(f"{datadir}{which_hospital}_parameters.csv")
+        parameters = read_parameters(f"{datadir}{which_hospital}_parameters.csv", prior_cache)
         data = read_data(f"{datadir}{which_hospital}_ts.csv")[:-days_withheld]
         test_set = pd.read_csv(f"{datadir}{which_hospital}_ts.csv")[-days_withheld:]
         test_set.date = test_set.date.astype("datetime64[ns]")
@@ -273,12 +275,15 @@ def plotq(d):
 
 def main():
 
-    tuples_for_starmap = [(7, j) for j in ['PMC', "LGH", "HUP", "CCH", 'PAH', 'MCP']]
+    hospitals = ['PMC', "LGH", "HUP", "CCH", 'PAH', 'MCP']
+    # the hospitals share most priors: fit each one once here, and ship the
+    # filled cache to the workers, whose own caches start empty
+    for j in hospitals:
+        read_parameters(f"{datadir}{j}_parameters.csv")
+    tuples_for_starmap = [(7, j, NORM_APPROXIMATIONS) for j in hospitals]
     
-    import multiprocessing as mp
-    pool = mp.Pool(mp.cpu_count())
-    outdicts = pool.starmap(bayes_xval, tuples_for_starmap)
-    pool.close()
+    with RunExecutor(prior_cache=NORM_APPROXIMATIONS) as executor:
+        outdicts = executor.starmap(bayes_xval, tuples_for_starmap)
         
     
     for i in outdicts:
@@ -0,0 +1,150 @@
+"""Run-scoped process pool shared by all parallel phases of a run
+"""
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import multiprocessing as mp
+from multiprocessing import shared_memory, util
+
+import numpy as np
+
+# worker side: the run's read-only inputs, and attached shared memory segments
+_SHARED: Dict[str, Any] = {}
+_SEGMENTS: Dict[str, shared_memory.SharedMemory] = {}
+
+
+class SharedRef:  # pylint: disable=R0903
+    """Stands in a task's arguments for an input shipped by the initializer
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+
+
+class SharedArrayRef:  # pylint: disable=R0903
+    """Stands in a task's arguments for an array published in shared memory
+    """
+
+    def __init__(self, segment: str, shape: Tuple[int, ...], dtype: str):
+        self.segment = segment
+        self.shape = shape
+        self.dtype = dtype
+
+
+def _init_worker(shared: Dict[str, Any]):
+    """Stores the run's read-only inputs in a new worker
+    """
+    _SHARED.clear()
+    _SHARED.update(shared)
+    # detach from the shared memory segments when the worker exits
+    util.Finalize(None, _close_segments, exitpriority=10)
+
+
+def _close_segments():
+    """Closes the worker's attachments to shared memory segments
+    """
+    for segment in _SEGMENTS.values():
+        segment.close()
+    _SEGMENTS.clear()
+
+
+def _resolve(arg: Any) -> Any:
+    """Replaces references by the worker's copy of the shared input
+    """
+    if isinstance(arg, SharedRef):
+        return _SHARED[arg.name]
+    if isinstance(arg, SharedArrayRef):
+        if arg.segment not in _SEGMENTS:
+            _SEGMENTS[arg.segment] = shared_memory.SharedMemory(name=arg.segment)
+        array = np.ndarray(arg.shape, arg.dtype, buffer=_SEGMENTS[arg.segment].buf)
+        array.flags.writeable = False
+        return array
+    return arg
+
+
+def _call(fcn: Callable, args: Tuple) -> Any:
+    """Runs one task in a worker
+    """
+    return fcn(*[_resolve(arg) for arg in args])
+
+
+class RunExecutor:
+    """Process pool started once per run and used by every parallel phase.
+
+    The read-only inputs of the run (e.g., the parameter table and the census series)
+    are passed as keywords and shipped to each worker once, by the pool initializer.
+    Arrays that only exist later in the run (e.g., a posterior sample) can be published
+    in shared memory with `share_array`. Tasks are dispatched with `starmap` as usual:
+    any argument that *is* one of the shared objects is sent as a lightweight reference
+    and resolved in the worker.
+
+    The pool is started on first use; with `processes=1` tasks run in-process.
+    Use as a context manager, or call `close` at the end of the run.
+
+    Arguments:
+        processes: Number of workers, defaults to the number of CPUs.
+        shared: The run's read-only inputs, by name.
+    """
+
+    def __init__(self, processes: Optional[int] = None, **shared: Any):
+        self.processes = processes or mp.cpu_count()
+        self.shared = shared
+        self._pool = None
+        self._arrays: List[Tuple[np.ndarray, SharedArrayRef]] = []
+        self._segments: List[shared_memory.SharedMemory] = []
+
+    def __enter__(self) -> "RunExecutor":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def share_array(self, array: np.ndarray) -> np.ndarray:
+        """Publishes `array` in shared memory; tasks receiving it get a read-only view.
+
+        Returns the array itself, which is the object to pass in task arguments.
+        """
+        if self.processes > 1:
+            array = np.ascontiguousarray(array)
+            segment = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, array.dtype, buffer=segment.buf)[...] = array
+            self._segments.append(segment)
+            self._arrays.append(
+                (array, SharedArrayRef(segment.name, array.shape, array.dtype.str))
+            )
+        return array
+
+    def _reference(self, arg: Any) -> Any:
+        for name, value in self.shared.items():
+            if arg is value:
+                return SharedRef(name)
+        for value, ref in self._arrays:
+            if arg is value:
+                return ref
+        return arg
+
+    def starmap(self, fcn: Callable, iterable: Iterable[Tuple]) -> List[Any]:
+        """Like `multiprocessing.Pool.starmap`, on the run's workers
+
+        Arguments:
+            fcn: Module level function to call.
+            iterable: Argument tuples, one per task.
+        """
+        if self.processes == 1:
+            return [fcn(*args) for args in iterable]
+        if self._pool is None:
+            self._pool = mp.Pool(self.processes, _init_worker, (self.shared,))
+        tasks = [(fcn, tuple(self._reference(arg) for arg in args)) for args in iterable]
+        return self._pool.starmap(_call, tasks)
+
+    def close(self):
+        """Stops the workers and releases the shared memory
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        for segment in self._segments:
+            segment.close()
+            segment.unlink()
+        self._segments = []
+        self._arrays = []
@@ -1,6 +1,10 @@
 """Fitting routines for approximating distributions with normal distributions
 """
-from typing import TypeVar, Dict, Any, Optional
+from typing import TypeVar, Dict, Any, Optional, Tuple
+
+from collections import OrderedDict
+from json import dump, load
+from os import path, replace
 
 from numpy import linspace, sqrt, median, sum
 
@@ -51,7 +55,7 @@ def parse_dist(data: Dict[str, Any]) -> Dist:
         dist = beta(a=data["p1"], b=data["p2"])
     elif distribution == "gamma":
         dist = gamma(a=data["p1"], scale=data["p2"])
-    elif distribution == "normal":
+    elif distribution in ("normal", "norm"):
         dist = norm(loc = data['p1'], scale = data['p2'])
     elif distribution == "constant":
         dist = data["base"]
@@ -70,14 +74,102 @@ def gv_to_dist(normal: NormalDistVar) -> Dist:
     return norm(loc=normal.mean, scale=normal.sdev)
 
 
-def fit_norm_to_prior_df(prior_df: DataFrame) -> Dict[str, FloatOrDistVar]:
+DistSpec = Tuple[str, float, float]
+
+
+class NormalApproximationCache:
+    """Bounded cache of normal approximations of prior distributions
+
+    Maps `(distribution, p1, p2)` of a prior spec to the (mean, sdev) returned by
+    `fit_norm_dist_to_dist`. Least recently used entries are dropped once `max_size`
+    is exceeded. If `file_name` is given, entries are loaded from and saved to this
+    json file, such that they persist between runs.
+
+    The cache lives in one process: pool workers do not see what the parent adds
+    after they start. Pass a filled cache to them with their tasks' inputs.
+
+    Arguments:
+        max_size: Maximal number of entries
+        file_name: Optional json file to store entries in
+    """
+
+    def __init__(self, max_size: int = 1024, file_name: Optional[str] = None):
+        self.max_size = max_size
+        self.file_name = None
+        self._entries: Dict[DistSpec, Tuple[float, float]] = OrderedDict()
+        self._modified = False
+        if file_name is not None:
+            self.open(file_name)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def open(self, file_name: str):
+        """Uses `file_name` as on-disk store and loads its entries if present
+        """
+        self.file_name = file_name
+        if path.exists(file_name):
+            with open(file_name, "r") as fin:
+                for distribution, p1, p2, mu, std in load(fin):
+                    self.put((distribution, p1, p2), (mu, std))
+        self._modified = False
+
+    def get(self, key: DistSpec) -> Optional[Tuple[float, float]]:
+        """Returns (mean, sdev) for key or None if not present
+        """
+        if key not in self._entries:
+            return None
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def put(self, key: DistSpec, value: Tuple[float, float]):
+        """Adds (mean, sdev) for key and drops the oldest entry if full
+        """
+        self._entries[key] = tuple(value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        self._modified = True
+
+    def save(self):
+        """Writes entries to the on-disk store if present and modified
+        """
+        if self.file_name is None or not self._modified:
+            return
+        tmp_file_name = self.file_name + ".tmp"
+        with open(tmp_file_name, "w") as fout:
+            dump([list(key) + list(val) for key, val in self._entries.items()], fout)
+        replace(tmp_file_name, self.file_name)
+        self._modified = False
+
+
+NORM_APPROXIMATIONS = NormalApproximationCache()
+
+
+def fit_norm_to_prior_df(
+    prior_df: DataFrame, cache: Optional[NormalApproximationCache] = NORM_APPROXIMATIONS
+) -> Dict[str, FloatOrDistVar]:
     """Reads in prior data frame (`params.csv`) and returns fitted normal variables.
+
+    Normal approximations are looked up in and added to `cache` (if not None).
     """
     priors = {}
     for _, row in prior_df.iterrows():
         dist = parse_dist(row)
-        priors[row["param"]] = (  # account for constant dist
-            dist if isinstance(dist, float) else fit_norm_dist_to_dist(dist)
-        )
+        if isinstance(dist, float):  # account for constant dist
+            priors[row["param"]] = dist
+            continue
+
+        key = (row["distribution"], float(row["p1"]), float(row["p2"]))
+        value = cache.get(key) if cache is not None else None
+        if value is None:
+            normal = fit_norm_dist_to_dist(dist)
+            value = (normal.mean, normal.sdev)
+            if cache is not None:
+                cache.put(key, value)
+        priors[row["param"]] = gvar(*value)
+
+    if cache is not None:
+        cache.save()
 
     return priors
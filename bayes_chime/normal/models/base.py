@@ -1,22 +1,63 @@
 """Helper functions to utilize SIR like models
 """
-from typing import Dict, Generator, List, Callable, Optional
+from typing import Dict, Generator, List, Callable, Optional, Tuple
 
 from abc import ABC, abstractmethod
 
 from datetime import date as Date
 from datetime import timedelta
 
+from numpy import array, ndarray, ones, stack
 from pandas import DataFrame, DatetimeIndex, infer_freq
 
+from gvar import BufferDict, gvar, gvar_function, mean
+
 from bayes_chime.normal.utilities import (
     FloatLike,
+    FloatLikeArray,
     NormalDistVar,
     FloatOrDistVar,
     NormalDistArray,
 )
 
 
+class SimulationResult:
+    """Compact simulation result: one array per column over all dates
+
+    Returned by `CompartmentModel.simulate`. Columns are accessed by name; the
+    conversion to a DataFrame only happens on request.
+
+    Arguments:
+        dates: The simulation dates
+        columns: Array of values over dates for each column
+    """
+
+    def __init__(self, dates: DatetimeIndex, columns: Dict[str, ndarray]):
+        self.dates = dates
+        self.columns = columns
+
+    def __getitem__(self, column: str) -> ndarray:
+        return self.columns[column]
+
+    def values(
+        self, columns: Optional[List[str]] = None, start_date: Optional[Date] = None
+    ) -> ndarray:
+        """Returns the (dates x columns) array of the selected columns
+
+        Arguments:
+            columns: The columns to return, defaults to all columns.
+            start_date: Only return rows for this and later dates.
+        """
+        columns = columns or list(self.columns)
+        rows = self.dates >= start_date if start_date is not None else slice(None)
+        return stack([self.columns[col][rows] for col in columns], axis=1)
+
+    def to_frame(self) -> DataFrame:
+        """Returns the result as a DataFrame indexed by date
+        """
+        return DataFrame(data=self.columns, index=self.dates.rename("date"))
+
+
 class CompartmentModel(ABC):
     """Abstract implementation of SIR like compartment model
 
@@ -81,6 +122,89 @@ class CompartmentModel(ABC):
         """
         return data
 
+    def post_process_arrays(  # pylint: disable=R0201, W0613
+        self, columns: Dict[str, ndarray], **pars: Dict[str, FloatOrDistVar]
+    ) -> Dict[str, ndarray]:
+        """Array version of `post_process_simulation` used by `simulate`.
+
+        Arguments:
+            columns: Array of values over dates for each simulated column
+            pars: Model parameters
+
+        Returns:
+            The columns, optionally extended by new columns
+        """
+        return columns
+
+    def recurrence(
+        self,
+        initial: Dict[str, NormalDistVar],
+        schedule: Dict[str, ndarray],
+        **pars: Dict[str, FloatOrDistVar],
+    ) -> Dict[str, ndarray]:
+        """Runs the simulation over all dates at once for `simulate`.
+
+        By default, this calls `simulation_step` for each date with the scheduled
+        parameters of that date. Models should overload this with a loop over
+        preallocated arrays.
+
+        Arguments:
+            initial: The compartments at the first date
+            schedule: Time dependent parameters with one value per date
+            pars: Model parameters
+
+        Returns:
+            Array of values over dates for each compartment and step output. Step
+            outputs which are not compartments are zero at the first date.
+        """
+        step_pars = dict(pars)
+        rows = [initial]
+        for tt in range(len(pars["dates"]) - 1):
+            for key, values in schedule.items():
+                step_pars[key] = values[tt]
+            rows.append(self.simulation_step(rows[-1], **step_pars))
+
+        keys = list(initial) + [key for key in rows[-1] if key not in initial]
+        return {key: array([row.get(key, 0) for row in rows]) for key in keys}
+
+    def recurrence_tangent(
+        self,
+        initial: Dict[str, NormalDistVar],
+        schedule: Dict[str, ndarray],
+        primary: NormalDistArray,
+        **pars: Dict[str, FloatOrDistVar],
+    ) -> Tuple[Dict[str, FloatLikeArray], Dict[str, ndarray]]:
+        """Float version of `recurrence` which also propagates derivatives.
+
+        Used by `fit_fcn` if `forward_jacobian` is set. Should run the recurrence on
+        the means and propagate tangent arrays with respect to the primary gvars.
+
+        Arguments:
+            initial: The compartments at the first date
+            schedule: Time dependent parameters with one value per date
+            primary: Primary gvars, all other gvar inputs are functions of them
+            pars: Model parameters
+
+        Returns:
+            Mean values (dates) and derivatives (dates x primary) for each column
+        """
+        raise NotImplementedError(
+            "{model} does not implement a forward jacobian.".format(
+                model=type(self).__name__
+            )
+        )
+
+    def post_process_tangent(  # pylint: disable=R0201, W0613
+        self,
+        columns: Dict[str, FloatLikeArray],
+        tangents: Dict[str, ndarray],
+        primary: NormalDistArray,
+        **pars: Dict[str, FloatOrDistVar],
+    ) -> Tuple[Dict[str, FloatLikeArray], Dict[str, ndarray]]:
+        """Float version of `post_process_arrays` which also propagates derivatives.
+        """
+        return columns, tangents
+
     # ----------------------------------------------------------
     # This part should be fixed unless you add functionality
     # ----------------------------------------------------------
@@ -93,6 +217,11 @@ class CompartmentModel(ABC):
         ] = None,
         fit_start_date: Optional[Date] = None,
         debug: bool = False,
+        parameter_schedule: Callable[
+            [ndarray, Dict[str, FloatOrDistVar]], Dict[str, ndarray]
+        ] = None,
+        vectorized: bool = False,
+        forward_jacobian: bool = False,
     ):
         """Initializes the compartment model
         update function
@@ -109,6 +238,13 @@ class CompartmentModel(ABC):
             fit_start_date: When calling fit_fcn, this will only return results after
                 this date. This should be used if only a subset of the dates are fitted.
             debug: Print additional messages
+            parameter_schedule: Array version of update_parameters used by `simulate`.
+                It takes the day offsets of all dates (relative to the first date) and
+                all model parameters as input. It should return the time dependent
+                parameters as arrays over dates, e.g., `{"beta": beta_t}`. If not
+                present, the schedule is collected from update_parameters.
+            vectorized: Use `simulate` instead of `propagate_uncertainties` in
+                fit_fcn.
 
         Note:
             If the update_parameters method requires additional arguments, they must be
@@ -122,6 +258,9 @@ class CompartmentModel(ABC):
         )
         self.fit_start_date = fit_start_date
         self.debug = debug
+        self.parameter_schedule = parameter_schedule
+        self.vectorized = vectorized
+        self.forward_jacobian = forward_jacobian
 
     def propagate_uncertainties(
         self, meta_pars: Dict[str, FloatLike], dist_pars: Dict[str, NormalDistVar]
@@ -160,6 +299,48 @@ class CompartmentModel(ABC):
             inp_pars = self.update_parameters(date, **pars)
             data = self.simulation_step(data, **inp_pars)
 
+    def simulate(
+        self, meta_pars: Dict[str, FloatLike], dist_pars: Dict[str, NormalDistVar]
+    ) -> SimulationResult:
+        """Propagates uncertainties through simulation using arrays over dates
+
+        Same result as `propagate_uncertainties`, but the time dependent parameters
+        are computed for all dates up front and the simulation runs over arrays.
+
+        Arguments:
+            meta_pars: Fixed model meta parameters
+            dist_pars: Variable model prior parameters
+
+        Returns:
+            Compact simulation result, use `to_frame` for a DataFrame
+        """
+        pars = self.parse_input(**meta_pars, **dist_pars)
+        initial = {
+            compartment: pars["initial_{compartment}".format(compartment=compartment)]
+            for compartment in self.compartments
+        }
+        columns = self.recurrence(initial, self._schedule(**pars), **pars)
+        return SimulationResult(
+            pars["dates"], self.post_process_arrays(columns, **pars)
+        )
+
+    def _schedule(self, **pars: Dict[str, FloatOrDistVar]) -> Dict[str, ndarray]:
+        """Computes time dependent parameters for all dates
+
+        Falls back to collecting parameters changed by update_parameters date by date.
+        """
+        dates = pars["dates"]
+        if self.parameter_schedule is not None:
+            days = (dates - dates[0]).days.values
+            return self.parameter_schedule(days, **pars)
+
+        updates = [self.update_parameters(date, **pars) for date in dates]
+        return {
+            key: array([update[key] for update in updates])
+            for key, val in updates[0].items()
+            if val is not pars.get(key)
+        }
+
     def fit_fcn(  # pylint: disable=C0103
         self, xx: Dict[str, FloatLike], pp: Dict[str, NormalDistVar]
     ) -> NormalDistArray:
@@ -177,6 +358,21 @@ class CompartmentModel(ABC):
             print("xx:\n", xx)
             print("pp:\n", pp)
 
+        prior = BufferDict(pp)
+        if self.forward_jacobian and prior.buf.dtype == object:
+            values = self._fit_fcn_tangent(xx, prior)
+            if self.debug:
+                print("result:\n", values)
+            return values if values.shape[0] > 1 else values.flatten()
+
+        if self.vectorized:
+            values = self.simulate(xx, pp).values(
+                self.fit_columns, self.fit_start_date or None
+            )
+            if self.debug:
+                print("result:\n", values)
+            return values if values.shape[0] > 1 else values.flatten()
+
         df = self.propagate_uncertainties(xx, pp)
         if self.fit_start_date:
             df = df.loc[self.fit_start_date :]
@@ -188,6 +384,44 @@ class CompartmentModel(ABC):
 
         return df.values if df.values.shape[0] > 1 else df.values.flatten()
 
+    def _fit_fcn_tangent(  # pylint: disable=C0103
+        self, xx: Dict[str, FloatLike], prior: BufferDict
+    ) -> NormalDistArray:
+        """Computes fit_fcn values on floats and their jacobian by forward propagation
+
+        The inputs are replaced by independent gvars with the same means. Derivatives
+        with respect to these are propagated through the simulation and mapped back on
+        the actual inputs with `gvar_function`.
+        """
+        primary = gvar(mean(prior.buf), ones(prior.size))
+        pars = self.parse_input(**xx, **BufferDict(prior, buf=primary))
+        initial = {
+            compartment: pars["initial_{compartment}".format(compartment=compartment)]
+            for compartment in self.compartments
+        }
+        columns, tangents = self.recurrence_tangent(
+            initial, self._schedule(**pars), primary, **pars
+        )
+        columns, tangents = self.post_process_tangent(
+            columns, tangents, primary, **pars
+        )
+
+        fit_columns = self.fit_columns or list(columns)
+        rows = (
+            pars["dates"] >= self.fit_start_date
+            if self.fit_start_date
+            else slice(None)
+        )
+        values = stack([columns[col][rows] for col in fit_columns], axis=1)
+        jacobian = stack([tangents[col][rows] for col in fit_columns], axis=1)
+
+        return array(
+            [
+                gvar_function(prior.buf, val, der)
+                for val, der in zip(values.flat, jacobian.reshape(-1, prior.size))
+            ]
+        ).reshape(values.shape)
+
     def check_call(  # pylint: disable=C0103
         self,
         xx: Dict[str, FloatLike],
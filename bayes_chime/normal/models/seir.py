@@ -1,11 +1,60 @@
 """Implementation of SIR model
 """
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
-from bayes_chime.normal.utilities import FloatOrDistVar, NormalDistVar
+from numpy import array, broadcast_to, empty, eye, log, ndarray, stack, where, zeros
+
+from bayes_chime.normal.utilities import (
+    FloatLikeArray,
+    FloatOrDistVar,
+    NormalDistArray,
+    NormalDistVar,
+    mean_and_tangent,
+)
 from bayes_chime.normal.models.sir import SIRModel
 
 
+def seir_step(  # pylint: disable=R0913
+    susceptible: FloatOrDistVar,
+    exposed: FloatOrDistVar,
+    infected: FloatOrDistVar,
+    recovered: FloatOrDistVar,
+    beta: FloatOrDistVar,
+    alpha: FloatOrDistVar,
+    gamma: FloatOrDistVar,
+    nu: FloatOrDistVar,
+) -> Tuple[Tuple[FloatOrDistVar, ...], Tuple[FloatOrDistVar, ...], Tuple[FloatOrDistVar, ...]]:
+    """One SEIR step, shared by `simulation_step`, `recurrence` and
+    `recurrence_tangent`.
+
+    Compartments are clamped at zero and rescaled to keep the total population.
+
+    Returns:
+        The compartments before clamping, the updated compartments and the
+        rescaled flows S->E, E->I and I->R.
+    """
+    total = susceptible + exposed + infected + recovered
+
+    d_se = beta * (susceptible / total) ** nu * infected
+    d_ei = alpha * exposed
+    d_ir = gamma * infected
+
+    updated = (
+        susceptible - d_se,
+        exposed + (d_se - d_ei),
+        infected + (d_ei - d_ir),
+        recovered + d_ir,
+    )
+    clamped = [max(val, 0) for val in updated]
+    rescale = total / (clamped[0] + clamped[1] + clamped[2] + clamped[3])
+
+    return (
+        updated,
+        tuple(val * rescale for val in clamped),
+        (d_se * rescale, d_ei * rescale, d_ir * rescale),
+    )
+
+
 class SEIRModel(SIRModel):
     """Basic SEIR model
     """
@@ -38,6 +87,8 @@ class SEIRModel(SIRModel):
     ):
         """Executes SIR step and patches results such that each component is larger zero.
 
+        The step is `seir_step`, which `recurrence` runs as well.
+
         Arguments:
             data:
                 susceptible: Susceptible population
@@ -54,37 +105,162 @@ class SEIRModel(SIRModel):
             Updated compartments and optionally additional information like change
             from last iteration.
         """
-        susceptible = data["susceptible"]
-        exposed = data["exposed"]
-        infected = data["infected"]
-        recovered = data["recovered"]
+        _, (susceptible, exposed, infected, recovered), (d_se, d_ei, d_ir) = seir_step(
+            data["susceptible"],
+            data["exposed"],
+            data["infected"],
+            data["recovered"],
+            pars["beta"],
+            pars["alpha"],
+            pars["gamma"],
+            pars["nu"],
+        )
+        out = {
+            "susceptible": susceptible,
+            "exposed": exposed,
+            "infected": infected,
+            "recovered": recovered,
+            "exposed_new": d_se,
+            "infected_new": d_ei,
+            "recovered_new": d_ir,
+        }
+
+        return out
+
+    def recurrence(
+        self,
+        initial: Dict[str, NormalDistVar],
+        schedule: Dict[str, ndarray],
+        **pars: Dict[str, FloatOrDistVar],
+    ) -> Dict[str, ndarray]:
+        """Runs the step of `simulation_step` (`seir_step`) over preallocated arrays
+        for all dates, without building a dictionary per step.
+        """
+        n_dates = len(pars["dates"])
+        beta = schedule["beta"] if "beta" in schedule else [pars["beta"]] * n_dates
+        alpha, gamma, nu = pars["alpha"], pars["gamma"], pars["nu"]
 
-        total = susceptible + exposed + infected + recovered
+        keys = list(initial) + ["exposed_new", "infected_new", "recovered_new"]
+        out = {key: empty(n_dates, dtype=object) for key in keys}
+        state = tuple(initial[key] for key in self._compartment_keys)
+        for key in keys:
+            out[key][0] = initial.get(key, 0)
 
-        d_se = pars["beta"] * (susceptible / total) ** pars["nu"] * infected
-        d_ei = pars["alpha"] * exposed
-        d_ir = pars["gamma"] * infected
+        for tt in range(1, n_dates):
+            _, state, flow = seir_step(*state, beta[tt - 1], alpha, gamma, nu)
+            for key, val in zip(self._compartment_keys, state):
+                out[key][tt] = val
+            for key, val in zip(self._flow_keys, flow):
+                out[key][tt] = val
 
-        susceptible -= d_se
-        exposed += d_se - d_ei
-        infected += d_ei - d_ir
-        recovered += d_ir
+        # float columns unless the inputs are normal distributed
+        return {key: array(values.tolist()) for key, values in out.items()}
 
-        susceptible = max(susceptible, 0)
-        exposed = max(exposed, 0)
-        infected = max(infected, 0)
-        recovered = max(recovered, 0)
+    _compartment_keys = ["susceptible", "exposed", "infected", "recovered"]
+    _flow_keys = ["exposed_new", "infected_new", "recovered_new"]
+    # flows (S->E, E->I, I->R) to compartments (S, E, I, R)
+    _flow_matrix = array([[-1, 0, 0], [1, -1, 0], [0, 1, -1], [0, 0, 1]])
 
-        rescale = total / (susceptible + exposed + infected + recovered)
+    def recurrence_tangent(  # pylint: disable=R0914
+        self,
+        initial: Dict[str, NormalDistVar],
+        schedule: Dict[str, ndarray],
+        primary: NormalDistArray,
+        **pars: Dict[str, FloatOrDistVar],
+    ) -> Tuple[Dict[str, FloatLikeArray], Dict[str, ndarray]]:
+        """Runs `recurrence` on means and propagates derivatives w.r.t. primary.
 
-        out = {
-            "susceptible": susceptible * rescale,
-            "exposed": exposed * rescale,
-            "infected": infected * rescale,
-            "recovered": recovered * rescale,
-            "exposed_new": d_se * rescale,
-            "infected_new": d_ei * rescale,
-            "recovered_new": d_ir * rescale,
-        }
+        The recurrence is first run on floats. The derivatives of each step with
+        respect to the compartments and the step parameters (beta, alpha, gamma, nu)
+        are then computed for all dates at once, such that propagating the tangents
+        only takes one matrix product per date.
+        """
+        n_dates = len(pars["dates"])
+        compartments, flows = self._compartment_keys, self._flow_keys
 
-        return out
+        beta, d_beta = mean_and_tangent(
+            schedule["beta"] if "beta" in schedule else [pars["beta"]] * n_dates,
+            primary,
+        )
+        alpha, d_alpha = mean_and_tangent(pars["alpha"], primary)
+        gamma, d_gamma = mean_and_tangent(pars["gamma"], primary)
+        nu, d_nu = mean_and_tangent(pars["nu"], primary)
+        state_0, d_state_0 = mean_and_tangent(
+            array([initial[key] for key in compartments]), primary
+        )
+
+        # float recurrence, same step as `recurrence`
+        state = zeros((n_dates, 4))
+        flow = zeros((n_dates, 3))
+        updated = zeros((n_dates - 1, 4))
+        state[0] = state_0
+        compartments_tt = state_0.tolist()
+        for tt in range(n_dates - 1):
+            updated[tt], compartments_tt, flow[tt + 1] = seir_step(
+                *compartments_tt, beta[tt], alpha, gamma, nu
+            )
+            state[tt + 1] = compartments_tt
+
+        # step derivatives w.r.t. (S, E, I, R, beta, alpha, gamma, nu) for all dates
+        unit = eye(8)
+        susceptible, exposed, infected, recovered = state[:-1].T
+        total = state[:-1].sum(axis=1)
+        d_total = unit[:4].sum(axis=0)
+
+        frac = susceptible / total
+        power = frac ** nu
+        d_power = (nu * frac ** (nu - 1) / total)[:, None] * (
+            unit[0] - frac[:, None] * d_total
+        )
+        d_power[:, 7] += power * log(where(frac > 0, frac, 1))
+
+        d_flow = zeros((n_dates - 1, 3, 8))
+        d_flow[:, 0] = (beta[:-1] * infected)[:, None] * d_power
+        d_flow[:, 0, 2] += beta[:-1] * power
+        d_flow[:, 0, 4] += power * infected
+        d_flow[:, 1, 1] = alpha
+        d_flow[:, 1, 5] = exposed
+        d_flow[:, 2, 2] = gamma
+        d_flow[:, 2, 6] = infected
+
+        d_updated = unit[:4] + self._flow_matrix @ d_flow
+        clamped = updated < 0
+        updated[clamped] = 0
+        d_updated[clamped] = 0
+
+        rescale = total / updated.sum(axis=1)
+        d_rescale = (
+            d_total - rescale[:, None] * d_updated.sum(axis=1)
+        ) / updated.sum(axis=1)[:, None]
+        d_state = (
+            d_updated * rescale[:, None, None]
+            + updated[:, :, None] * d_rescale[:, None]
+        )
+        d_flow = (
+            d_flow * rescale[:, None, None]
+            + (flow[1:] / rescale[:, None])[:, :, None] * d_rescale[:, None]
+        )
+
+        # chain rule with derivatives of the step parameters w.r.t. primary
+        d_step_pars = stack(
+            [d_beta[:-1]]
+            + [broadcast_to(der, d_beta[:-1].shape) for der in (d_alpha, d_gamma, d_nu)],
+            axis=1,
+        )
+        state_tangent = zeros((n_dates, 4, len(primary)))
+        state_tangent[0] = d_state_0
+        step_pars_tangent = d_state[:, :, 4:] @ d_step_pars
+        for tt in range(n_dates - 1):
+            state_tangent[tt + 1] = (
+                d_state[tt, :, :4] @ state_tangent[tt] + step_pars_tangent[tt]
+            )
+        flow_tangent = zeros((n_dates, 3, len(primary)))
+        flow_tangent[1:] = (
+            d_flow[:, :, :4] @ state_tangent[:-1] + d_flow[:, :, 4:] @ d_step_pars
+        )
+
+        columns = {key: state[:, idx] for idx, key in enumerate(compartments)}
+        columns.update({key: flow[:, idx] for idx, key in enumerate(flows)})
+        tangents = {key: state_tangent[:, idx] for idx, key in enumerate(compartments)}
+        tangents.update({key: flow_tangent[:, idx] for idx, key in enumerate(flows)})
+        return columns, tangents
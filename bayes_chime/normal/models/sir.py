@@ -1,15 +1,51 @@
 """Implementation of SIR model
 """
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
-from numpy import log, NaN
+from numpy import log, NaN, array, concatenate, empty, ndarray, outer
 from pandas import DataFrame
 
 
-from bayes_chime.normal.utilities import FloatOrDistVar, NormalDistVar
+from bayes_chime.normal.utilities import (
+    FloatLikeArray,
+    FloatOrDistVar,
+    NormalDistArray,
+    NormalDistVar,
+    exponential_census,
+    mean_and_tangent,
+)
 from bayes_chime.normal.models.base import CompartmentModel
 
 
+def sir_step(
+    susceptible: FloatOrDistVar,
+    infected: FloatOrDistVar,
+    recovered: FloatOrDistVar,
+    beta: FloatOrDistVar,
+    gamma: FloatOrDistVar,
+) -> Tuple[Tuple[FloatOrDistVar, ...], Tuple[FloatOrDistVar, ...]]:
+    """One SIR step, shared by `simulation_step` and `recurrence`.
+
+    Compartments are clamped at zero and rescaled to keep the total population.
+
+    Returns:
+        The updated compartments and the rescaled flows S->I and I->R.
+    """
+    total = susceptible + infected + recovered
+
+    d_si = beta * susceptible / total * infected
+    d_ir = gamma * infected
+
+    clamped = [
+        max(susceptible - d_si, 0),
+        max(infected + (d_si - d_ir), 0),
+        max(recovered + d_ir, 0),
+    ]
+    rescale = total / (clamped[0] + clamped[1] + clamped[2])
+
+    return tuple(val * rescale for val in clamped), (d_si * rescale, d_ir * rescale)
+
+
 class SIRModel(CompartmentModel):
     """Basic SIR model
     """
@@ -70,8 +106,25 @@ class SIRModel(CompartmentModel):
         # fill initial hosp admits if present
         df = df.fillna(0)
 
+        columns = self.post_process_arrays(
+            {col: df[col].values for col in df.columns}, **pars
+        )
+        for col, values in columns.items():
+            if col not in df.columns:
+                df[col] = values
+
+        return df
+
+    def post_process_arrays(  # pylint: disable=R0201, W0613, C0103
+        self, columns: Dict[str, ndarray], **pars: Dict[str, FloatOrDistVar]
+    ) -> Dict[str, ndarray]:
+        """Compute admits and census based on exponential LOS distribution if parameters
+        present.
+        """
         # Local infections
-        df["infected_new_local"] = df["infected_new"] * pars.get("market_share", NaN)
+        columns["infected_new_local"] = columns["infected_new"] * pars.get(
+            "market_share", NaN
+        )
 
         dependency = {
             "hospital": "infected_new_local",
@@ -80,25 +133,81 @@ class SIRModel(CompartmentModel):
         }
 
         for kind in ["hospital", "icu", "vent"]:
-            df[f"{kind}_admits"] = df[dependency[kind]].values * pars.get(
+            columns[f"{kind}_admits"] = columns[dependency[kind]] * pars.get(
                 f"{kind}_probability", NaN
             )
 
-            census = [pars.get(f"initial_{kind}", NaN)]
-            for base in df[f"{kind}_admits"].values[1:]:
-                census.append(
-                    base
-                    + (1 - 1 / pars.get(f"{kind}_length_of_stay", NaN)) * census[-1]
-                )
-            df[f"{kind}_census"] = census
+            # the initial census enters the recurrence as the first "admit"
+            admits = concatenate(
+                [[pars.get(f"initial_{kind}", NaN)], columns[f"{kind}_admits"][1:]]
+            )
+            columns[f"{kind}_census"] = exponential_census(
+                admits, pars.get(f"{kind}_length_of_stay", NaN)
+            )
 
-        return df
+        return columns
+
+    def post_process_tangent(  # pylint: disable=R0201, W0613, C0103
+        self,
+        columns: Dict[str, FloatLikeArray],
+        tangents: Dict[str, ndarray],
+        primary: NormalDistArray,
+        **pars: Dict[str, FloatOrDistVar],
+    ) -> Tuple[Dict[str, FloatLikeArray], Dict[str, ndarray]]:
+        """Computes admits and census like `post_process_arrays` and their derivatives.
+
+        The census derivative follows the same recurrence as the census, with
+        `d_admits[t] + d_decay * census[t-1]` as admits.
+        """
+        market_share, d_market_share = mean_and_tangent(
+            pars.get("market_share", NaN), primary
+        )
+        columns["infected_new_local"] = columns["infected_new"] * market_share
+        tangents["infected_new_local"] = tangents[
+            "infected_new"
+        ] * market_share + outer(columns["infected_new"], d_market_share)
+
+        dependency = {
+            "hospital": "infected_new_local",
+            "icu": "hospital_admits",
+            "vent": "icu_admits",
+        }
+
+        for kind in ["hospital", "icu", "vent"]:
+            probability, d_probability = mean_and_tangent(
+                pars.get(f"{kind}_probability", NaN), primary
+            )
+            columns[f"{kind}_admits"] = columns[dependency[kind]] * probability
+            tangents[f"{kind}_admits"] = tangents[
+                dependency[kind]
+            ] * probability + outer(columns[dependency[kind]], d_probability)
+
+            initial, d_initial = mean_and_tangent(
+                pars.get(f"initial_{kind}", NaN), primary
+            )
+            length_of_stay, d_length_of_stay = mean_and_tangent(
+                pars.get(f"{kind}_length_of_stay", NaN), primary
+            )
+            admits = concatenate([[initial], columns[f"{kind}_admits"][1:]])
+            d_admits = concatenate([[d_initial], tangents[f"{kind}_admits"][1:]])
+
+            census = exponential_census(admits, length_of_stay)
+            d_decay = d_length_of_stay / length_of_stay ** 2
+            d_admits[1:] += outer(census[:-1], d_decay)
+            columns[f"{kind}_census"] = census
+            tangents[f"{kind}_census"] = exponential_census(
+                d_admits.T, length_of_stay
+            ).T
+
+        return columns, tangents
 
     def simulation_step(
         self, data: Dict[str, NormalDistVar], **pars: Dict[str, FloatOrDistVar]
     ):
         """Executes SIR step and patches results such that each component is larger zero.
 
+        The step is `sir_step`, which `recurrence` runs as well.
+
         Arguments:
             data:
                 susceptible: Susceptible population
@@ -112,31 +221,50 @@ class SIRModel(CompartmentModel):
             Updated compartments and optionally additional information like change
             from last iteration.
         """
-        susceptible = data["susceptible"]
-        infected = data["infected"]
-        recovered = data["recovered"]
-
-        total = susceptible + infected + recovered
-
-        d_si = pars["beta"] * susceptible / total * infected
-        d_ir = pars["gamma"] * infected
+        (susceptible, infected, recovered), (d_si, d_ir) = sir_step(
+            data["susceptible"],
+            data["infected"],
+            data["recovered"],
+            pars["beta"],
+            pars["gamma"],
+        )
+        out = {
+            "susceptible": susceptible,
+            "infected": infected,
+            "recovered": recovered,
+            "infected_new": d_si,
+            "recovered_new": d_ir,
+        }
 
-        susceptible -= d_si
-        infected += d_si - d_ir
-        recovered += d_ir
+        return out
 
-        susceptible = max(susceptible, 0)
-        infected = max(infected, 0)
-        recovered = max(recovered, 0)
+    def recurrence(
+        self,
+        initial: Dict[str, NormalDistVar],
+        schedule: Dict[str, ndarray],
+        **pars: Dict[str, FloatOrDistVar],
+    ) -> Dict[str, ndarray]:
+        """Runs the step of `simulation_step` (`sir_step`) over preallocated arrays
+        for all dates, without building a dictionary per step.
+        """
+        n_dates = len(pars["dates"])
+        beta = schedule["beta"] if "beta" in schedule else [pars["beta"]] * n_dates
+        gamma = pars["gamma"]
 
-        rescale = total / (susceptible + infected + recovered)
+        compartment_keys = ["susceptible", "infected", "recovered"]
+        flow_keys = ["infected_new", "recovered_new"]
+        keys = list(initial) + flow_keys
+        out = {key: empty(n_dates, dtype=object) for key in keys}
+        state = tuple(initial[key] for key in compartment_keys)
+        for key in keys:
+            out[key][0] = initial.get(key, 0)
 
-        out = {
-            "susceptible": susceptible * rescale,
-            "infected": infected * rescale,
-            "recovered": recovered * rescale,
-            "infected_new": d_si * rescale,
-            "recovered_new": d_ir * rescale,
-        }
+        for tt in range(1, n_dates):
+            state, flow = sir_step(*state, beta[tt - 1], gamma)
+            for key, val in zip(compartment_keys, state):
+                out[key][tt] = val
+            for key, val in zip(flow_keys, flow):
+                out[key][tt] = val
 
-        return out
+        # float columns unless the inputs are normal distributed
+        return {key: array(values.tolist()) for key, values in out.items()}
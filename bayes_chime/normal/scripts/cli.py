@@ -2,7 +2,7 @@
 """Command line interface script for running a Bayesian fit from command line
 bayeschime -m -p data/Downtown_parameters.csv -d data/Downtown_ts.csv -y data/data_errors.csv -b flexible_beta
 """
-from typing import Dict, Tuple
+from typing import Dict, Optional, Tuple
 
 from argparse import ArgumentParser
 
@@ -26,17 +26,19 @@ from bayes_chime.normal.utilities import (
 )
 
 from bayes_chime.normal.models import SEIRModel
+from bayes_chime.normal.fitting import NORM_APPROXIMATIONS
 from bayes_chime.normal.scripts.utils import (
     DEBUG,
     read_parameters,
     read_data,
+    read_previous_fit,
     dump_results,
     get_logger,
     mse,
 )
+from bayes_chime.executor import RunExecutor
 import copy
 import numpy as np
-import multiprocessing as mp
 import pandas as pd
 
 
@@ -124,10 +126,34 @@ def parse_args():
         action="store_true",
         default=True,
     )
+    parser.add_argument(
+        "-u",
+        "--update",
+        help="The fit.pickle of a previous run, or its output directory."
+        " The fit then starts from the previous posterior means, e.g., to update the"
+        " fit with a new day of data.",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "-c",
+        "--prior-cache",
+        help="Json file to store normal approximations of the prior distributions in."
+        " Parameter files with known distributions are then read without fitting.",
+        type=str,
+        default=None,
+    )
     args = parser.parse_args()
     return args
 
 
+def start_values(update: Optional[str]) -> Optional[Dict[str, FloatLike]]:
+    """Start values of the fit: the posterior means of the previous fit to update,
+    if any, see `read_previous_fit`.
+    """
+    return read_previous_fit(update).pmean if update else None
+
+
 def logistic_social_policy(
     date: Date, **kwargs: Dict[str, FloatOrDistVar]
 ) -> Dict[str, FloatOrDistVar]:
@@ -149,6 +175,19 @@ def logistic_social_policy(
     return ppars
 
 
+def logistic_social_policy_schedule(
+    days: np.ndarray, **kwargs: Dict[str, FloatOrDistVar]
+) -> Dict[str, np.ndarray]:
+    """Computes `logistic_social_policy` beta for all days since the first date at once
+    """
+    return {
+        "beta": kwargs["beta"]
+        * one_minus_logistic_fcn(
+            days, L=kwargs["logistic_L"], k=kwargs["logistic_k"], x0=kwargs["logistic_x0"],
+        )
+    }
+
+
 def flexible_beta(
         date: Date, **kwargs: Dict[str, FloatOrDistVar]
 ) -> Dict[str, FloatOrDistVar]:
@@ -162,6 +201,18 @@ def flexible_beta(
     return ppars
 
 
+def flexible_beta_schedule(
+    days: np.ndarray, **kwargs: Dict[str, FloatOrDistVar]
+) -> Dict[str, np.ndarray]:
+    """Computes `flexible_beta` beta for all days since the first date at once
+    """
+    knots = np.array(kwargs['knots'])
+    xx = np.where(days > max(knots), max(knots) + 1, days)
+    X = np.clip(xx[:, None] - knots, 0, None)**kwargs['spline_power']
+    beta = kwargs["beta"] * (1-1/(1+np.exp(kwargs['beta_intercept'] + X@kwargs['beta_splines'])))
+    return {"beta": beta}
+
+
 def power_spline(x, knots, n):
     if x > max(knots): #trim the ends of the spline to prevent nonsense extrapolation
         x = max(knots)+1
@@ -244,63 +295,108 @@ def get_yy(data: DataFrame, **err: Dict[str, FloatLike]) -> NormalDistArray:
 
 
 
-def xval_wrapper(pen, win, parameter_file_path, splines, spline_power, 
-                 data_file_path, data_error_file_path, k):
-    try:
-        parameters = read_parameters(parameter_file_path)
-        data = read_data(data_file_path)
-        tr = data[:win]
-        val = data[win:(win+7)]
+def xval_window(win, penalties, parameters, splines, spline_power,
+                data, error_infos):
+    """Fits one cross-validation window for all penalties and scores the forecast of
+    the following week.
 
-        mi = SEIRModel(
-            fit_columns=["hospital_census", "vent_census"],
-            update_parameters=flexible_beta
-        )
-        xx, pp = prepare_model_parameters(parameters = parameters, data = tr, 
-                                          beta_fun = 'flexible_beta', splines = splines,
-                                          spline_power = spline_power)      
-        pp['beta_splines'] = gvar([0 for i in range(k)], [pen for i in range(k)])
-        mi.fit_start_date = xx["day0"]
-        xx["error_infos"] = (
-            read_csv(data_error_file_path).set_index("param")["value"].to_dict()
-        )
-        fit = nonlinear_fit(
-            data=(xx, get_yy(tr, **xx["error_infos"])),
-            prior=pp,
-            fcn=mi.fit_fcn,
-            debug=False,
-        )        
-        # detect and handle degenerate fits
-        # THIS IS A TEMPORARY HACK
-        splinecoefvec = np.array([fit.p['beta_splines'][i].mean for i in range(len(fit.p['beta_splines']))])
-        cv = np.std(splinecoefvec)/np.mean(splinecoefvec)
-        if cv < .1:
-            MSE = -9999
-            error = "degenerate fit"
-        else:
-            xx = fit.x.copy()
-            xx["dates"] = xx["dates"].union(
-                date_range(xx["dates"].max(), freq="D", periods=8)
+    Penalties (the prior sd of the spline coefficients) are fitted in increasing order
+    and each fit starts from the parameters of the previous one.
+    """
+    tr = data[:win]
+    val = data[win:(win+7)]
+
+    mi = SEIRModel(
+        fit_columns=["hospital_census", "vent_census"],
+        update_parameters=flexible_beta,
+        parameter_schedule=flexible_beta_schedule,
+        vectorized=True,
+        forward_jacobian=True,
+    )
+    xx, pp = prepare_model_parameters(parameters = parameters, data = tr,
+                                      beta_fun = 'flexible_beta', splines = splines,
+                                      spline_power = spline_power)
+    mi.fit_start_date = xx["day0"]
+    xx["error_infos"] = error_infos
+    yy = get_yy(tr, **xx["error_infos"])
+    # the forecast covers the validation week
+    xx_forecast = xx.copy()
+    xx_forecast["dates"] = xx["dates"].union(
+        date_range(xx["dates"].max(), freq="D", periods=8)
+    )
+
+    p0 = None
+    results = []
+    for pen in sorted(penalties):
+        try:
+            pp['beta_splines'] = gvar(np.zeros(len(splines)), pen*np.ones(len(splines)))
+            fit = nonlinear_fit(
+                data=(xx, yy),
+                prior=pp,
+                p0=p0,
+                fcn=mi.fit_fcn,
+                debug=False,
             )
-            prediction_df = mi.propagate_uncertainties(xx, fit.p) 
-            prediction_df.index = prediction_df.index.round("H")
-            mg = val.merge(prediction_df, left_index = True, right_index = True)
-            # scaling
-            hosp = (mg.hosp-np.mean(mg.hosp))/np.std(mg.hosp)
-            hosp_hat = (mg.hospital_census.apply(lambda x: x.mean)-np.mean(mg.hosp))/np.std(mg.hosp)
-            vent = (mg.vent-np.mean(mg.vent))/np.std(mg.vent)
-            vent_hat = (mg.vent_census.apply(lambda x: x.mean)-np.mean(mg.vent))/np.std(mg.vent)
-            MSE = mse(hosp, hosp_hat) + mse(vent, vent_hat) 
-            error = ""
-        return dict(mse = MSE,
-                    pen = pen,
-                    win = win, 
-                    error = error)
-    except Exception as e:
-        return dict(mse = -9999,
-                    pen = pen,
-                    win = win, 
-                    error = e)
+            p0 = fit.pmean
+            # detect and handle degenerate fits
+            # THIS IS A TEMPORARY HACK
+            splinecoefvec = fit.pmean['beta_splines']
+            cv = np.std(splinecoefvec)/np.mean(splinecoefvec)
+            if cv < .1:
+                MSE = -9999
+                error = "degenerate fit"
+            else:
+                prediction_df = mi.simulate(xx_forecast, fit.pmean).to_frame()
+                prediction_df.index = prediction_df.index.round("H")
+                mg = val.merge(prediction_df, left_index = True, right_index = True)
+                # scaling, constant series (e.g., no vents) are only centered
+                hosp_sd = np.std(mg.hosp) or 1.
+                vent_sd = np.std(mg.vent) or 1.
+                hosp = (mg.hosp-np.mean(mg.hosp))/hosp_sd
+                hosp_hat = (mg.hospital_census-np.mean(mg.hosp))/hosp_sd
+                vent = (mg.vent-np.mean(mg.vent))/vent_sd
+                vent_hat = (mg.vent_census-np.mean(mg.vent))/vent_sd
+                MSE = mse(hosp, hosp_hat) + mse(vent, vent_hat)
+                error = ""
+        except Exception as e:
+            MSE = -9999
+            error = e
+        results.append(dict(mse = MSE,
+                            pen = pen,
+                            win = win,
+                            error = error))
+    return results
+
+
+def cross_validate(penalties, windows, parameters, splines, spline_power,
+                   data, error_infos, executor):
+    """Rolling-window cross-validation of the spline penalty
+
+    Runs one task per window on the executor, see `xval_window`.
+
+    Returns:
+        One row per penalty and window with the mse, rmse and error message of the
+        fit. Failed or degenerate fits have mse -9999 and no rmse.
+    """
+    results = executor.starmap(
+        xval_window,
+        [(win, penalties, parameters, splines, spline_power, data, error_infos)
+         for win in windows]
+    )
+    xval_df = pd.DataFrame([res for window in results for res in window])
+    xval_df['rmse'] = xval_df.mse.where(xval_df.mse > 0)**.5
+    return xval_df
+
+
+def select_penalty(xval_df: DataFrame) -> float:
+    """Selects the penalty with the lowest mean rmse over the windows
+
+    Failed and degenerate fits are left out, see `cross_validate`.
+    """
+    xval_df = xval_df.loc[xval_df.mse > 0]
+    penframe = xval_df.groupby(['pen']).agg({'rmse': ['mean', 'std']}, as_index=False).reset_index()
+    penframe.columns = ['pen', 'mu', 'sig']
+    return penframe.pen.loc[penframe.mu == min(penframe.mu)].iloc[0]
 
 
 def main():
@@ -315,7 +411,10 @@ def main():
         error_file_path = 'data/data_errors.csv'
         model = SEIRModel(
             fit_columns=["hospital_census", "vent_census"],
-            update_parameters=flexible_beta
+            update_parameters=flexible_beta,
+            parameter_schedule=flexible_beta_schedule,
+            vectorized=True,
+            forward_jacobian=True,
         )
         xval = True
         k = 10
@@ -326,6 +425,7 @@ def main():
         win = 40
         pen = .002
         beta_fun = 'flexible_beta'
+        p0 = None
         pd.options.display.max_rows = 4000
         pd.options.display.max_columns = 4000
     else:
@@ -345,16 +445,26 @@ def main():
     
         LOGGER.debug("Received arguments:\n%s", args)
     
+        if args.prior_cache:
+            NORM_APPROXIMATIONS.open(args.prior_cache)
         parameters = read_parameters(parameter_file_path)
         LOGGER.debug("Read parameters:\n%s", parameters)
     
         data = read_data(data_file_path)
         LOGGER.debug("Read data:\n%s", data)
 
+        # start values of the fit
+        p0 = start_values(args.update)
+        LOGGER.debug("Start values:\n%s", p0)
+
         model = SEIRModel(
             fit_columns=["hospital_census", "vent_census"],
             update_parameters=flexible_beta if beta_fun == "flexible_beta" \
                                             else logistic_social_policy,
+            parameter_schedule=flexible_beta_schedule if beta_fun == "flexible_beta" \
+                                            else logistic_social_policy_schedule,
+            vectorized=True,
+            forward_jacobian=True,
         )
 
 
@@ -376,29 +486,16 @@ def main():
         penvec = 10**np.linspace(-10, 5, 16)
 
         winstart = list(range(data.shape[0]-14, (data.shape[0]-7)))
-        tuples_for_starmap = [(p,
-                               w,
-                               parameter_file_path,
-                               splines, 
-                               k, 
-                               data_file_path, 
-                               error_file_path, 
-                               k) for p in penvec for w in winstart]
-        
-        pool = mp.Pool(mp.cpu_count())
-        xval_results = pool.starmap(xval_wrapper, tuples_for_starmap)
-        pool.close()
-        xval_df = pd.DataFrame(xval_results)
+        # the inputs are parsed once and shipped to each worker once
+        error_infos = read_csv(error_file_path).set_index("param")["value"].to_dict()
+        with RunExecutor(parameters=parameters, data=data,
+                         error_infos=error_infos) as executor:
+            xval_df = cross_validate(penvec, winstart, parameters, splines,
+                                     spline_power, data, error_infos, executor)
         # remove errors
         errors = (xval_df.mse == -9999).sum()
         # assert errors < xval_df.shape[0]*.2, "Lot's of errors when doing cross-validation.  Breaking here rather than returning unreliable results."
-        xval_df = xval_df.loc[xval_df.mse >0]
-        xval_df['rmse'] = xval_df.mse**.5
-        penframe = xval_df.groupby(['pen']).agg({'rmse':['mean', 'std']}, as_index = False).reset_index()
-        penframe.columns = ['pen', 'mu', 'sig']
-
-        
-        best_penalty = penframe.pen.loc[penframe.mu == min(penframe.mu)].iloc[0]
+        best_penalty = select_penalty(xval_df)
         print(f"The best prior sd on the splines is {best_penalty}.  Don't forget to look at the plot of cross-validation statistics (in the output directory) to make sure that there's nothing wacky going on.")
         parameters['pen_beta'] = gvar(0,best_penalty)
 
@@ -423,6 +520,7 @@ def main():
             fit = nonlinear_fit(
                 data=(xx, get_yy(data, **xx["error_infos"])),
                 prior=pp,
+                p0=p0,
                 fcn=model.fit_fcn,
                 # debug=args.verbose,
             )
@@ -433,6 +531,7 @@ def main():
             fit_kwargs = lambda error_infos: dict(
                 data=(xx, get_yy(data, hosp_rel=0, vent_rel=0, **error_infos)),
                 prior=pp,
+                p0=p0,
                 fcn=model.fit_fcn,
                 debug=args.verbose,
             )
@@ -1,19 +1,24 @@
 """Utility function for command line script
 """
-from typing import Dict, TypeVar
+from typing import Dict, Optional, TypeVar
 
 from os import path, makedirs
+from glob import glob
 
 from datetime import datetime
 from logging import getLogger, StreamHandler, Formatter, DEBUG, INFO
 
 from pandas import read_csv, DataFrame, date_range, Series
 
-from gvar import dump, mean, sdev
+from gvar import dump, load, mean, sdev
 
 from bayes_chime.normal.utilities import FloatOrDistVar
 from bayes_chime.normal.models.base import CompartmentModel
-from bayes_chime.normal.fitting import fit_norm_to_prior_df
+from bayes_chime.normal.fitting import (
+    NORM_APPROXIMATIONS,
+    NormalApproximationCache,
+    fit_norm_to_prior_df,
+)
 from bayes_chime.normal.plotting import plot_fit
 import numpy as np
 
@@ -48,15 +53,18 @@ def get_logger(name: str):
     return logger
 
 
-def read_parameters(file_name: str) -> Dict[str, FloatOrDistVar]:
+def read_parameters(
+    file_name: str, cache: Optional[NormalApproximationCache] = NORM_APPROXIMATIONS
+) -> Dict[str, FloatOrDistVar]:
     """Reads in parameter file, fits a normal distribution and returns parameters needed
     for normal module.
 
     Arguments:
         file_name: Path to the parameter file
+        cache: Normal approximations to look up and add to, see `fit_norm_to_prior_df`
     """
     df = read_csv(file_name)
-    parameters = fit_norm_to_prior_df(df)
+    parameters = fit_norm_to_prior_df(df, cache)
     return {PARAMETER_MAP.get(key, key): val for key, val in parameters.items()}
 
 
@@ -83,6 +91,22 @@ def read_data(file_name: str) -> DataFrame:
     return df
 
 
+def read_previous_fit(file_name: str) -> Fit:
+    """Reads the fit of a previous run from the pickle file written by `dump_results`.
+
+    Arguments:
+        file_name: Path to the `fit.pickle` file or to a directory containing it
+            (e.g., the output directory of the previous run). Directories are searched
+            recursively and the most recent file is used.
+    """
+    if path.isdir(file_name):
+        candidates = glob(path.join(file_name, "**", "fit.pickle"), recursive=True)
+        if not candidates:
+            raise FileNotFoundError(f"Could not locate fit.pickle in {file_name}.")
+        file_name = max(candidates, key=path.getmtime)
+    return load(file_name)["fit"]
+
+
 def dump_results(
     output_dir: str, fit: Fit, model: CompartmentModel, extend_days: int = 30
 ):
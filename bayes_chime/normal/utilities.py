@@ -1,8 +1,11 @@
 """Utilities for the normal CHIME Bayes module
 """
-from typing import TypeVar, Union
+from typing import Tuple, TypeVar, Union
 
-from numpy import exp
+from numpy import exp, array, asarray, ndarray, ndindex, zeros
+
+from gvar import deriv, mean
+from gvar._gvarcore import GVar  # pylint: disable=E0611
 
 FloatLike = TypeVar("FloatLike")  # Floats or integers
 FloatLikeArray = TypeVar("FloatLikeArray")  # Arrays of floats or integers
@@ -28,3 +31,62 @@ def one_minus_logistic_fcn(  # pylint: disable=C0103
     """Computes `1 - L / (1 + exp(-k(x-x0)))`.
     """
     return 1 - logistic_fcn(x, L, k, x0)
+
+
+def exponential_census(
+    admits: FloatOrDistArray, length_of_stay: FloatOrDistArray
+) -> FloatOrDistArray:
+    """Computes census from admits assuming an exponentially distributed length of stay.
+
+    Evaluates the first order recurrence `c[t] = a[t] + (1 - 1 / los) * c[t-1]` with
+    `c[-1] = 0` along the last axis of `admits`. Leading axes are a batch (e.g., draws or
+    kinds) and `length_of_stay` broadcasts against them. A non-zero initial census can be
+    set by passing it as the first admits entry.
+
+    Float input is evaluated with log2(n_days) array operations (a doubling scan which
+    stays stable for short stays). Object arrays, e.g., gvars, use the plain recurrence.
+    """
+    admits = asarray(admits)
+    decay = 1 - 1 / asarray(length_of_stay)[..., None]
+    is_object = object in (admits.dtype, decay.dtype)
+    census = array(admits, dtype=object if is_object else float)
+
+    if is_object:
+        decay = decay[..., 0]
+        for tt in range(1, census.shape[-1]):
+            census[..., tt] = census[..., tt] + decay * census[..., tt - 1]
+        return census
+
+    shift = 1
+    while shift < census.shape[-1]:
+        census[..., shift:] = census[..., shift:] + decay * census[..., :-shift]
+        decay = decay * decay
+        shift *= 2
+    return census
+
+
+def mean_and_tangent(
+    value: FloatOrDistArray, primary: NormalDistArray
+) -> Tuple[FloatLikeArray, ndarray]:
+    """Splits value into its mean and its derivatives with respect to primary gvars.
+
+    Arguments:
+        value: Float, gvar or array of both
+        primary: The primary gvars
+
+    Returns:
+        Mean of value and array of derivatives with shape `value.shape + (n_primary,)`.
+        Floats have zero derivatives.
+    """
+    values = asarray(value)
+    if values.dtype != object:
+        return value, zeros(values.shape + (len(primary),))
+
+    if all(isinstance(val, GVar) for val in values.flat):
+        return mean(value), deriv(value, primary)
+
+    tangent = zeros(values.shape + (len(primary),))
+    for idx in ndindex(values.shape):
+        if isinstance(values[idx], GVar):
+            tangent[idx] = deriv(values[idx], primary)
+    return mean(value), tangent
@@ -0,0 +1,71 @@
+"""Tests for the run-scoped process pool
+* Checks that shared inputs and shared arrays reach the workers by reference
+* Checks that starmap returns results in task order
+* Checks that close releases the shared memory
+"""
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+import pytest
+
+from bayes_chime.executor import RunExecutor
+
+
+def row_of(array, row):
+    """Task returning a row of `array` and whether the worker could write to it"""
+    return array[row].tolist(), array.flags.writeable
+
+
+def lookup(table, key):
+    """Task reading a shared input"""
+    return table[key]
+
+
+def slow_square(x, n_tasks):
+    """Task finishing later the earlier it was submitted"""
+    time.sleep(0.02 * (n_tasks - x))
+    return x * x
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_share_array(processes):
+    """Checks that workers see shared arrays read-only, and shared inputs unchanged
+    """
+    table = dict(a=1, b=[2, 3])
+    array = np.arange(12.0).reshape(3, 4)
+    with RunExecutor(processes=processes, table=table) as executor:
+        shared = executor.share_array(array)
+        rows = executor.starmap(row_of, [(shared, i) for i in range(3)])
+        values = executor.starmap(lookup, [(table, "a"), (table, "b")])
+
+    assert [row for row, _ in rows] == array.tolist()
+    if processes > 1:
+        # a view of the shared memory segment, not a pickled copy
+        assert not any(writeable for _, writeable in rows)
+    assert values == [1, [2, 3]]
+
+
+def test_starmap_order():
+    """Checks that results come back in task order, not completion order
+    """
+    with RunExecutor(processes=2) as executor:
+        results = executor.starmap(slow_square, [(x, 6) for x in range(6)])
+    assert results == [x * x for x in range(6)]
+
+
+def test_close_unlinks():
+    """Checks that close stops the pool and removes the shared memory segments
+    """
+    executor = RunExecutor(processes=2)
+    shared = executor.share_array(np.ones(5))
+    names = [segment.name for segment in executor._segments]  # pylint: disable=W0212
+    assert len(names) == 1
+    assert executor.starmap(row_of, [(shared, 0)]) == [(1.0, False)]
+
+    executor.close()
+    assert executor._pool is None  # pylint: disable=W0212
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=names[0])
+    # closing twice is harmless
+    executor.close()
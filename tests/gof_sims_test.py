@@ -0,0 +1,385 @@
+"""Tests for the chains of _01_GOF_sims
+* Checks that the likelihood simulates only the days it reads, deterministically
+* Checks that trajectories and their bands span the requested horizon, and that the
+  plot horizons are trimmed to it
+* Checks that an interrupted chain resumed from its checkpoint matches an
+  uninterrupted one
+* Checks that the delayed-acceptance emulator is ready after its minimum burn-in, and
+  that its acceptance tests do not overflow
+* Checks the layout of the ensemble sampler's output
+* Checks the temperature ladder and swap rates of the tempered sampler, and that its
+  replicas leave failed states
+* Checks that chains are extended in rounds until the convergence targets are met
+* Checks that the successive-halving penalty search runs fewer iterations than the grid
+* Checks that chains streamed to the binary chain store read back unchanged, but
+  for s, e, i and r before the offset
+* Checks that an update run starts from the last state of every previous chain
+"""
+import warnings
+from os import path
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+import _01_GOF_sims
+from _02_munge_chains import plot_horizons, trajectory_bands
+from _01_GOF_sims import (chain, do_chains, ensemble_chain, eval_pos, get_inputs,
+                          get_test_loss,
+                          last_states, successive_halving, tempered_chain,
+                          tempered_log_ratio)
+from _99_shared_functions import ParamSchema, QuadraticEmulator, projection_days, read_chains
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+
+
+@pytest.fixture(name="inputs")
+def fixture_inputs(monkeypatch):
+    """Census and parameters of HUP, read the way the script reads them
+    """
+    monkeypatch.chdir(ROOT)
+    return get_inputs(SimpleNamespace(prefix="HUP", parameters=None, ts=None))
+
+
+def run_chain(inputs, n_iters=60, burn_in=20, sampler=chain, **kwargs):
+    """A short chain of `sampler` on `inputs`, projecting 60 days
+    """
+    census_ts, params = inputs
+    return sampler(1, params, census_ts, n_iters, .25, 0, dict(mu=0, sig=-1), False,
+                   False, burn_in=burn_in, n_days=60, **kwargs)
+
+
+@pytest.mark.parametrize("sig, extra_days", [(-1, 0), (50, 7)])
+def test_eval_pos_fit_mode(inputs, monkeypatch, sig, extra_days):
+    """Checks that eval_pos simulates the observed days (and the forecast week with a
+    forecast prior) without the stochastic projection, and scores proposals like a
+    full projection would, whatever the random generator
+    """
+    census_ts, params = inputs
+    schema = ParamSchema(params)
+    pos = np.random.default_rng(0).uniform(size=(5, schema.size))
+    forecast_priors = dict(mu=0, sig=sig)
+
+    def evaluate(rng):
+        return eval_pos(pos, schema, census_ts, None, None, 0, False, forecast_priors,
+                        False, rng=np.random.default_rng(rng))
+
+    fit = evaluate(1)
+    n_obs = census_ts.shape[0]
+    assert fit["draw"]["arr"].shape == (5, n_obs + extra_days + 1, 6)
+    assert fit["draw"]["arr_stoch"] is None
+    # random positions may be impossible under the forecast prior, not all of them
+    assert np.isfinite(fit["posterior"]).any()
+    np.testing.assert_array_equal(evaluate(2)["posterior"], fit["posterior"])
+
+    SIR_from_params = _01_GOF_sims.SIR_from_params
+
+    def full_projection(*args, **kwargs):
+        kwargs.update(n_days=300, stochastic=True)
+        return SIR_from_params(*args, **kwargs)
+
+    monkeypatch.setattr(_01_GOF_sims, "SIR_from_params", full_projection)
+    full = evaluate(1)
+    assert full["draw"]["arr"].shape == (5, 301, 6)
+    np.testing.assert_allclose(full["posterior"], fit["posterior"], rtol=1e-12)
+
+
+@pytest.mark.parametrize("horizon", [20, 45])
+def test_projection_horizon(inputs, horizon):
+    """Checks that a chain run with a horizon keeps the census series plus the horizon,
+    and that the plots only ask for days the chain kept
+    """
+    census_ts, params = inputs
+    nobs = census_ts.shape[0]
+    n_days = projection_days(nobs, horizon)
+    assert n_days == nobs + horizon
+    assert projection_days(nobs) == 300
+
+    df = chain(1, params, census_ts, 40, .25, 0, dict(mu=0, sig=-1), False, False,
+               burn_in=20, n_days=n_days)
+    assert {len(arr) for arr in df.arr} == {n_days + 1}
+    for bands in [df.attrs["bands"], trajectory_bands(df)]:
+        assert bands["arr"].quantiles([.5]).shape == (1, n_days + 1, 6)
+        assert bands["seir"].quantiles([.5]).shape == (1, n_days + 1, 4)
+
+    howfar = plot_horizons([30, 90, 180], horizon)
+    assert howfar == ([horizon] if horizon < 30 else [30])
+    assert all(nobs + h <= n_days for h in howfar)
+
+
+class Interrupted(Exception):
+    """Stands for the run being killed"""
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        dict(adaptive=False),
+        dict(adaptive=True),
+        dict(sampler=ensemble_chain, n_walkers=8),
+        dict(sampler=tempered_chain, n_temps=3),
+    ],
+)
+def test_resume_from_checkpoint(inputs, monkeypatch, tmp_path, kwargs):
+    """Checks that a chain killed after a checkpoint resumes to the same output
+    """
+    expected = run_chain(inputs, **kwargs)
+
+    checkpoint = str(tmp_path / "chain.pkl")
+    save_checkpoint = _01_GOF_sims.save_checkpoint
+
+    def save_and_die(*args):
+        save_checkpoint(*args)
+        raise Interrupted()
+
+    monkeypatch.setattr(_01_GOF_sims, "save_checkpoint", save_and_die)
+    with pytest.raises(Interrupted):
+        run_chain(inputs, checkpoint=checkpoint, checkpoint_every=25, **kwargs)
+    assert path.exists(checkpoint)
+
+    monkeypatch.setattr(_01_GOF_sims, "save_checkpoint", save_checkpoint)
+    resumed = run_chain(inputs, checkpoint=checkpoint, checkpoint_every=25, **kwargs)
+
+    assert_frame_equal(resumed, expected)
+    # the same trajectories, up to the last bit of numpy's vectorized sums
+    for key in ["arr", "seir"]:
+        np.testing.assert_allclose(resumed.attrs["bands"][key].quantiles([.5]),
+                                   expected.attrs["bands"][key].quantiles([.5]),
+                                   rtol=1e-12)
+
+
+def test_delayed_acceptance_burn_in(inputs):
+    """Checks that the emulator covers the free parameters only, and screens
+    proposals after the documented minimum burn-in
+    """
+    schema = ParamSchema(inputs[1])
+    assert len(schema.free) < schema.size
+    burn_in = 2 * QuadraticEmulator(schema.free).n_coef
+    df = run_chain(inputs, n_iters=burn_in + 100, burn_in=burn_in,
+                   delayed_acceptance=True, project=False)
+    assert df.attrs["sampler"]["full_evals_saved"] > 0
+
+
+def test_delayed_acceptance_overflow(inputs, monkeypatch):
+    """Checks that a large emulated posterior gap neither overflows nor stops
+    the chain
+    """
+    class SteepEmulator(QuadraticEmulator):
+        def __call__(self, pos):
+            return 1e4 * super().__call__(pos)
+
+    monkeypatch.setattr(_01_GOF_sims, "QuadraticEmulator", SteepEmulator)
+    burn_in = 2 * QuadraticEmulator(ParamSchema(inputs[1]).free).n_coef
+    # the chain catches exceptions, so record the warnings instead of raising them
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always", RuntimeWarning)
+        df = run_chain(inputs, n_iters=burn_in + 100, burn_in=burn_in,
+                       delayed_acceptance=True, project=False)
+    assert not [w for w in caught if "overflow" in str(w.message)]
+    assert df.attrs["sampler"]["full_evals_saved"] > 0
+    assert len(df) == 99
+    assert np.isfinite(df.posterior).all()
+
+
+def test_ensemble_chain(inputs):
+    """Checks that every walker is a chain of the thinned post-burn-in iterations,
+    within the prior support
+    """
+    df = run_chain(inputs, n_iters=61, burn_in=20, sampler=ensemble_chain, n_walkers=7,
+                   thin=4)
+
+    # the ensemble is rounded up to an even number of walkers
+    assert sorted(df.chain.unique()) == list(range(8))
+    for _, walker in df.groupby("chain"):
+        assert walker.iter.tolist() == list(range(21, 61, 4))
+    assert len(df.attrs["sampler"]) == 1
+    assert 0 < df.attrs["sampler"][0]["accept_rate"] <= 1
+    for name in ["hosp_prop", "ICU_prop", "logistic_L"]:
+        assert ((df[name] > 0) & (df[name] < 1)).all()
+    assert len(df.attrs["bands"]["arr"]) == len(df)
+
+
+def test_tempered_chain(inputs):
+    """Checks that only the T=1 replica is kept, on a geometric ladder up to
+    max_temp
+    """
+    df = run_chain(inputs, sampler=tempered_chain, n_temps=4, max_temp=27.0)
+
+    assert df.chain.unique().tolist() == [1]
+    assert df.iter.tolist() == list(range(21, 60))
+    sampler = df.attrs["sampler"]
+    np.testing.assert_allclose(sampler["temperatures"], [1, 3, 9, 27])
+    assert len(sampler["swap_rates"]) == 3
+    assert ((sampler["swap_rates"] >= 0) & (sampler["swap_rates"] <= 1)).all()
+    assert sampler["evaluations"] == 4 * 39
+    assert 0 < sampler["accept_rate"] <= 1
+
+
+def test_tempered_log_ratio():
+    """Checks that a replica in a failed state accepts any proposal that
+    evaluates and none that fails, without nan
+    """
+    inf = np.inf
+    betas = np.array([1, .5, .25, .1])
+    log_ratio = tempered_log_ratio(np.array([-1., -1., -inf, -inf]),
+                                   np.array([-10., -10., -inf, -inf]),
+                                   np.array([-2., -inf, -2., -inf]),
+                                   np.array([-20., -inf, -20., -inf]), betas)
+    np.testing.assert_array_equal(log_ratio, [1 + 10, inf, -inf, -inf])
+
+
+def test_tempered_chain_failed_start(inputs, monkeypatch):
+    """Checks that replicas which all start in failed states move on"""
+    eval_pos = _01_GOF_sims.eval_pos
+    calls = []
+
+    def fail_first(pos, *args, **kwargs):
+        out = eval_pos(pos, *args, **kwargs)
+        if not calls:
+            out["posterior"] = np.full(len(pos), np.nan)
+        calls.append(1)
+        return out
+
+    monkeypatch.setattr(_01_GOF_sims, "eval_pos", fail_first)
+    df = run_chain(inputs, sampler=tempered_chain, n_temps=4, max_temp=27.0)
+
+    assert np.isfinite(df.posterior).all()
+    sampler = df.attrs["sampler"]
+    assert ((sampler["swap_rates"] >= 0) & (sampler["swap_rates"] <= 1)).all()
+    assert 0 < sampler["accept_rate"] <= 1
+
+
+@pytest.mark.parametrize("rhat_target, n_rounds", [(1e6, 1), (0.5, 3)])
+def test_rounds(inputs, monkeypatch, tmp_path, rhat_target, n_rounds):
+    """Checks that the chains stop after the round that meets the target, or at
+    max_iters, and that the temporary checkpoints are removed
+    """
+    checkpoint_dir = tmp_path / "checkpoints"
+    checkpoint_dir.mkdir()
+    monkeypatch.setattr(_01_GOF_sims, "mkdtemp", lambda: str(checkpoint_dir))
+    census_ts, params = inputs
+    df = do_chains(40, params, census_ts, .25, False, 0, 2, dict(mu=0, sig=-1), False,
+                   False, burn_in=10, n_days=census_ts.shape[0] + 7,
+                   rhat_target=rhat_target, max_iters=100)
+
+    n_iters = min(40 * n_rounds, 100)
+    convergence = df.attrs["convergence"]
+    assert convergence["converged"] == (n_rounds == 1)
+    assert convergence["n_iters"] == n_iters
+    assert set(convergence["diagnostics"].param) >= {"hosp_prop", "hosp_census_day_7"}
+    for _, retained in df.groupby("chain"):
+        assert retained.iter.tolist() == list(range(11, n_iters))
+    assert not checkpoint_dir.exists()
+
+
+def test_successive_halving(inputs, monkeypatch, tmp_path):
+    """Checks that the penalties are halved every round, that the finalist's
+    chains are resumed rather than restarted, and that fewer iterations than
+    the full grid are run
+    """
+    checkpoint_dir = tmp_path / "checkpoints"
+    checkpoint_dir.mkdir()
+    monkeypatch.setattr(_01_GOF_sims, "mkdtemp", lambda: str(checkpoint_dir))
+    census_ts, params = inputs
+    pen_vec = [.05, .2, .35, .5]
+    losses, total_iters = successive_halving(pen_vec, 40, 2, 7, params, census_ts,
+                                             dict(mu=0, sig=-1), False, burn_in=10)
+
+    # budgets of 10, 20 and 40 iterations for 4, 2 and 1 penalties
+    assert total_iters == 2 * (10 + 10 + 20 + 40) < 2 * len(pen_vec) * 40
+    assert set(losses) == set(pen_vec)
+    # a chain of n iterations has n - 1 test losses, less the warm-up
+    assert sorted(len(x) for x in losses.values()) == [2 * 4, 2 * 4, 2 * 9, 2 * 29]
+    best = max(losses, key=lambda j: len(losses[j]))
+    expected = []
+    for i in range(2):
+        # the finalist's chains are extended from their checkpoints, not restarted
+        checkpoint = str(tmp_path / f"{i}.pkl")
+        for budget in [10, 20, 40]:
+            test_loss = get_test_loss(budget, i, 7, best, params, census_ts,
+                                      dict(mu=0, sig=-1), False, 0, checkpoint)
+        expected += test_loss.tolist()[10:]
+    np.testing.assert_array_equal(losses[best], expected)
+    assert not checkpoint_dir.exists()
+
+
+def test_chain_store(inputs, tmp_path):
+    """Checks that read_chains returns what the chains kept, also when selecting
+    iterations and columns, but s, e, i and r only from the offset on
+    """
+    census_ts, params = inputs
+    chains = [
+        chain(seed, params, census_ts, 50, .25, 0, dict(mu=0, sig=-1), False, False,
+              burn_in=10, n_days=60, checkpoint_every=15,
+              store_dir=str(tmp_path / f"chain_{seed}"))
+        for seed in [1, 2]
+    ]
+    expected = pd.concat(chains, ignore_index=True)
+    # a chain that keeps nothing leaves an empty store
+    empty = chain(3, params, census_ts, 10, .25, 0, dict(mu=0, sig=-1), False, False,
+                  burn_in=10, n_days=60, store_dir=str(tmp_path / "chain_3"))
+    assert len(empty) == 0
+    assert path.getsize(tmp_path / "chain_3" / "records.bin") == 0
+
+    df = read_chains(str(tmp_path))
+    assert list(df.columns) == list(expected.columns)
+    trajectories = ["arr", "s", "e", "i", "r"]
+    assert_frame_equal(df.drop(columns=trajectories), expected.drop(columns=trajectories))
+    for row, exp in zip(df.itertuples(), expected.itertuples()):
+        np.testing.assert_allclose(row.arr, exp.arr, rtol=1e-6)
+        for k in "seir":
+            # stored from the offset on, nan before: the days before are lost
+            assert row.offset > 0
+            stored, full = getattr(row, k), getattr(exp, k)
+            assert np.isnan(stored[:row.offset]).all()
+            np.testing.assert_allclose(stored[row.offset:],
+                                       full[row.offset:row.offset + 61], rtol=1e-6)
+
+    selected = read_chains(str(tmp_path), columns=["iter", "chain", "hosp_prop", "arr"],
+                           iters=slice(20, None, 5))
+    assert list(selected.columns) == ["iter", "chain", "hosp_prop", "arr"]
+    assert selected.iter.tolist() == [20, 25, 30, 35, 40, 45] * 2
+    rows = expected.set_index(["chain", "iter"]).loc[zip(selected.chain, selected.iter)]
+    np.testing.assert_array_equal(selected.hosp_prop, rows.hosp_prop)
+
+    listed = read_chains(str(tmp_path), columns=["iter"], iters=[11, 49])
+    assert listed.iter.tolist() == [11, 49, 11, 49]
+
+
+@pytest.mark.parametrize("store", ["chains", "json"])
+def test_last_states(inputs, tmp_path, store):
+    """Checks that last_states returns the quantiles of every chain's final
+    state, with the base value for parameters the previous run did not have
+    """
+    census_ts, params = inputs
+    outdir = tmp_path / "output"
+    chains = [
+        chain(seed, params, census_ts, 30, .25, 0, dict(mu=0, sig=-1), False, False,
+              burn_in=10, n_days=60, project=False,
+              store_dir=str(outdir / "chains" / f"chain_{seed}") if store == "chains" else None)
+        for seed in [2, 1]
+    ]
+    df = pd.concat(chains, ignore_index=True)
+    if store == "json":
+        outdir.mkdir()
+        df.drop(columns="hosp_prop").to_json(outdir / "chains.json.bz2", orient="records",
+                                             lines=True)
+
+    schema = ParamSchema(params)
+    final = pd.concat([chains[1].tail(1), chains[0].tail(1)])
+    if store == "json":
+        final = final.drop(columns="hosp_prop")
+    expected = np.clip(schema.quantiles(schema.vectors(final)), 1e-6, 1 - 1e-6)
+
+    start = last_states(str(tmp_path), params)
+    assert start.shape == (2, schema.size)
+    # to_json keeps 10 digits
+    np.testing.assert_allclose(start, expected, rtol=1e-8)
+    constants = [i for i in range(schema.size) if i not in schema.free]
+    assert np.isnan(start[:, constants]).all()
+    assert np.isfinite(start[:, schema.free]).all()
+    if store == "json":
+        base = schema.quantiles(schema.base[None, :])[0, schema.index["hosp_prop"]]
+        np.testing.assert_allclose(start[:, schema.index["hosp_prop"]], base)
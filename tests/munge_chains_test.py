@@ -0,0 +1,84 @@
+"""Tests for the post-processing of _02_munge_chains
+* Checks that R(t) is read from each draw's own offset, for logistic and spline beta
+* Checks that the plot horizons are trimmed to the run's horizon
+"""
+from os import path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from _02_munge_chains import Rt_quantiles, plot_horizons
+from _99_shared_functions import ParamSchema, SIR_from_params, qdraw, sd_schedule
+
+DATA = path.join(path.dirname(path.dirname(path.abspath(__file__))), "data")
+
+
+def spline_params(params, nobs):
+    """The parameter table of a flexible beta run (see _01_GOF_sims.main)
+    """
+    beta_k = int(params.base.loc[params.param == "beta_spline_dimension"])
+    splines = pd.DataFrame(dict(
+        param=[f"beta_spline_coef_{i}" for i in range(beta_k)],
+        base=0, distribution="norm", p1=0, p2=1,
+    ))
+    nobsd = pd.DataFrame(dict(param=["nobs"], base=[nobs], distribution=["constant"]))
+    params = pd.concat([params, splines, nobsd], ignore_index=True)
+    params.loc[params.param.isin(["logistic_k", "logistic_L", "logistic_x0"]),
+               "distribution"] = "constant"
+    return params
+
+
+@pytest.mark.parametrize("splines", [False, True])
+def test_Rt_quantiles(splines):
+    """Checks R(t) of draws with different offsets against their simulations
+    """
+    census_ts = pd.read_csv(path.join(DATA, "HUP_ts.csv"))
+    nobs = census_ts.shape[0]
+    params = pd.read_csv(path.join(DATA, "HUP_parameters.csv"))
+    # offsets are 4 or 5 days depending on incubation_days
+    params.loc[params.param == "incubation_days", ["distribution", "p1", "p2"]] = \
+        ["uniform", 1.5, 2.5]
+    if splines:
+        params = spline_params(params, nobs)
+    schema = ParamSchema(params)
+    draws = qdraw(np.random.default_rng(0).uniform(size=(40, schema.size)), schema)
+    projection = SIR_from_params(draws, n_days=nobs, stochastic=False)
+    offset = projection["offset"]
+    assert set(offset) == {4, 5}
+
+    df = schema.frame(draws.val)
+    df["offset"] = offset
+    df["s"] = list(projection["s"])
+
+    # R(t) of each draw from the schedule its simulation used, from its first
+    # hospitalization on
+    pop = float(params.base.loc[params.param == "region_pop"])
+    expected = []
+    for j, off in enumerate(offset):
+        schedule = dict(n_days=off + nobs)
+        if splines:
+            schedule.update(b0=draws["b0"][j],
+                            beta_spline=draws.val[j, schema.spline_index][None, :],
+                            beta_k=len(schema.spline_index),
+                            beta_spline_power=draws["beta_spline_power"][j], nobs=nobs)
+        else:
+            schedule.update(logistic_L=draws["logistic_L"][j],
+                            logistic_k=draws["logistic_k"][j],
+                            logistic_x0=draws["logistic_x0"][j] + off)
+        sd = sd_schedule(**schedule)[0, off:]
+        s = projection["s"][j, off:off + nobs]
+        expected.append(draws["beta"][j] * (1 - sd) * (s / pop) ** draws["nu"][j]
+                        * draws["recovery_days"][j])
+    expected = np.quantile(np.array(expected), [0.05, .25, 0.5, .75, 0.95], axis=0).T
+
+    np.testing.assert_allclose(Rt_quantiles(df, params, census_ts), expected, rtol=1e-10)
+
+
+@pytest.mark.parametrize("horizon, expected", [
+    (None, [30, 90, 180]), (180, [30, 90, 180]), (100, [30, 90]), (30, [30]), (20, [20]),
+])
+def test_plot_horizons(horizon, expected):
+    """Checks that only the horizons the chains cover are plotted, or the horizon itself
+    """
+    assert plot_horizons([30, 90, 180], horizon) == expected
@@ -0,0 +1,81 @@
+"""Tests for fitting routines of the normal module
+* Checks that cached normal approximations match fitted ones
+* Checks size bound and on-disk store of the cache
+* Checks that a filled cache shipped to a worker process skips fitting
+"""
+from pickle import dumps, loads
+
+from pandas import DataFrame
+
+from bayes_chime.normal import fitting
+from bayes_chime.normal.fitting import NormalApproximationCache, fit_norm_to_prior_df
+
+PRIOR_DF = DataFrame(
+    {
+        "param": ["n_hosp", "hosp_prop", "ICU_prop", "recovery_days"],
+        "base": [1.0, 0.025, 0.45, 14.0],
+        "distribution": ["constant", "gamma", "beta", "gamma"],
+        "p1": [None, 6.326832789, 52.0593112, 9.833457434],
+        "p2": [None, 0.004168888, 96.8674197, 1.642265575],
+    }
+)
+
+
+def test_cached_approximations(monkeypatch):
+    """Checks that cached priors agree with fitted priors and skip fitting
+    """
+    expected = fit_norm_to_prior_df(PRIOR_DF, cache=None)
+
+    cache = NormalApproximationCache()
+    first = fit_norm_to_prior_df(PRIOR_DF, cache=cache)
+    assert len(cache) == 3
+
+    def fail(dist):
+        raise AssertionError(f"Fitted {dist} although cached.")
+
+    monkeypatch.setattr(fitting, "fit_norm_dist_to_dist", fail)
+    second = fit_norm_to_prior_df(PRIOR_DF, cache=cache)
+
+    for priors in [first, second]:
+        assert priors.keys() == expected.keys()
+        assert priors["n_hosp"] == expected["n_hosp"]
+        for key in ["hosp_prop", "ICU_prop", "recovery_days"]:
+            assert priors[key].mean == expected[key].mean
+            assert priors[key].sdev == expected[key].sdev
+
+
+def test_cache_size_and_store(tmp_path):
+    """Checks that the least recently used entry is dropped and entries persist
+    """
+    file_name = str(tmp_path / "priors.json")
+    cache = NormalApproximationCache(max_size=2, file_name=file_name)
+    cache.put(("gamma", 1.0, 2.0), (2.0, 1.4))
+    cache.put(("beta", 1.0, 2.0), (0.3, 0.2))
+    assert cache.get(("gamma", 1.0, 2.0)) == (2.0, 1.4)
+    cache.put(("normal", 0.0, 1.0), (0.0, 1.0))
+
+    assert len(cache) == 2
+    assert cache.get(("beta", 1.0, 2.0)) is None
+    cache.save()
+
+    cache = NormalApproximationCache(file_name=file_name)
+    assert len(cache) == 2
+    assert cache.get(("gamma", 1.0, 2.0)) == (2.0, 1.4)
+    assert cache.get(("normal", 0.0, 1.0)) == (0.0, 1.0)
+
+
+def test_cache_shipped_to_worker(monkeypatch):
+    """Checks that a cache keeps its entries when pickled for a pool worker
+    """
+    cache = NormalApproximationCache()
+    expected = fit_norm_to_prior_df(PRIOR_DF, cache=cache)
+
+    def fail(dist):
+        raise AssertionError(f"Fitted {dist} although cached.")
+
+    monkeypatch.setattr(fitting, "fit_norm_dist_to_dist", fail)
+    shipped = loads(dumps(cache))
+    priors = fit_norm_to_prior_df(PRIOR_DF, cache=shipped)
+    for key in ["hosp_prop", "ICU_prop", "recovery_days"]:
+        assert priors[key].mean == expected[key].mean
+        assert priors[key].sdev == expected[key].sdev
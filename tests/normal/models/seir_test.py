@@ -1,13 +1,24 @@
 """Tests for SEIR model in this repo
 * Compares conserved quantities
 * Compares model against SEIR wo social policies in limit to SIR
+* Compares vectorized simulation against iterative simulation
+* Compares the SIR and SEIR recurrences against stepping `simulation_step`
+* Compares forward jacobian against gvar arithmetic
 """
-from pytest import fixture
+from functools import partial
 
+from pytest import fixture, mark
+
+from numpy import abs as np_abs
+from numpy import array
 from pandas import Series
+from gvar import BufferDict, gvar, mean, sdev, deriv
+from lsqfit import nonlinear_fit
 from pandas.testing import assert_frame_equal, assert_series_equal
 
 from bayes_chime.normal.models import SIRModel, SEIRModel
+from bayes_chime.normal.models.base import CompartmentModel
+from bayes_chime.normal.utilities import one_minus_logistic_fcn
 
 from tests.normal.models.sir_test import (  # pylint: disable=W0611
     fixture_sir_data_wo_policy,
@@ -25,6 +36,32 @@ COLS_TO_COMPARE = [
 PENN_CHIME_COMMIT = "188c35be9561164bedded4a8071a320cbde0d2bc"
 
 
+def logistic_policy(date, **kwargs):
+    """Time dependent beta for testing update_parameters
+    """
+    kwargs["beta"] = kwargs["beta"] * one_minus_logistic_fcn(
+        (date - kwargs["dates"][0]).days,
+        L=kwargs["logistic_L"],
+        k=kwargs["logistic_k"],
+        x0=kwargs["logistic_x0"],
+    )
+    return kwargs
+
+
+def logistic_policy_schedule(days, **kwargs):
+    """Array version of `logistic_policy` for testing parameter_schedule
+    """
+    return {
+        "beta": kwargs["beta"]
+        * one_minus_logistic_fcn(
+            days,
+            L=kwargs["logistic_L"],
+            k=kwargs["logistic_k"],
+            x0=kwargs["logistic_x0"],
+        )
+    }
+
+
 @fixture(name="seir_data")
 def fixture_seir_data(sir_data_wo_policy):
     """Returns data for the SIHR model
@@ -85,3 +122,109 @@ def test_compare_sir_vs_seir(sir_data_wo_policy, seir_data, monkeypatch):
     assert_frame_equal(
         predictions_sir[COLS_TO_COMPARE], predictions_seir[COLS_TO_COMPARE],
     )
+
+
+def test_simulate_vs_propagate_uncertainties(seir_data):
+    """Checks if the vectorized simulation reproduces the iterative simulation for
+    a time dependent beta, with and without a parameter schedule
+    """
+    x, pars = seir_data
+    pars = pars.copy()
+    pars["initial_exposed"] = gvar(pars["initial_infected"], 10)
+    pars["beta"] = gvar(pars["beta"], pars["beta"] / 10)
+    pars["logistic_L"] = gvar(0.5, 0.1)
+    x = {**x, "logistic_k": 0.5, "logistic_x0": 20}
+
+    fit_columns = ["infected", "hospital_census"]
+    seir_model = SEIRModel(fit_columns=fit_columns, update_parameters=logistic_policy)
+    expected = seir_model.propagate_uncertainties(x, pars)
+
+    for schedule in [None, logistic_policy_schedule]:
+        seir_model.parameter_schedule = schedule
+        computed = seir_model.simulate(x, pars).to_frame()
+
+        assert list(computed.columns) == list(expected.columns)
+        assert_frame_equal(
+            expected.applymap(mean), computed.applymap(mean), check_freq=False
+        )
+        assert_frame_equal(
+            expected.applymap(sdev), computed.applymap(sdev), check_freq=False
+        )
+
+        seir_model.vectorized = False
+        yy_expected = seir_model.fit_fcn(x, pars)
+        seir_model.vectorized = True
+        yy_computed = seir_model.fit_fcn(x, pars)
+        assert yy_expected.shape == yy_computed.shape
+        assert np_abs(mean(yy_expected) - mean(yy_computed)).max() == 0
+        assert np_abs(sdev(yy_expected) - sdev(yy_computed)).max() == 0
+
+
+@mark.parametrize("model_class", [SIRModel, SEIRModel])
+def test_recurrence_vs_simulation_step(model_class, seir_data):
+    """Checks if the models' recurrence reproduces the default recurrence, which
+    calls `simulation_step` for every date
+    """
+    x, pars = seir_data
+    pars = pars.copy()
+    pars["initial_exposed"] = gvar(pars["initial_infected"], 10)
+    pars["beta"] = gvar(pars["beta"], pars["beta"] / 10)
+    pars["logistic_L"] = gvar(0.5, 0.1)
+    x = {**x, "logistic_k": 0.5, "logistic_x0": 20}
+
+    model = model_class(
+        update_parameters=logistic_policy, parameter_schedule=logistic_policy_schedule
+    )
+    computed = model.simulate(x, pars).to_frame()
+    model.recurrence = partial(CompartmentModel.recurrence, model)
+    expected = model.simulate(x, pars).to_frame()
+
+    assert_frame_equal(expected.applymap(mean), computed.applymap(mean))
+    assert_frame_equal(expected.applymap(sdev), computed.applymap(sdev))
+
+
+def test_forward_jacobian(seir_data):
+    """Checks if the forward jacobian reproduces the gvar arithmetic fit function and
+    the resulting fit parameters
+    """
+    x, pars = seir_data
+    x = {**x, "logistic_k": 0.5, "logistic_x0": 20}
+    prior = BufferDict(
+        beta=gvar(pars["beta"], pars["beta"] / 10),
+        gamma=gvar(pars["gamma"], pars["gamma"] / 10),
+        alpha=gvar(0.5, 0.05),
+        nu=gvar(1, 0.1),
+        logistic_L=gvar(0.5, 0.1),
+        initial_exposed=gvar(pars["initial_infected"], 10),
+        hospital_probability=gvar(pars["hospital_probability"], 0.001),
+    )
+    x.update({key: val for key, val in pars.items() if key not in prior})
+
+    fit_columns = ["infected", "hospital_census"]
+    kwargs = dict(
+        fit_columns=fit_columns,
+        update_parameters=logistic_policy,
+        parameter_schedule=logistic_policy_schedule,
+        fit_start_date=x["dates"][10],
+    )
+    gvar_model = SEIRModel(**kwargs)
+    tangent_model = SEIRModel(**kwargs, forward_jacobian=True)
+
+    yy_expected = gvar_model.fit_fcn(x, prior)
+    yy_computed = tangent_model.fit_fcn(x, prior)
+    scale = np_abs(mean(yy_expected)).max(axis=0)
+    assert np_abs((mean(yy_expected) - mean(yy_computed)) / scale).max() < 1.0e-12
+    jac_expected = array([deriv(y, prior.buf) for y in yy_expected.flat])
+    jac_computed = array([deriv(y, prior.buf) for y in yy_computed.flat])
+    assert np_abs(jac_expected - jac_computed).max() < 1.0e-12 * np_abs(
+        jac_expected
+    ).max()
+
+    yy = gvar(mean(yy_expected) * 1.05, sdev(yy_expected) + 0.1 * scale)
+    fit_expected = nonlinear_fit(data=(x, yy), prior=prior, fcn=gvar_model.fit_fcn)
+    fit_computed = nonlinear_fit(data=(x, yy), prior=prior, fcn=tangent_model.fit_fcn)
+    for key in prior:
+        assert abs(fit_expected.p[key].mean - fit_computed.p[key].mean) < (
+            1.0e-6 * fit_expected.p[key].sdev
+        )
+        assert abs(fit_expected.p[key].sdev / fit_computed.p[key].sdev - 1) < 1.0e-6
@@ -0,0 +1,69 @@
+"""Tests for the cross-validation of the command line script
+* Checks that warm-starting the penalty path selects the same penalty as cold starts
+* Checks that constant series are scored without dividing by zero
+"""
+from os import path
+
+from numpy import arange, exp, isfinite
+from pandas import DataFrame, Index, concat, date_range
+from pytest import fixture
+
+from bayes_chime.executor import RunExecutor
+from bayes_chime.normal.scripts.cli import cross_validate, select_penalty
+from bayes_chime.normal.scripts.utils import read_parameters
+
+DATA = path.join(path.dirname(path.dirname(path.dirname(path.dirname(
+    path.abspath(__file__))))), "data")
+PENALTIES = [1e-3, 1e-1, 10.0]
+ERROR_INFOS = {"hosp_min": 10, "hosp_rel": 0.1, "vent_min": 2, "vent_rel": 0.1}
+
+
+@fixture(name="xval_setup")
+def fixture_xval_setup():
+    """A logistic rise of the census without any vents, and the flexible beta priors
+    """
+    days = arange(45)
+    hosp = (2 + 60 / (1 + exp(-(days - 25) / 5))).round().astype(int)
+    data = DataFrame(
+        {"hosp": hosp, "vent": 0},
+        index=Index(date_range("2020-03-09", periods=45, freq="D"), name="date"),
+    )
+    parameters = read_parameters(path.join(DATA, "foo.csv"))
+    splines = arange(0, 45, 9)
+    return parameters, splines, data
+
+
+def test_warm_start_penalty(xval_setup):
+    """Checks that the warm-started penalty path selects the penalty of cold starts
+    """
+    parameters, splines, data = xval_setup
+    with RunExecutor(processes=1) as executor:
+        warm = cross_validate(
+            PENALTIES, [30], parameters, splines, 1, data, ERROR_INFOS, executor
+        )
+        cold = concat(
+            [
+                cross_validate(
+                    [pen], [30], parameters, splines, 1, data, ERROR_INFOS, executor
+                )
+                for pen in PENALTIES
+            ],
+            ignore_index=True,
+        )
+
+    assert warm.pen.tolist() == cold.pen.tolist() == PENALTIES
+    assert select_penalty(warm) == select_penalty(cold) == 10.0
+
+
+def test_constant_series(xval_setup):
+    """Checks that windows without vents are scored with finite errors
+    """
+    parameters, splines, data = xval_setup
+    with RunExecutor(processes=1) as executor:
+        xval_df = cross_validate(
+            PENALTIES, [30, 35], parameters, splines, 1, data, ERROR_INFOS, executor
+        )
+
+    assert (xval_df.error == "").all()
+    assert (xval_df.mse > 0).all()
+    assert isfinite(xval_df.rmse).all()
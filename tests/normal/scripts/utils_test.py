@@ -0,0 +1,71 @@
+"""Tests for reading the previous fit of an update run
+* Checks that a directory search picks the most recent fit.pickle
+* Checks that a directory without fit.pickle raises FileNotFoundError
+* Checks that an update run starts from the posterior means of the previous fit
+"""
+from os import makedirs, path, utime
+
+from numpy import arange
+from gvar import dump, gvar
+from lsqfit import nonlinear_fit
+from pytest import raises
+
+from bayes_chime.normal.scripts.cli import start_values
+from bayes_chime.normal.scripts.utils import read_previous_fit
+
+
+def line(x, p):
+    """Straight line model of the fits"""
+    return p["a"] + p["b"] * x
+
+
+def dump_fit(dir_name, slope, mtime):
+    """Dumps a fit of a line with `slope` the way `dump_results` does
+    """
+    x = arange(5.0)
+    fit = nonlinear_fit(
+        data=(x, gvar(1 + slope * x, 0.1 * (1 + x))),
+        prior={"a": gvar(0, 10), "b": gvar(0, 10)},
+        fcn=line,
+    )
+    makedirs(dir_name, exist_ok=True)
+    file_name = path.join(dir_name, "fit.pickle")
+    dump({"model": None, "fit": fit}, outputfile=file_name)
+    utime(file_name, (mtime, mtime))
+    return fit
+
+
+def test_read_previous_fit(tmp_path):
+    """Checks that the newest fit.pickle of the run directories is read
+    """
+    output_dir = str(tmp_path)
+    dump_fit(path.join(output_dir, "2020_05_01_10_00_00"), 2.0, 1e9)
+    newest = dump_fit(path.join(output_dir, "2020_05_02_10_00_00"), 3.0, 1e9 + 200)
+    dump_fit(path.join(output_dir, "nested", "2020_05_03_10_00_00"), 4.0, 1e9 + 100)
+
+    fit = read_previous_fit(output_dir)
+    assert fit.pmean["b"] == newest.pmean["b"]
+    assert abs(fit.pmean["b"] - 3) < 0.1
+
+    direct = read_previous_fit(path.join(output_dir, "nested", "2020_05_03_10_00_00",
+                                         "fit.pickle"))
+    assert abs(direct.pmean["b"] - 4) < 0.1
+
+
+def test_read_previous_fit_missing(tmp_path):
+    """Checks that a directory without a previous fit raises
+    """
+    makedirs(str(tmp_path / "empty"))
+    with raises(FileNotFoundError):
+        read_previous_fit(str(tmp_path))
+
+
+def test_start_values(tmp_path):
+    """Checks that `--update` starts the fit from the previous posterior means
+    """
+    fit = dump_fit(str(tmp_path), 2.0, 1e9)
+    p0 = start_values(str(tmp_path))
+    assert set(p0) == {"a", "b"}
+    for key in ["a", "b"]:
+        assert p0[key] == fit.pmean[key]
+    assert start_values(None) is None
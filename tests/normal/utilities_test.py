@@ -0,0 +1,46 @@
+"""Tests for utility functions of the normal module
+* Compares vectorized census against the plain recurrence
+"""
+from numpy import array, linspace, stack
+from numpy.random import default_rng
+from numpy.testing import assert_allclose
+
+from gvar import gvar, mean, sdev
+
+from bayes_chime.normal.utilities import exponential_census
+
+
+def census_recurrence(admits, length_of_stay):
+    """Reference implementation of census for exponential length of stay
+    """
+    census = [0]
+    for admit in admits:
+        census.append(admit + (1 - 1 / length_of_stay) * census[-1])
+    return array(census[1:])
+
+
+def test_exponential_census_batch():
+    """Checks batched census against recurrence for different length of stays
+    """
+    rng = default_rng(42)
+    admits = rng.poisson(20, size=(50, 300)).astype(float)
+    length_of_stay = linspace(1.05, 20, 50)
+
+    expected = stack(
+        [census_recurrence(aa, los) for aa, los in zip(admits, length_of_stay)]
+    )
+
+    assert_allclose(exponential_census(admits, length_of_stay), expected, rtol=1.0e-12)
+
+
+def test_exponential_census_gvar():
+    """Checks that census of gvars follows recurrence including uncertainties
+    """
+    admits = gvar([1, 2, 3, 4, 5], [0.1, 0.2, 0.3, 0.4, 0.5])
+    length_of_stay = gvar(7, 1)
+
+    computed = exponential_census(admits, length_of_stay)
+    expected = census_recurrence(admits, length_of_stay)
+
+    assert_allclose(mean(computed), mean(expected))
+    assert_allclose(sdev(computed), sdev(expected))
@@ -0,0 +1,434 @@
+"""Tests for the simulation and sampler building blocks in _99_shared_functions
+* Checks that the batched SEIR engine matches the scalar one and the day loop it replaced
+* Checks that the compiled prior transform matches the per-row one it replaced
+* Checks that array-native parameter vectors simulate like the long-format frames
+* Checks that the sample store keeps one copy of the trajectories per state
+* Checks that the adaptive proposal survives non-finite acceptance probabilities
+* Checks that trajectory bands are bounded by default and exact when uncapped
+* Checks the stochastic observation models and the deterministic projection
+* Checks the days and the quantile bands of the reopening scenarios
+* Checks that the spline design matrix is built once and read-only
+"""
+from os import path
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import stats as sps
+
+from _99_shared_functions import (
+    OBSERVATION_MODELS,
+    AdaptiveProposal,
+    ParamSchema,
+    ParamVector,
+    SampleStore,
+    SIR_from_params,
+    TrajectoryReservoir,
+    logistic,
+    qdraw,
+    power_spline,
+    reopenfn,
+    reopening_days,
+    reopening_scenarios,
+    sd_schedule,
+    sim_sir,
+    sim_sir_batch,
+    sir,
+    spline_design_matrix,
+)
+from bayes_chime.executor import RunExecutor
+
+DATA = path.join(path.dirname(path.dirname(path.abspath(__file__))), "data")
+N_DAYS = 120
+
+
+def draws(n_draws, seed=0):
+    """Random SEIR parameters, one entry per draw
+    """
+    rng = np.random.default_rng(seed)
+    return dict(
+        S=rng.uniform(1e6, 4e6, n_draws),
+        E=np.zeros(n_draws),
+        I=rng.uniform(1, 100, n_draws),
+        R=np.zeros(n_draws),
+        alpha=rng.uniform(0.15, 0.3, n_draws),
+        beta=rng.uniform(0.2, 0.5, n_draws),
+        gamma=rng.uniform(0.05, 0.15, n_draws),
+        nu=rng.uniform(1.0, 2.0, n_draws),
+        logistic_L=rng.uniform(0.3, 0.8, n_draws),
+        logistic_k=rng.uniform(0.5, 2.0, n_draws),
+        logistic_x0=rng.uniform(10, 40, n_draws),
+        b0=rng.normal(size=n_draws),
+        beta_spline=rng.normal(size=(n_draws, 5)),
+        reopen_day=rng.integers(50, 100, n_draws),
+        reopen_speed=rng.uniform(0, 0.1, n_draws),
+        reopen_cap=rng.uniform(0, 1, n_draws),
+    )
+
+
+def loop_sim_sir(S, E, I, R, alpha, beta, b0, beta_spline, beta_k, beta_spline_power,
+                 nobs, gamma, nu, n_days, logistic_L, logistic_k, logistic_x0,
+                 reopen_day, reopen_speed, reopen_cap):
+    """The day-by-day scalar simulation that sim_sir used to be
+    """
+    N = S + E + I + R
+    s, e, i, r = [S], [E], [I], [R]
+    if len(beta_spline) > 0:
+        knots = np.linspace(0, nobs - nobs / beta_k / 2, beta_k)
+    for day in range(n_days):
+        y = S, E, I, R
+        if len(beta_spline) > 0:
+            X = power_spline(day, knots, beta_spline_power, xtrim=nobs)
+            sd = logistic(L=1, k=1, x0=0, x=b0 + float(X @ beta_spline))
+        else:
+            sd = logistic(logistic_L, logistic_k, logistic_x0, x=day)
+        sd *= reopenfn(day, reopen_day, reopen_speed, reopen_cap)
+        S, E, I, R = sir(y, alpha, beta * (1 - sd), gamma, nu, N)
+        s.append(S)
+        e.append(E)
+        i.append(I)
+        r.append(R)
+    return np.array(s), np.array(e), np.array(i), np.array(r)
+
+
+@pytest.mark.parametrize("splines", [False, True])
+def test_sim_sir_batch(splines):
+    """Checks that a batch of draws matches the draws simulated one at a time, by
+    sim_sir and by the day loop it replaced
+    """
+    pars = draws(6)
+    schedule = dict(n_days=N_DAYS, reopen_day=pars["reopen_day"],
+                    reopen_speed=pars["reopen_speed"], reopen_cap=pars["reopen_cap"])
+    if splines:
+        schedule.update(b0=pars["b0"], beta_spline=pars["beta_spline"], beta_k=5,
+                        beta_spline_power=2, nobs=60)
+    else:
+        schedule.update(logistic_L=pars["logistic_L"], logistic_k=pars["logistic_k"],
+                        logistic_x0=pars["logistic_x0"])
+    sd = sd_schedule(**schedule)
+    assert sd.shape == (6, N_DAYS)
+    batch = sim_sir_batch(*[pars[k] for k in ["S", "E", "I", "R", "alpha", "beta",
+                                             "gamma", "nu"]], sd)
+
+    for j in range(6):
+        kwargs = dict(
+            S=pars["S"][j], E=pars["E"][j], I=pars["I"][j], R=pars["R"][j],
+            alpha=pars["alpha"][j], beta=pars["beta"][j], b0=pars["b0"][j],
+            beta_spline=pars["beta_spline"][j] if splines else [], beta_k=5,
+            beta_spline_power=2, nobs=60, gamma=pars["gamma"][j], nu=pars["nu"][j],
+            n_days=N_DAYS, logistic_L=pars["logistic_L"][j],
+            logistic_k=pars["logistic_k"][j], logistic_x0=pars["logistic_x0"][j],
+            reopen_day=pars["reopen_day"][j], reopen_speed=pars["reopen_speed"][j],
+            reopen_cap=pars["reopen_cap"][j],
+        )
+        single = sim_sir(Xmu=None, Xsig=None, **kwargs)
+        loop = loop_sim_sir(**kwargs)
+        for compartment in range(4):
+            assert batch[compartment].shape == (6, N_DAYS + 1)
+            np.testing.assert_allclose(batch[compartment][j], single[compartment],
+                                       rtol=1e-10)
+            np.testing.assert_allclose(single[compartment], loop[compartment], rtol=1e-10)
+
+
+def test_adaptive_proposal_non_finite():
+    """Checks that nan acceptance probabilities and saturated quantiles are ignored
+    """
+    proposal = AdaptiveProposal(np.arange(3), min_samples=2)
+    rng = np.random.default_rng(0)
+    pos = np.array([0.5, 1.0, 0.0])
+    for _ in range(5):
+        proposal.update(pos, np.nan)
+        proposal.update(pos, 0.5)
+        pos = proposal.propose(pos, rng)
+        assert ((pos > 0) & (pos < 1)).all()
+    assert proposal.n == 5
+    assert np.isfinite(proposal.log_scale)
+    assert np.isfinite(proposal.mean).all()
+    assert np.isfinite(proposal.chol).all()
+
+
+def test_trajectory_reservoir_exact():
+    """Checks that reservoirs are bounded by default, that uncapped ones give the
+    quantiles of every trajectory, also after pooling chains, and that capped
+    ones say they are approximate
+    """
+    assert TrajectoryReservoir().capacity == 4000
+    rng = np.random.default_rng(0)
+    draws = rng.normal(size=(3, 500, 10))
+    q = [0.025, 0.5, 0.975]
+
+    chains = [TrajectoryReservoir(None, rng=1), TrajectoryReservoir(None, rng=2),
+              TrajectoryReservoir(None, rng=3)]
+    capped = [TrajectoryReservoir(100, rng=1), TrajectoryReservoir(100, rng=2),
+              TrajectoryReservoir(100, rng=3)]
+    for reservoirs in [chains, capped]:
+        for res, chain_draws in zip(reservoirs, draws):
+            for draw in chain_draws:
+                res.push(draw)
+
+    pooled = chains[0].merge(chains[1]).merge(chains[2])
+    assert pooled.exact
+    assert pooled.describe() == "exact, over all 1500 retained trajectories"
+    np.testing.assert_array_equal(
+        pooled.quantiles(q), np.quantile(draws.reshape(-1, 10), q, axis=0)
+    )
+
+    pooled = capped[0].merge(capped[1]).merge(capped[2])
+    assert not pooled.exact
+    assert len(pooled.samples) == 100
+    assert "approximate" in pooled.describe()
+
+
+def row_qdraw(qvec, p_df):
+    """The per-row prior transform that qdraw used to be: values and prior densities
+    """
+    outdicts = []
+    for i in range(len(qvec)):
+        if p_df.distribution.iloc[i] == "constant":
+            out = dict(param=p_df.param.iloc[i], val=p_df.base.iloc[i], prob=1)
+        else:
+            if p_df.distribution.iloc[i] == "gamma":
+                p = (qvec[i], p_df.p1.iloc[i], 0, p_df.p2.iloc[i])
+            elif p_df.distribution.iloc[i] == "beta":
+                p = (qvec[i], p_df.p1.iloc[i], p_df.p2.iloc[i])
+            elif p_df.distribution.iloc[i] == "uniform":
+                p = (qvec[i], p_df.p1.iloc[i], p_df.p1.iloc[i] + p_df.p2.iloc[i])
+            elif p_df.distribution.iloc[i] == "norm":
+                p = (qvec[i], p_df.p1.iloc[i], p_df.p2.iloc[i])
+            out = dict(
+                param=p_df.param.iloc[i],
+                val=getattr(sps, p_df.distribution.iloc[i]).ppf(*p),
+            )
+            p_pdf = (out["val"],) + p[1:]
+            out.update({"prob": getattr(sps, p_df.distribution.iloc[i]).pdf(*p_pdf)})
+        outdicts.append(out)
+    return pd.DataFrame(outdicts)
+
+
+def test_prior_transform():
+    """Checks values and log prior densities of single vectors and of a matrix of
+    proposals against the per-row transform, for every distribution family
+    """
+    params = pd.read_csv(path.join(DATA, "HUP_parameters.csv"))
+    params = pd.concat([params, pd.DataFrame(
+        dict(param=["uniform_par"], base=[0.5], distribution=["uniform"], p1=[2.0], p2=[3.0])
+    )], ignore_index=True)
+    schema = ParamSchema(params)
+    assert set(schema.distribution) == {"constant", "gamma", "beta", "norm", "uniform"}
+
+    qmat = np.random.default_rng(0).uniform(size=(5, schema.size))
+    batch = qdraw(qmat, schema)
+    for j, qvec in enumerate(qmat):
+        expected = row_qdraw(qvec, params)
+        single = qdraw(qvec, params)
+        for draw in [single.val, batch.val[j]]:
+            np.testing.assert_allclose(draw, expected.val.astype(float), rtol=1e-12)
+        for logprior in [single.logprior, batch.logprior[j]]:
+            np.testing.assert_allclose(logprior, np.log(expected.prob.astype(float)),
+                                       rtol=1e-10)
+
+    # quantiles invert the transform on the sampled parameters
+    np.testing.assert_allclose(schema.quantiles(batch.val)[:, schema.free],
+                               qmat[:, schema.free], rtol=1e-8)
+    assert np.isnan(schema.quantiles(batch.val)[:, schema.distribution == "constant"]).all()
+
+
+def test_param_vectors():
+    """Checks batched and single-draw simulations from parameter vectors against the
+    long-format frames qdraw used to return, and the frame <-> vector round trip
+    """
+    params = pd.read_csv(path.join(DATA, "HUP_parameters.csv"))
+    schema = ParamSchema(params)
+    qmat = np.random.default_rng(1).uniform(size=(4, schema.size))
+    batch = qdraw(qmat, schema)
+    assert batch["beta"].shape == (4,)
+    assert batch.get("reopen_day") is None
+
+    frame = schema.frame(batch.val)
+    assert list(frame.columns) == schema.scalar_names
+    np.testing.assert_array_equal(schema.vectors(frame), batch.val)
+
+    projection = SIR_from_params(batch, n_days=60, stochastic=False)
+    for j in range(4):
+        single = qdraw(qmat[j], schema)
+        long_format = single.to_frame()[["param", "val"]]
+        for draw in [single, long_format]:
+            out = SIR_from_params(draw, n_days=60, stochastic=False)
+            assert out["offset"] == projection["offset"][j]
+            np.testing.assert_allclose(out["arr"], projection["arr"][j], rtol=1e-10)
+
+
+def test_sample_store():
+    """Checks the frame of a sample store: rows in order, one trajectory object per
+    state shared by the rows that reference it, and room made by `grow`
+    """
+    schema = ParamSchema(pd.read_csv(path.join(DATA, "HUP_parameters.csv")))
+    vals = qdraw(np.random.default_rng(2).uniform(size=(3, schema.size)), schema).val
+    store = SampleStore(schema, 2, test_loss=True)
+    state = store.add_state(np.ones((11, 6)), *[np.arange(13.0)] * 4)
+    store.append(vals[0], iter=1, chain=3, posterior=-1.0, offset=2, state=state,
+                 test_loss=0.5)
+    store.append(vals[0], iter=2, chain=3, posterior=-2.0, offset=2, state=state,
+                 test_loss=0.5)
+    store.grow(3)
+    store.append(vals[1], iter=3, chain=3, posterior=-3.0, offset=4, test_loss=0.25)
+    assert len(store) == 3
+
+    df = store.frame()
+    assert list(df.columns) == schema.scalar_names + [
+        "arr", "iter", "chain", "posterior", "offset", "s", "e", "i", "r", "test_loss"
+    ]
+    assert df.iter.tolist() == [1, 2, 3]
+    assert df.posterior.tolist() == [-1.0, -2.0, -3.0]
+    assert df.test_loss.tolist() == [0.5, 0.5, 0.25]
+    np.testing.assert_array_equal(schema.vectors(df)[:, schema.free],
+                                  vals[[0, 0, 1]][:, schema.free])
+    assert df.arr[0] is df.arr[1]
+    assert df.s[0] is df.s[1]
+    assert df.arr[2] is None
+
+
+@pytest.mark.parametrize("model", sorted(OBSERVATION_MODELS))
+def test_observation_models(model):
+    """Checks shape, support and reproducibility of the observation models
+    """
+    observation = OBSERVATION_MODELS[model]
+    rng = np.random.default_rng(3)
+    s = np.linspace(1e6, 8e5, 51)[None, :] * np.ones((3, 1))
+    e = rng.uniform(1e2, 1e4, size=(3, 51))
+    ds = rng.uniform(0, 500, size=(3, 51))
+    props = dict(hosp_prop=np.full((3, 1), .03), ICU_prop=np.full((3, 1), .4),
+                 vent_prop=np.full((3, 1), .6), mkt_share=np.full((3, 1), .2))
+
+    hosp, icu, vent = observation(ds, s, e, rng=np.random.default_rng(4), **props)
+    for admits in [hosp, icu, vent]:
+        assert admits.shape == (3, 51)
+        assert (admits >= 0).all()
+    if model == "binomial":
+        for admits in [hosp, icu, vent]:
+            assert np.issubdtype(admits.dtype, np.integer)
+    assert (icu <= hosp).all() and (vent <= icu).all()
+
+    again = observation(ds, s, e, rng=np.random.default_rng(4), **props)
+    other = observation(ds, s, e, rng=np.random.default_rng(5), **props)
+    for x, y, z in zip([hosp, icu, vent], again, other):
+        np.testing.assert_array_equal(x, y)
+    assert not np.array_equal(hosp, other[0])
+
+
+def baseline_projection(draw, n_days):
+    """The deterministic projection (admits and census) of one ParamVector, the
+    way SIR_from_params computed it before the observation models
+    """
+    offset = int(sps.expon.ppf(0.99, 1 / draw["incubation_days"]))
+    total_infections = draw["n_hosp"] / draw["mkt_share"] / draw["hosp_prop"]
+    s, e, i, r = sim_sir(draw["region_pop"] - total_infections, total_infections, 0.0, 0.0,
+                         1 / draw["incubation_days"], draw["beta"], None, [], None, None,
+                         None, None, None, 1 / draw["recovery_days"], draw["nu"],
+                         n_days + offset, draw["logistic_L"], draw["logistic_k"],
+                         draw["logistic_x0"] + offset)
+    ds = np.array([0] + list(np.diff(i) + np.diff(r)))[offset:]
+    hosp = ds * draw["hosp_prop"] * draw["mkt_share"]
+    icu = hosp * draw["ICU_prop"]
+    vent = icu * draw["vent_prop"]
+    columns = [hosp, icu, vent]
+    for admits, los in zip([hosp, icu, vent], ["hosp_LOS", "ICU_LOS", "vent_LOS"]):
+        census = [0]
+        for a in admits:
+            census.append(float(a) + (1 - 1 / float(draw[los])) * census[-1])
+        columns.append(np.array(census[1:]))
+    return np.stack(columns, axis=1)
+
+
+def test_SIR_from_params_observation():
+    """Checks the stochastic projections for shape, support and reproducibility, and
+    that fit mode returns the same deterministic projection as the baseline
+    """
+    schema = ParamSchema(pd.read_csv(path.join(DATA, "HUP_parameters.csv")))
+    batch = qdraw(np.random.default_rng(6).uniform(size=(4, schema.size)), schema)
+
+    projection = SIR_from_params(batch, n_days=60, rng=np.random.default_rng(7))
+    assert projection["arr_stoch"].shape == projection["arr"].shape == (4, 61, 6)
+    assert (projection["arr_stoch"] >= 0).all()
+    # binomial admits are whole individuals
+    admits = projection["arr_stoch"][:, :, :3]
+    np.testing.assert_array_equal(admits, np.round(admits))
+    again = SIR_from_params(batch, n_days=60, rng=np.random.default_rng(7))
+    np.testing.assert_array_equal(projection["arr_stoch"], again["arr_stoch"])
+
+    fit = SIR_from_params(batch, n_days=60, stochastic=False)
+    assert fit["arr_stoch"] is None
+    for key in ["arr", "s", "e", "i", "r", "offset"]:
+        np.testing.assert_array_equal(fit[key], projection[key])
+    for j in range(4):
+        np.testing.assert_allclose(fit["arr"][j],
+                                   baseline_projection(ParamVector(schema, batch.val[j]), 60),
+                                   rtol=1e-10, atol=1e-12)
+
+
+@pytest.mark.parametrize("reopen_day, n_days, expected", [
+    (100, 300, [100, 134, 168]),
+    # spacing of at least a day, up to 2/3 of the projection
+    (0, 3, [0, 1]),
+    (199, 300, [199]),
+    (200, 300, []),
+    # no zero or negative spacing past the projection
+    (300, 300, []),
+    (400, 300, []),
+    (8675309, 300, []),
+])
+def test_reopening_days(reopen_day, n_days, expected):
+    """Checks the reopening days of the scenarios against the horizon
+    """
+    days = reopening_days(reopen_day, n_days, 6)
+    assert days.tolist() == expected
+    assert len(days) <= 6
+
+
+def test_reopening_scenarios():
+    """Checks that each scenario gets the quantiles of its own seeded simulation, with
+    or without worker processes
+    """
+    schema = ParamSchema(pd.read_csv(path.join(DATA, "HUP_parameters.csv")))
+    batch = qdraw(np.random.default_rng(8).uniform(size=(6, schema.size)), schema)
+    q = (.05, .25, .5, .75, .95)
+    scenarios = [(day, .1, .5) for day in reopening_days(20, 60, 3)]
+    assert len(scenarios) == 2
+
+    qmats = reopening_scenarios(schema, batch.val, scenarios, n_days=60, processes=1)
+    assert len(qmats) == 2
+    for (day, speed, cap), seed, qmat in zip(
+            scenarios, np.random.SeedSequence(0).spawn(2), qmats):
+        draw = SIR_from_params(batch, reopen_day=day, reopen_speed=speed, reopen_cap=cap,
+                               rng=np.random.default_rng(seed), n_days=60)
+        np.testing.assert_array_equal(
+            qmat, np.quantile(draw["arr_stoch"][:, :, 3], q, axis=0))
+        assert qmat.shape == (5, 61)
+        assert (np.diff(qmat, axis=0) >= 0).all()
+    assert not np.array_equal(qmats[0], qmats[1])
+
+    with RunExecutor(processes=2) as executor:
+        shared = reopening_scenarios(schema, batch.val, scenarios, n_days=60,
+                                     executor=executor)
+        assert reopening_scenarios(schema, batch.val, [], n_days=60, executor=executor) == []
+    for x, y in zip(qmats, shared):
+        np.testing.assert_array_equal(x, y)
+
+
+def test_spline_design_matrix():
+    """Checks that equal arguments share one read-only matrix of power_spline rows
+    """
+    X = spline_design_matrix(119, 5, np.array([2.0]), 160)
+    assert X.shape == (160, 5)
+    # the arguments come as ints, floats or one-element arrays
+    assert spline_design_matrix(119.0, 5, 2, 160) is X
+    assert spline_design_matrix(np.int64(119), np.float64(5), [2.0], 160.0) is X
+    assert spline_design_matrix(119, 5, 2, 161) is not X
+
+    knots = np.linspace(0, 119 - 119 / 5 / 2, 5)
+    for day in [0, 50, 130]:
+        np.testing.assert_array_equal(X[day], power_spline(day, knots, 2.0, xtrim=119))
+
+    assert not X.flags.writeable
+    with pytest.raises(ValueError):
+        X[0, 0] = 1.0